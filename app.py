@@ -2,17 +2,30 @@
 
 """The app."""
 from os import getenv, getcwd, path
-from datetime import datetime as dt
+from hashlib import sha256
 from io import BytesIO
+from itertools import chain
 from locale import setlocale, LC_TIME
 
-from flask import (Flask, render_template, send_file, make_response, g, request)
+from flask import (Flask, Response, render_template, g, request, redirect,
+                   url_for, jsonify, abort, stream_with_context)
 from werkzeug import secure_filename
-from jinjatex import Jinjatex
-from jinja2 import PackageLoader, StrictUndefined
 
 from contractor.soapclient import Importer
+from contractor.cache import Snapshot, TTLCache
+from contractor.tex import ParallelCompiler, create_environment
+from contractor.formats import FormatCache
+from contractor.workers import TexWorkerPool
+from contractor.storage import FileCache, file_digest, file_response
+from contractor.jobs import JobQueue
+from contractor.pregenerate import Pregenerator
+from contractor.scheduler import (CompileScheduler, Overloaded, PREVIEW,
+                                  BULK, BACKGROUND)
+from contractor.archive import stream_zip, unique_filenames
+from contractor import batch
+from contractor.database import CompanyStore, FILTER_NAMES
 from contractor.api_auth import api_auth, protected
+from contractor.metrics import METRICS
 
 app = Flask('contractor')
 app.config.from_pyfile('settings.py')
@@ -30,51 +43,223 @@ app.config.setdefault('LOCALE', 'de_CH.utf-8')
 setlocale(LC_TIME, app.config['LOCALE'])
 
 
-CRM = Importer(app.config['SOAP_USERNAME'], app.config['SOAP_PASSWORD'])
-
-TEX = Jinjatex(tex_engine='xelatex',
-               loader=PackageLoader('contractor', 'tex_templates'),
-               undefined=StrictUndefined,
-               trim_blocks=True)
-
-
-TEX.env.filters.update({
-    # Filters to parse date, including short one to list dates nicely
-    # Format: Dienstag, 18.10.2016
-    'fulldate': lambda date: dt.strftime(date, "%A, %d.%m.%Y"),
-    # Format: Dienstag, 18.
-    'shortdate': lambda date: dt.strftime(date, "%A, %d.")
-})
+# Does not connect yet, the CRM may be unavailable during startup
+CRM = Importer(app.config['SOAP_USERNAME'], app.config['SOAP_PASSWORD'],
+               full_sync_every=app.config['CRM_FULL_SYNC_EVERY'],
+               sessions=app.config['CRM_SESSIONS'],
+               retries=app.config['CRM_RETRIES'],
+               backoff=app.config['CRM_BACKOFF'])
+
+# Imported companies are stored locally to filter them and survive restarts
+STORE = CompanyStore(path.join(app.config['STORAGE_DIR'], 'companies.db'))
+
+
+def load_companies():
+    """Import changes from the CRM and store the result."""
+    (data, errors) = CRM.sync()
+    STORE.save(data, errors)
+    return (data, errors)
+
+
+# Shared snapshot of (data, errors), requests don't need to wait for the CRM
+# Only changes are imported from the CRM to update the snapshot
+COMPANIES = Snapshot(load_companies, ttl=app.config['CRM_SNAPSHOT_TTL'])
+
+# Contracts of single companies are rendered once and reused until the
+# company or the settings change, entries never expire
+FRAGMENTS = TTLCache(maxsize=app.config['TEX_FRAGMENT_CACHE_SIZE'],
+                     ttl=float('inf'))
+TEX = create_environment(fragment_cache=FRAGMENTS)
+
+# Compiled pdfs are cached on disk
+PDF_CACHE = FileCache(path.join(app.config['STORAGE_DIR'], 'pdf'),
+                      max_size=app.config['STORAGE_MAX_SIZE'])
+
+# Preambles of tex documents are precompiled
+if app.config['TEX_PRECOMPILE_PREAMBLE']:
+    FORMATS = FormatCache(path.join(app.config['STORAGE_DIR'], 'formats'))
+else:
+    FORMATS = None
+
+# xelatex is run by warm, long-lived workers
+TEX_POOL = TexWorkerPool(TEX.tex_engine,
+                         path.join(app.config['STORAGE_DIR'], 'scratch'),
+                         workers=app.config['TEX_WORKERS'],
+                         timeout=app.config['TEX_TIMEOUT'],
+                         max_jobs=app.config['TEX_RECYCLE_AFTER'])
+
+# Documents for many companies are compiled in parallel
+COMPILER = ParallelCompiler(TEX,
+                            workers=app.config['TEX_WORKERS'],
+                            chunk_size=app.config['TEX_CHUNK_SIZE'],
+                            cache=PDF_CACHE,
+                            formats=FORMATS,
+                            tex_pool=TEX_POOL)
+# Background work compiles one chunk at a time, and does not queue its chunks
+# in the pool for requests
+BACKGROUND_COMPILER = ParallelCompiler(
+    TEX, workers=1, chunk_size=app.config['TEX_CHUNK_SIZE'],
+    cache=PDF_CACHE, formats=FORMATS, tex_pool=TEX_POOL)
+
+# Bulk documents can be generated in the background, jobs are created again
+# if their pdf has been evicted from the cache
+JOBS = JobQueue(workers=app.config['JOB_WORKERS'],
+                retention=app.config['JOB_RETENTION'],
+                available=lambda key: key in PDF_CACHE)
+
+# Compilations requested by users are limited and shared by identical
+# requests
+SCHEDULER = CompileScheduler(concurrency=app.config['COMPILE_CONCURRENCY'],
+                             queue_size=app.config['COMPILE_QUEUE_SIZE'],
+                             retry_after=app.config['COMPILE_RETRY_AFTER'])
+
+# Contracts are compiled in the background after companies are loaded, but
+# only while no compilations for requests are waiting. They run in the
+# scheduler with the lowest priority, and requests for the same document
+# share them.
+PREGENERATOR = Pregenerator(
+    workers=app.config['PREGENERATE_WORKERS'],
+    busy=lambda: (SCHEDULER.waiting > 0 or
+                  TEX_POOL.stats()['queued'] > 0))
 
 
 # Get Auth
 app.register_blueprint(api_auth)
 
 
-def send(data):
-    """Send data as file with headers to disable caching.
+@app.errorhandler(Overloaded)
+def overloaded(error):
+    """Ask clients to retry later if too many compilations are queued."""
+    response = Response("Too many documents are being created right now, "
+                        "please try again in a moment.\n", status=503,
+                        mimetype='text/plain')
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
+@app.after_request
+def add_timing_header(response):
+    """Send the time spent in each stage, if enabled.
 
-    We want the preview to be refreshed, so need to avoid browser caching.
+    The `Server-Timing` header is shown by the developer tools of browsers.
     """
-    try:
-        filename = '%s.pdf' % g.get('company', 'contracts')
-        response = make_response(send_file(BytesIO(data),
-                                           mimetype='application/pdf',
-                                           attachment_filename=filename,
-                                           as_attachment=True,
-                                           cache_timeout=0))
-        response.headers['Content-Length'] = len(data)
-    except TypeError:
-        filename = '%s.tex' % g.get('company', 'source')
-        response = make_response(send_file(BytesIO(data.encode()),
-                                           mimetype='text/plain',
-                                           attachment_filename=filename,
-                                           as_attachment=True,
-                                           cache_timeout=0))
-        response.headers['Content-Length'] = len(data.encode())
+    if app.config['METRICS_TIMING_HEADER']:
+        timings = METRICS.breakdown()
+        if timings:
+            response.headers['Server-Timing'] = ', '.join(
+                '%s;dur=%.1f' % (stage, seconds * 1000)
+                for (stage, seconds) in timings)
     return response
 
 
+def send(key, create, inline=False):
+    """Send a compiled document from the pdf cache.
+
+    We want the preview to be refreshed if the document changes, but not to
+    download unchanged documents again. The file is sent from disk, with
+    the hash of its content as ETag, so browsers have to revalidate it.
+
+    Args:
+        key (str): Cache key of the document
+        create (callable): Creates the document again if it has been
+            evicted in the meantime, returns the cache key
+        inline (bool): Show the document in the browser, e.g. previews
+    """
+    with METRICS.timer('send'):
+        try:
+            file = open(PDF_CACHE.path(key), 'rb')
+        except FileNotFoundError:
+            key = create()
+            file = open(PDF_CACHE.path(key), 'rb')
+
+        try:
+            if file.read(4) == b'\x89PNG':
+                filename = 'preview.png'
+                mimetype = 'image/png'
+            else:
+                filename = '%s.pdf' % g.get('company', 'contracts')
+                mimetype = 'application/pdf'
+
+            return file_response(file, file_digest(file), mimetype,
+                                 filename=filename, inline=inline)
+        except BaseException:
+            # Closed by the response otherwise
+            file.close()
+            raise
+
+
+def send_source(source):
+    """Send tex source as file, with its hash as ETag."""
+    with METRICS.timer('send'):
+        data = source.encode()
+        return file_response(BytesIO(data), sha256(data).hexdigest(),
+                             'text/plain',
+                             filename='%s.tex' % g.get('company', 'source'))
+
+
+def stream_template(name, **context):
+    """Like `render_template`, but send parts as soon as they are rendered.
+
+    Iterables in the context (e.g. companies) are only consumed while
+    sending, so the beginning of the page does not wait for them.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(name).stream(context)
+    # Send a few rows at once instead of every single piece
+    stream.enable_buffering(50)
+    return Response(stream_with_context(stream))
+
+
+def _stream_crm(errors):
+    """Yield companies directly from the CRM, and add errors to the dict.
+
+    Once all companies have been read, they are stored and used to seed
+    COMPANIES, so the CRM is not imported a second time.
+    """
+    data = []
+    for (company, parsed, error) in CRM.iter_companies(record=True):
+        if error is None:
+            data.append(parsed)
+            yield parsed
+        else:
+            errors[company['name']] = error
+
+    STORE.save(data, errors)
+    if not COMPANIES.loaded:
+        COMPANIES.seed((data, errors), stale=False)
+
+
+def select_companies(lazy=False):
+    """Return (data, errors, filters) for the current request.
+
+    Companies can be filtered with query arguments, e.g. `?size=big`, see
+    `CompanyStore.query` for all filters.
+
+    With lazy, data is an iterator only read when the companies are needed.
+    If no companies have been imported yet, they are streamed from the CRM
+    while the snapshot is loaded in the background, and errors are only
+    complete after data has been read.
+    """
+    filters = {name: request.args[name] for name in FILTER_NAMES
+               if request.args.get(name)}
+
+    if lazy and not filters and not COMPANIES.loaded:
+        errors = {}
+        return (_stream_crm(errors), errors, filters)
+
+    (data, errors) = COMPANIES.get()
+    if filters:
+        try:
+            with METRICS.timer('query'):
+                if lazy:
+                    data = STORE.iter_query(**filters)
+                else:
+                    data = STORE.query(**filters)
+        except ValueError:
+            abort(400)
+    return (data, errors, filters)
+
+
 # Routes
 
 @app.route('/', methods=['GET', 'POST'])
@@ -82,24 +267,43 @@ def send(data):
 def main():
     """Main view.
 
-    Includes output format and yearly settings.
+    Includes output format and yearly settings. The page is streamed, so
+    it is shown while the companies are still being sent.
     """
-    (data, errors) = CRM.get_companies()
+    (data, errors, filters) = select_companies(lazy=True)
 
-    return render_template('main.html',
+    return stream_template('main.html',
                            user=g.get('username', ''),
                            yearly=app.config['YEARLY_SETTINGS'],
                            companies=data,
-                           errors=errors)
+                           errors=errors,
+                           filters=filters,
+                           updated=COMPANIES.timestamp)
+
+
+@app.route('/refresh', methods=['POST'])
+@protected
+def refresh():
+    """Reload company data from the CRM now.
+
+    All companies are listed, but only new and modified ones are imported.
+    """
+    COMPANIES.refresh()
+    return redirect(url_for('main'))
+
+
+def letter_options():
+    """Return the fields of the custom letter from the form."""
+    fields = ['destination_address', 'subject', 'opening', 'body', 'closing',
+              'signature', 'attachments']
+    return {field: request.form.get(field, '') for field in fields}
 
 
 @app.route('/custom/', methods=['GET', 'POST'])
 @protected
 def custom():
     """View to show and create customizable letter."""
-    fields = ['destination_address', 'subject', 'opening', 'body', 'closing',
-              'signature', 'attachments']
-    options = {field: request.form.get(field, '') for field in fields}
+    options = letter_options()
 
     # Fields must not be empty
     empty_ok = ['attachments']
@@ -108,12 +312,134 @@ def custom():
               for field, value in options.items()}
 
     if request.method == 'POST' and not any(errors.values()):
-        return send(TEX.compile_template('custom_letter.tex', **options))
+        name = 'custom_letter.tex'
+        source = COMPILER.render(name, **options)
+        key = COMPILER.key(name, source)
+
+        def _compile():
+            return SCHEDULER.run(
+                key, lambda: COMPILER.compile(name, source, stored=True),
+                priority=PREVIEW)
+
+        with METRICS.timer('pdf'):
+            document = _compile()
+        return send(document, _compile)
 
     return render_template('custom.html',
                            user=g.username,
                            values=options,
-                           errors=errors)
+                           errors=errors,
+                           preview_delay=int(
+                               app.config['PREVIEW_DEBOUNCE'] * 1000))
+
+
+@app.route('/custom/preview', methods=['POST'])
+@protected
+def custom_preview():
+    """Send a quick image of the first page of the custom letter.
+
+    Empty fields are allowed. The page updates the preview once the letter
+    has not been edited for `PREVIEW_DEBOUNCE` seconds, so previews are
+    not requested for every key stroke. The full pdf is created by
+    `custom`.
+    """
+    g.company = 'preview'  # Filename without pdftoppm
+    options = letter_options()
+    name = 'custom_letter.tex'
+    resolution = app.config['PREVIEW_RESOLUTION']
+    key = COMPILER.preview_key(name, resolution, **options)
+
+    METRICS.count('contractor_previews_total', result=(
+        'created' if key not in PDF_CACHE else 'cached'))
+
+    def _preview():
+        return SCHEDULER.run(key, lambda: COMPILER.preview(
+            name, resolution, stored=True, **options), priority=PREVIEW)
+
+    return send(_preview(), _preview, inline=True)
+
+
+def contract_options(output_format, selection):
+    """Return the template variables for contracts of the selection."""
+    return batch.contract_options(output_format, selection,
+                                  app.config['YEARLY_SETTINGS'])
+
+
+def contracts_key(output_format, selection, filters=None):
+    """Return a key for the contracts, equal for identical requests.
+
+    Contracts of all (filtered) companies are identified by the company
+    data generation, contracts of single companies by their data.
+    """
+    if filters is None:
+        return "%s:company:%s" % (output_format,
+                                  sorted(dict(selection[0]).items()))
+    return "%s:%s:%s" % (output_format, COMPANIES.generation,
+                         sorted(filters.items()))
+
+
+def compile_contracts(letterdata, progress=None, compiler=COMPILER,
+                      **options):
+    """Compile the contracts of all companies into a single pdf.
+
+    Returns:
+        str: The key of the pdf in `PDF_CACHE`
+    """
+    if app.config['TEX_INCREMENTAL_BULK']:
+        compile_pdf = compiler.compile_bulk
+    else:
+        compile_pdf = compiler.compile_template
+    return compile_pdf('contract.tex', letterdata, progress=progress,
+                       stored=True, **options)
+
+
+def pregenerate_contracts(previous, companies):
+    """Compile contracts in the background after companies are loaded.
+
+    Contracts of single companies are only compiled for new or changed
+    companies, the contracts for all companies if anything has changed.
+    Output formats are set in `PREGENERATE`. Tasks for older company data
+    are cancelled.
+
+    The contracts are compiled in the scheduler with background priority,
+    with the same keys as requests (see `contracts_key`).
+    """
+    data = companies[0]
+    before = {item['id']: item for item in (previous or ([], {}))[0]}
+    changed = [item for item in data if before.get(item['id']) != item]
+    if not changed and list(before) == [item['id'] for item in data]:
+        return
+
+    def _compile(output_format, selection, filters=None):
+        options = contract_options(output_format, selection)
+        key = contracts_key(output_format, selection, filters)
+
+        def _task(check):
+            return SCHEDULER.run(key, lambda: compile_contracts(
+                progress=check, compiler=BACKGROUND_COMPILER, **options),
+                priority=BACKGROUND, reject=False)
+        return _task
+
+    formats = app.config['PREGENERATE']
+    singles = [_compile(output_format, [item])
+               for (output_format, outputs) in sorted(formats.items())
+               if 'single' in outputs
+               for item in changed]
+    # Same key as requests without filters
+    bulk = [_compile(output_format, data, filters={})
+            for (output_format, outputs) in sorted(formats.items())
+            if 'bulk' in outputs and data]
+    PREGENERATOR.schedule([singles, bulk])
+
+
+# Start loading companies only now, everything to handle them is ready
+if app.config['PREGENERATE']:
+    COMPANIES.subscribe(pregenerate_contracts)
+if STORE.saved_at is not None:
+    # Serve stored companies until the CRM has been contacted
+    COMPANIES.seed(STORE.load(), STORE.saved_at)
+if app.config['CRM_REFRESH_INTERVAL']:
+    COMPANIES.start(app.config['CRM_REFRESH_INTERVAL'])
 
 
 @app.route('/contracts/<output_format>')
@@ -122,34 +448,166 @@ def custom():
 def send_contracts(output_format, company_id=None):
     """Contract creation."""
     if company_id is None:
-        selection = CRM.get_companies()[0]  # select data of (data, errors)
+        (selection, _, filters) = select_companies()
     else:
         selection = [CRM.get_company(company_id)]
         g.company = secure_filename(selection[0]['companyname'])
+        filters = None
+
+    options = contract_options(output_format, selection)
 
-    # Check if output format is email -> only single contract
-    contract_only = (output_format == "email")
+    if (output_format == "tex"):
+        return send_source(COMPILER.render('contract.tex', **options))
+    else:
+        # Previews of single companies go first
+        priority = BULK if company_id is None else PREVIEW
 
-    # Get yearly settings
-    yearly = app.config['YEARLY_SETTINGS']
-    letter_only = (output_format == "letter")
+        def _compile():
+            return SCHEDULER.run(
+                contracts_key(output_format, selection, filters),
+                lambda: compile_contracts(**options), priority=priority)
 
-    options = dict(
-        # Data
-        letterdata=selection,
+        with METRICS.timer('pdf'):
+            document = _compile()
+        return send(document, _compile)
 
-        # Yearly settings
-        fairtitle=yearly['fairtitle'],
-        president=yearly['president'],
-        sender=yearly['sender'],
-        days=yearly['days'],
-        prices=yearly['prices'],
 
-        # Output options
-        contract_only=contract_only,
-        letter_only=letter_only
-    )
-    if (output_format == "tex"):
-        return send(TEX.render_template('contract.tex', **options))
+@app.route('/archive/<output_format>')
+@protected
+def send_archive(output_format):
+    """Send a zip archive with a separate file for every company.
+
+    The archive is streamed, every file is sent as soon as it is ready.
+    """
+    selection = select_companies()[0]
+    options = contract_options(output_format, selection)
+    del options['letterdata']
+
+    if output_format == "tex":
+        extension = 'tex'
+        documents = (COMPILER.render('contract.tex', letterdata=[data],
+                                     **options).encode()
+                     for data in selection)
     else:
-        return send(TEX.compile_template('contract.tex', **options))
+        extension = 'pdf'
+
+        def _schedule(part, compile_part, reject=False):
+            key = "archive:%s:%s" % (output_format, [
+                sorted(dict(data).items()) for data in part])
+            return SCHEDULER.run(key, compile_part, priority=BULK,
+                                 reject=reject)
+
+        # The first chunk is compiled before the response starts, so an
+        # overloaded server answers with 503 instead of a broken archive.
+        # Later chunks wait in the queue.
+        first = selection[:COMPILER.chunk_size]
+        rest = selection[COMPILER.chunk_size:]
+        with METRICS.timer('pdf'):
+            first_pdfs = _schedule(first, lambda: COMPILER.compile_split(
+                'contract.tex', first, **options), reject=True)
+        documents = chain(first_pdfs, (
+            pdf for (_, pdf) in COMPILER.compile_each(
+                'contract.tex', rest, schedule=_schedule, **options)))
+
+    filenames = unique_filenames(
+        '%s.%s' % (secure_filename(data['companyname']), extension)
+        for data in selection)
+
+    response = Response(stream_zip(zip(filenames, documents)),
+                        mimetype='application/zip')
+    response.headers['Content-Disposition'] = (
+        'attachment; filename=contracts_%s.zip' % output_format)
+    return response
+
+
+@app.route('/jobs/start/<output_format>', methods=['GET', 'POST'])
+@protected
+def start_job(output_format):
+    """Start creating contracts for all companies in the background.
+
+    Identical requests (same format and company data) share a job.
+    """
+    if output_format == "tex":
+        # Rendering is fast, no job needed
+        return redirect(url_for('send_contracts', output_format='tex',
+                                **request.args))
+
+    (selection, _, filters) = select_companies()
+    options = contract_options(output_format, selection)
+
+    key = contracts_key(output_format, selection, filters)
+
+    def _create(progress):
+        # Jobs are already queued, they wait for a slot instead of failing
+        return SCHEDULER.run(
+            key, lambda: compile_contracts(progress=progress, **options),
+            reject=False)
+
+    job = JOBS.submit(key, len(selection), _create)
+    return redirect(url_for('show_job', job_id=job.id))
+
+
+def _get_job(job_id):
+    job = JOBS.get(job_id)
+    if job is None:
+        abort(404)
+    return job
+
+
+@app.route('/jobs/<job_id>')
+@protected
+def show_job(job_id):
+    """Show job progress, updated by polling the status."""
+    return render_template('job.html',
+                           user=g.get('username', ''),
+                           job=_get_job(job_id))
+
+
+@app.route('/jobs/<job_id>/status')
+@protected
+def job_status(job_id):
+    """Return job progress as json."""
+    return jsonify(_get_job(job_id).as_dict())
+
+
+@app.route('/jobs/<job_id>/download')
+@protected
+def download_job(job_id):
+    """Send the result of a finished job."""
+    job = _get_job(job_id)
+    if job.status != 'done':
+        abort(404)
+    return send(job.result, lambda: abort(404))
+
+
+@app.route('/metrics')
+def metrics():
+    """Export metrics for Prometheus.
+
+    Not protected, scrapers can not log in. No company data is included.
+    """
+    (data, errors) = COMPANIES.get() if COMPANIES.loaded else ([], {})
+    METRICS.set('contractor_companies', len(data), state='imported')
+    METRICS.set('contractor_companies', len(errors), state='failed')
+    if COMPANIES.age is not None:
+        METRICS.set('contractor_companies_age_seconds', COMPANIES.age)
+
+    sessions = app.extensions['api_auth']['sessions']
+    caches = [('pdf', PDF_CACHE), ('sessions', sessions),
+              ('fragments', FRAGMENTS)]
+    for (name, cache) in caches:
+        METRICS.set('contractor_cache_hits_total', cache.hits, cache=name)
+        METRICS.set('contractor_cache_misses_total', cache.misses,
+                    cache=name)
+    METRICS.set('contractor_storage_bytes', PDF_CACHE.size)
+
+    pool = TEX_POOL.stats()
+    METRICS.set('contractor_tex_workers', pool['busy'], state='busy')
+    METRICS.set('contractor_tex_workers', pool['alive'] - pool['busy'],
+                state='idle')
+    METRICS.set('contractor_tex_queued', pool['queued'])
+    METRICS.set('contractor_compiles', SCHEDULER.running, state='running')
+    METRICS.set('contractor_compiles', SCHEDULER.waiting, state='queued')
+
+    return Response(METRICS.render(),
+                    mimetype='text/plain; version=0.0.4')
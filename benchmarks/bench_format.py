@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark compiling with a precompiled preamble format.
+
+Single documents (contract, custom letter, invitation) are compiled
+repeatedly, with and without a format, and the average time per compilation
+is printed.
+
+Requires xelatex with amivtex and mylatexformat. Run from the repository
+root:
+
+```
+python benchmarks/bench_format.py --runs 5
+```
+"""
+
+import argparse
+import sys
+from os import path
+from shutil import which
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from contractor.formats import FormatCache  # noqa: E402
+from contractor.settings import YEARLY_SETTINGS  # noqa: E402
+from contractor.tex import amivtex_version, compile_tex  # noqa: E402
+from contractor.tex import create_environment  # noqa: E402
+from contractor.tests.fakes import FakeImporter, make_account  # noqa: E402
+
+
+def sources(tex):
+    """Return rendered example documents by template name."""
+    letterdata = FakeImporter([make_account(0)]).get_companies()[0]
+    contract = dict(
+        letterdata=letterdata,
+        fairtitle=YEARLY_SETTINGS['fairtitle'],
+        president=YEARLY_SETTINGS['president'],
+        sender=YEARLY_SETTINGS['sender'],
+        days=YEARLY_SETTINGS['days'],
+        prices=YEARLY_SETTINGS['prices'],
+        contract_only=False,
+        letter_only=False,
+    )
+    letter = dict(destination_address="Company\nStreet\n1234 City",
+                  subject="Benchmark", opening="Dear Sir or Madam,",
+                  body="Some text.", closing="Sincerely,",
+                  signature="Me", attachments="")
+
+    return {
+        'contract.tex': tex.render_template('contract.tex', **contract),
+        'custom_letter.tex': tex.render_template('custom_letter.tex',
+                                                 **letter),
+        'invitation.tex': tex.render_template('invitation.tex',
+                                              **contract),
+    }
+
+
+def timed(function, runs):
+    """Return the average seconds per call of function."""
+    start = perf_counter()
+    for _ in range(runs):
+        function()
+    return (perf_counter() - start) / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help="compilations per document and mode")
+    args = parser.parse_args()
+
+    tex = create_environment()
+    engine = tex.tex_engine
+    if which(engine) is None:
+        sys.exit("The tex engine '%s' is not installed." % engine)
+
+    with TemporaryDirectory() as directory:
+        formats = FormatCache(directory)
+
+        print("%-20s %10s %10s %10s %8s" % (
+            'template', 'build (s)', 'plain (s)', 'format (s)', 'saved'))
+        for (name, source) in sorted(sources(tex).items()):
+            start = perf_counter()
+            fmt = formats.get(source, engine, amivtex_version())
+            build = perf_counter() - start
+
+            plain = timed(lambda: compile_tex(source, engine), args.runs)
+            if fmt is None:
+                print("%-20s %10s %10.3f %10s %8s" % (
+                    name, 'failed', plain, '-', '-'))
+                continue
+
+            fast = timed(lambda: compile_tex(source, engine, fmt=fmt),
+                         args.runs)
+            print("%-20s %10.3f %10.3f %10.3f %7.0f%%" % (
+                name, build, plain, fast, 100 * (plain - fast) / plain))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark parsing CRM accounts into letterdata.
+
+Synthetic accounts are parsed in a single batch, and the time per account
+and the memory of the parsed records (compared to plain dicts with the same
+fields) are printed. No CRM connection is needed. Run from the repository
+root:
+
+```
+python benchmarks/bench_parse.py --accounts 5000 --runs 10
+```
+"""
+
+import argparse
+import sys
+import tracemalloc
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from contractor.letterdata import LetterData  # noqa: E402
+from contractor.soapclient import parse_accounts  # noqa: E402
+from contractor.tests.fakes import make_account  # noqa: E402
+
+
+def measure_memory(create):
+    """Return the result of create and the bytes allocated by it."""
+    tracemalloc.start()
+    try:
+        result = create()
+        return (result, tracemalloc.get_traced_memory()[0])
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--accounts', type=int, default=5000,
+                        help="number of synthetic accounts")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="number of batches to parse")
+    args = parser.parse_args()
+
+    accounts = [make_account(index) for index in range(args.accounts)]
+    # Some broken accounts to include error handling
+    for account in accounts[::100]:
+        account['tischgroesse_c'] = 'drei'
+
+    start = perf_counter()
+    for _ in range(args.runs):
+        results = parse_accounts(accounts)
+    elapsed = (perf_counter() - start) / args.runs
+
+    # Compare the containers only, the values are shared
+    fields = [data.as_dict() for (_, data, _) in results if data is not None]
+    (_, records) = measure_memory(
+        lambda: [LetterData(**values) for values in fields])
+    (_, dicts) = measure_memory(lambda: [dict(values) for values in fields])
+
+    print("accounts:        %i (%i errors)"
+          % (len(accounts), len(accounts) - len(fields)))
+    print("per batch:       %.1f ms" % (elapsed * 1000))
+    print("per account:     %.2f us" % (elapsed / len(accounts) * 1e6))
+    print("memory records:  %.0f bytes per account"
+          % (records / len(fields)))
+    print("memory dicts:    %.0f bytes per account"
+          % (dicts / len(fields)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+
+"""Offline benchmark suite for the whole app.
+
+The CRM is replaced by `FakeSOAPClient` with synthetic accounts and amivapi
+by the local `FakeAMIVAPI`, so no network connection or credentials are
+needed. With `--crm-latency`, every CRM request (and connecting) takes
+longer, like a remote CRM.
+If xelatex is not installed (or with `--fake-tex`), a fake `xelatex` writing
+blank pages is used, which still measures everything around the tex engine.
+
+For every number of companies (`--scales`), the following cases are timed:
+
+- `parse`: Import and parse all accounts from the CRM
+- `render`: Render the contract template for all companies
+- `compile`: Compile the contract of one company, without caches
+- `single`: Request the contract of one company from the app
+- `bulk`: Request the contracts of all companies, with an empty cache
+- `bulk_cached`: The same request again, served from the cache
+- `archive`: Request a zip archive with one pdf per company
+- `startup`: Import the app in a new process, with stored companies
+- `first_page`: Request the companies page right after startup
+
+Results are written as json, and can be compared to earlier results:
+
+```
+python benchmarks/suite.py --scales 10,100,1000 --output baseline.json
+# ... change something ...
+python benchmarks/suite.py --scales 10,100,1000 --output new.json \\
+    --compare baseline.json --threshold 0.2
+```
+
+Comparing prints the change of the median of every case and exits with
+status 1 if any case is slower than the threshold allows. With `--results`,
+existing results are compared instead of running the suite.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime as dt
+from os import path
+from shutil import which
+from statistics import mean, median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from unittest.mock import patch
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from contractor.soapclient import Importer  # noqa: E402
+from contractor.tests.fakes import (FakeAMIVAPI,  # noqa: E402
+                                    FakeImporter, FakeSOAPClient,
+                                    install_fake_tex, make_account)
+
+CASES = ['parse', 'render', 'compile', 'single', 'bulk', 'bulk_cached',
+         'archive']
+# Measured in a new process
+STARTUP_CASES = ['startup', 'first_page']
+
+CONFIG = """
+SOAP_USERNAME = 'benchmark'
+SOAP_PASSWORD = 'benchmark'
+STORAGE_DIR = %r
+LOCALE = %r
+CRM_REFRESH_INTERVAL = None
+# Measure compilations for requests only
+PREGENERATE = {}
+"""
+
+
+def load_app(directory, locale, accounts=(), latency=0):
+    """Import the app with fake CRM.
+
+    Returns:
+        tuple: (app module, login token, seconds to import the app)
+    """
+    config = path.join(directory, 'config.py')
+    with open(config, 'w') as file:
+        file.write(CONFIG % (path.join(directory, 'storage'), locale))
+    os.environ['CONTRACTOR_CONFIG'] = config
+
+    # Replace the SOAP connection for the rest of the run
+    patch.object(Importer, '_connect',
+                 lambda self: FakeSOAPClient(accounts, latency)).start()
+
+    start = perf_counter()
+    app = importlib.import_module('app')
+    startup = perf_counter() - start
+
+    api = FakeAMIVAPI().start()
+    app.app.config['AMIVAPI_URL'] = api.url
+    return (app, api.login('Benchmark'), startup)
+
+
+def measure_startup(directory, locale, scale, latency):
+    """Print the seconds to import the app and send the first page.
+
+    Called in a new process, after the companies have been stored.
+    """
+    accounts = [make_account(index) for index in range(scale)]
+    (app, token, startup) = load_app(directory, locale, accounts, latency)
+
+    client = app.app.test_client(use_cookies=False)
+    start = perf_counter()
+    response = client.get('/', headers={
+        'Cookie': 'amivapi_token=%s' % token})
+    response.get_data()
+    first_page = perf_counter() - start
+
+    app.TEX_POOL.close()
+    print(json.dumps({'startup': startup, 'first_page': first_page}))
+
+
+def run_startup(directory, locale, scale, runs, latency):
+    """Time the startup cases, every run in a new process."""
+    times = {name: [] for name in STARTUP_CASES}
+    for _ in range(runs):
+        output = subprocess.check_output([
+            sys.executable, path.abspath(__file__),
+            '--startup', directory, '--locale', locale,
+            '--scales', str(scale), '--crm-latency', str(latency)])
+        for (name, seconds) in json.loads(
+                output.decode().splitlines()[-1]).items():
+            times[name].append(seconds)
+    return times
+
+
+def timed(function, runs, setup=None):
+    """Return the seconds of every call of function."""
+    times = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        function()
+        times.append(perf_counter() - start)
+    return times
+
+
+def summarize(name, scale, times):
+    """Return the statistics of times and print them."""
+    result = {
+        'median': median(times),
+        'mean': mean(times),
+        'min': min(times),
+        'runs': times,
+    }
+    print("%-12s %6i companies  median %9.4f s  min %9.4f s"
+          % (name, scale, result['median'], result['min']))
+    return result
+
+
+def run_cases(app, token, scale, runs):
+    """Time all cases for a number of companies."""
+    accounts = [make_account(index) for index in range(scale)]
+    client = app.app.test_client(use_cookies=False)
+    headers = {'Cookie': 'amivapi_token=%s' % token}
+
+    def get(url):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, (url, response.status_code)
+        return response.get_data()
+
+    # Load the companies into the app
+    app.CRM.client.accounts = {account['id']: account
+                               for account in accounts}
+    app.CRM.request_full_sync()
+    app.COMPANIES.refresh()
+
+    selection = app.COMPANIES.get()[0]
+    options = app.contract_options('mail', selection)
+    single = app.contract_options('mail', selection[:1])
+    source = app.COMPILER.render('contract.tex', **single)
+
+    clear = app.PDF_CACHE.clear
+    crm = FakeImporter(accounts)
+
+    cases = {
+        'parse': (lambda: crm.get_companies(), None),
+        'render': (lambda: app.COMPILER.render('contract.tex', **options),
+                   None),
+        'compile': (lambda: app.COMPILER._compile(source), None),
+        'single': (lambda: get('/contracts/pdf/%s' % selection[0]['id']),
+                   clear),
+        'bulk': (lambda: get('/contracts/pdf'), clear),
+        'bulk_cached': (lambda: get('/contracts/pdf'), None),
+        'archive': (lambda: get('/archive/pdf'), clear),
+    }
+
+    results = {}
+    for name in CASES:
+        (function, setup) = cases[name]
+        results[name] = summarize(name, scale, timed(function, runs, setup))
+    return results
+
+
+def run(scales, runs, fake_tex, locale, latency):
+    """Run all cases for all scales and return the results."""
+    with TemporaryDirectory(prefix='contractor-benchmark') as directory:
+        if fake_tex:
+            install_fake_tex(directory)
+            os.environ['PATH'] = directory + os.pathsep + os.environ['PATH']
+
+        (app, token, _) = load_app(directory, locale, latency=latency)
+        try:
+            results = {name: {} for name in CASES + STARTUP_CASES}
+            for scale in scales:
+                for (name, result) in run_cases(app, token, scale,
+                                                runs).items():
+                    results[name][str(scale)] = result
+                # The companies of this scale are stored now
+                startup = run_startup(directory, locale, scale, runs,
+                                      latency)
+                for name in STARTUP_CASES:
+                    results[name][str(scale)] = summarize(
+                        name, scale, startup[name])
+        finally:
+            app.TEX_POOL.close()
+
+    return {
+        'meta': {
+            'date': dt.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'tex': 'fake' if fake_tex else 'xelatex',
+            'crm_latency': latency,
+            'runs': runs,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every case, return the list of regressions."""
+    if results['meta']['tex'] != baseline['meta']['tex']:
+        print("Warning: comparing results of different tex engines.")
+
+    regressions = []
+    print("%-12s %8s %12s %12s %8s" % ('case', 'scale', 'baseline (s)',
+                                       'current (s)', 'change'))
+    for (name, scales) in sorted(results['results'].items()):
+        for (scale, result) in sorted(scales.items(),
+                                      key=lambda item: int(item[0])):
+            before = baseline['results'].get(name, {}).get(scale)
+            if before is None:
+                continue
+            change = result['median'] / before['median'] - 1
+            regression = change > threshold
+            if regression:
+                regressions.append((name, scale, change))
+            print("%-12s %8s %12.4f %12.4f %+7.0f%%%s" % (
+                name, scale, before['median'], result['median'],
+                change * 100, '  REGRESSION' if regression else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scales', default='10,100,1000',
+                        help="comma separated numbers of companies")
+    parser.add_argument('--runs', type=int, default=3,
+                        help="runs per case and scale")
+    parser.add_argument('--fake-tex', action='store_true',
+                        help="use a fake xelatex even if it is installed")
+    parser.add_argument('--locale', default='C.UTF-8',
+                        help="locale for the app")
+    parser.add_argument('--crm-latency', type=float, default=0,
+                        help="seconds every request to the fake CRM takes")
+    parser.add_argument('--startup', help=argparse.SUPPRESS)
+    parser.add_argument('--output', help="write results to this json file")
+    parser.add_argument('--results',
+                        help="compare existing results instead of running")
+    parser.add_argument('--compare', help="json file with earlier results")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed relative slowdown of the median")
+    args = parser.parse_args()
+
+    if args.startup:
+        # Internal: measure startup in this new process
+        measure_startup(args.startup, args.locale, int(args.scales),
+                        args.crm_latency)
+        return
+
+    if args.results:
+        with open(args.results) as file:
+            results = json.load(file)
+    else:
+        fake_tex = args.fake_tex or which('xelatex') is None
+        scales = [int(scale) for scale in args.scales.split(',')]
+        results = run(scales, args.runs, fake_tex, args.locale,
+                      args.crm_latency)
+
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,15 @@
 # -*- coding: utf-8 -*-
 
-"""Provide login via amivapi."""
+"""Provide login via amivapi.
+
+Validated sessions are cached by token, so most requests do not need to
+contact amivapi at all. All requests to amivapi share a pooled keep-alive
+connection.
+"""
 
 from functools import wraps
 import requests
+from requests.adapters import HTTPAdapter
 from requests.compat import urljoin
 
 from flask import (Blueprint, redirect, url_for, make_response,
@@ -13,12 +19,33 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField
 from wtforms.validators import DataRequired
 
+from .cache import TTLCache
+from .metrics import METRICS
+
 COOKIE = 'amivapi_token'
 
 api_auth = Blueprint('api_auth', __name__)
 """The blueprint used for the endpoints."""
 
 
+@api_auth.record_once
+def _setup(state):
+    """Create the connection pool and session cache for the app."""
+    config = state.app.config
+
+    connection = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=config['AMIVAPI_POOLSIZE'])
+    connection.mount('http://', adapter)
+    connection.mount('https://', adapter)
+
+    state.app.extensions['api_auth'] = {
+        'connection': connection,
+        'sessions': TTLCache(maxsize=config['AMIVAPI_SESSION_CACHE_SIZE'],
+                             ttl=config['AMIVAPI_SESSION_TTL']),
+    }
+
+
 class LoginForm(FlaskForm):
     """Form for api login data."""
     class Meta:
@@ -55,7 +82,8 @@ def login():
             'password': form.password.data}
 
         try:
-            response = requests.post(_sessions_url(), data=data)
+            response = _connection().post(_sessions_url(), data=data,
+                                          timeout=_timeout())
 
             if response.status_code == 201:
                 # Successful login!
@@ -83,10 +111,11 @@ def logout():
     login_data = _get_session()
     if login_data:
         (_id, _etag, token) = login_data
+        _sessions().pop(token)
         h = {'Authorization': token, 'If-Match': _etag}
         delete_url = "%s/%s" % (_sessions_url(), _id)
         # Don't catch exceptions, let logout fail if something goes wrong
-        requests.delete(delete_url, headers=h)
+        _connection().delete(delete_url, headers=h, timeout=_timeout())
 
     response = make_response(redirect(url_for('.login')))
     response.set_cookie(COOKIE, expires=0)
@@ -109,24 +138,52 @@ def _sessions_url():
     return urljoin(current_app.config['AMIVAPI_URL'], 'sessions')
 
 
+def _connection():
+    """Return the pooled requests session of the app."""
+    return current_app.extensions['api_auth']['connection']
+
+
+def _sessions():
+    """Return the cache of validated sessions of the app."""
+    return current_app.extensions['api_auth']['sessions']
+
+
+def _timeout():
+    return current_app.config['AMIVAPI_TIMEOUT']
+
+
 def _get_session():
     """Return (session id, etag, token) if logged in, None otherwise.
 
     Token will be taken from cookies.
     g.username will be set to full name of user.
+
+    Sessions are only validated with amivapi if they are not cached yet.
     """
-    token = request.cookies.get(COOKIE)
+    with METRICS.timer('auth'):
+        return _validate_session(request.cookies.get(COOKIE))
+
 
+def _validate_session(token):
+    """Validate the token, using the cache, see `_get_session`."""
     if token:
+        cached = _sessions().get(token)
+        if cached is not None:
+            (_id, _etag, g.username) = cached
+            return (_id, _etag, token)
+
         h = {'Authorization': token}
         p = {'where': '{"token": "%s"}' % token, 'embedded': '{"user": 1}'}
 
         try:
-            response = requests.get(_sessions_url(), headers=h, params=p)
+            response = _connection().get(_sessions_url(), headers=h, params=p,
+                                         timeout=_timeout())
             if response.status_code == 200:
                 session = response.json()['_items'][0]
                 user = session['user']
                 g.username = " ".join((user['firstname'], user['lastname']))
+                _sessions().set(token, (session['_id'], session['_etag'],
+                                        g.username))
                 return (session['_id'], session['_etag'], token)
         except (requests.ConnectionError, requests.Timeout):
-            pass
+            METRICS.count('contractor_auth_errors_total')
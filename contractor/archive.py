@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+"""Create zip archives on the fly.
+
+The archive is written to a stream which collects the written bytes. After
+every file, the collected bytes are yielded, so the archive can be sent to
+the client while the next file is created. Only the current file has to be
+kept in memory.
+
+The stream is not seekable, so `zipfile` writes sizes and checksums after
+the data of each file (data descriptors), which is supported by all common
+unzip tools.
+"""
+
+from io import RawIOBase
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+from time import localtime
+
+
+class _Stream(RawIOBase):
+    """Unseekable stream keeping written bytes until they are collected."""
+
+    def __init__(self):
+        super(_Stream, self).__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def collect(self):
+        """Return and forget all bytes written so far."""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def unique_filenames(names):
+    """Append a counter to duplicate names, keeping the extension.
+
+    ```
+    >>> list(unique_filenames(['a.pdf', 'a.pdf', 'b.pdf']))
+    ['a.pdf', 'a_2.pdf', 'b.pdf']
+    ```
+    """
+    seen = {}
+    for name in names:
+        count = seen.get(name, 0) + 1
+        seen[name] = count
+        if count == 1:
+            yield name
+        else:
+            (base, dot, extension) = name.rpartition('.')
+            if not dot:
+                (base, extension) = (extension, '')
+            yield "%s_%s%s%s" % (base, count, dot, extension)
+
+
+def stream_zip(files):
+    """Yield a zip archive in chunks.
+
+    Args:
+        files (iterable): (filename, data) tuples, data as bytes.
+            Can be a generator to create the files one by one.
+
+    Yields:
+        bytes: The next part of the archive
+    """
+    stream = _Stream()
+    with ZipFile(stream, mode='w', compression=ZIP_DEFLATED) as archive:
+        for (filename, data) in files:
+            info = ZipInfo(filename, date_time=localtime()[:6])
+            info.compress_type = ZIP_DEFLATED
+            archive.writestr(info, data)
+            yield stream.collect()
+
+    # Central directory at the end of the archive
+    yield stream.collect()
@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+
+"""Generate contracts for the fair from the command line.
+
+Creating the documents for all companies takes minutes, which is too long
+for a browser request. This command imports the companies, like the app,
+and writes the documents of every output format into a directory:
+
+```
+python -m contractor.batch contracts/
+python -m contractor.batch contracts/ --formats email --filter size=big
+```
+
+For every format, there is a file per company (`<format>/<company>.pdf`)
+and a document with all companies (`contracts_<format>.pdf`). Company
+documents are compiled in parallel chunks, see `ParallelCompiler`.
+
+The settings are loaded like the app, i.e. from `CONTRACTOR_CONFIG` or
+`config.py` in the working directory, and compiled pdfs are shared with
+the app through the cache in `STORAGE_DIR`.
+
+A checkpoint (`checkpoint.json` in the output directory) records the input
+of every finished file. If a run is interrupted, running it again only
+creates missing files and files of changed companies, even without cache.
+
+With `--invitations`, invitations (`invitation.tex`) are created instead: a
+file per recipient (`invitations/<company>.pdf`) and a document to print
+(`invitations.pdf`). Recipients are streamed from the CRM (or the stored
+companies) and compiled in chunks, so memory stays bounded no matter how
+many recipients there are.
+"""
+
+import argparse
+import json
+import sys
+from contextlib import contextmanager
+from itertools import tee
+from locale import setlocale, LC_TIME
+from os import getcwd, getenv, makedirs, path, remove, replace
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from flask import Config
+from werkzeug.utils import secure_filename
+
+from .archive import unique_filenames
+from .cache import TTLCache
+from .database import CompanyStore, FILTER_NAMES
+from .formats import FormatCache
+from .soapclient import Importer
+from .storage import FileCache, make_key
+from .tex import (ParallelCompiler, concat_pdfs, create_environment,
+                  split_pdf)
+
+OUTPUT_FORMATS = ['mail', 'email', 'letter', 'tex']
+CHECKPOINT = 'checkpoint.json'
+
+
+def contract_options(output_format, selection, yearly):
+    """Return the template variables for contracts of the selection.
+
+    Args:
+        output_format (str): 'mail' (cover letter and contract twice),
+            'email' (contract only), 'letter' (cover letter only) or 'tex'
+        selection (list): letterdata of the companies
+        yearly (dict): The `YEARLY_SETTINGS`
+    """
+    # Check if output format is email -> only single contract
+    contract_only = (output_format == "email")
+    letter_only = (output_format == "letter")
+
+    return dict(
+        # Data
+        letterdata=selection,
+
+        # Yearly settings
+        fairtitle=yearly['fairtitle'],
+        president=yearly['president'],
+        sender=yearly['sender'],
+        days=yearly['days'],
+        prices=yearly['prices'],
+
+        # Output options
+        contract_only=contract_only,
+        letter_only=letter_only
+    )
+
+
+def invitation_options(yearly):
+    """Return the template variables for invitations, no recipients."""
+    return dict(
+        fairtitle=yearly['fairtitle'],
+        president=yearly['president'],
+        sender=yearly['sender'],
+    )
+
+
+class BatchGenerator(object):
+    """Write documents for companies into a directory, resumable.
+
+    Args:
+        compiler (ParallelCompiler): Compiles the documents
+        directory (str): Output directory, created if needed
+        yearly (dict): The `YEARLY_SETTINGS`
+        template (str): Name of the contract template
+        checkpoint_every (int): Save the checkpoint after n files
+    """
+
+    def __init__(self, compiler, directory, yearly, template='contract.tex',
+                 checkpoint_every=20):
+        self.compiler = compiler
+        self.directory = directory
+        self.yearly = yearly
+        self.template = template
+        self.checkpoint_every = checkpoint_every
+
+        self.stages = {}  # name: [seconds, items]
+        self.skipped = 0
+        self._unsaved = 0
+        self._checkpoint = path.join(directory, CHECKPOINT)
+        self.files = self._load_checkpoint()  # filename: key of the input
+
+    def _load_checkpoint(self):
+        try:
+            with open(self._checkpoint) as file:
+                return json.load(file)['files']
+        except (OSError, ValueError, KeyError):
+            return {}
+
+    def save_checkpoint(self):
+        """Write the checkpoint, replacing the previous one at once."""
+        makedirs(self.directory, exist_ok=True)
+        temporary = self._checkpoint + '.part'
+        with open(temporary, 'w') as file:
+            json.dump({'files': self.files}, file, indent=1, sort_keys=True)
+        replace(temporary, self._checkpoint)
+        self._unsaved = 0
+
+    @contextmanager
+    def stage(self, name, items):
+        """Time a stage processing a number of items."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += perf_counter() - start
+            totals[1] += items
+
+    def _finished(self, filename, key):
+        """True if the file exists and has been created from the input."""
+        return (self.files.get(filename) == key and
+                path.exists(path.join(self.directory, filename)))
+
+    def _save(self, filename, data):
+        """Write a file, which only appears once it is complete."""
+        target = path.join(self.directory, filename)
+        makedirs(path.dirname(target), exist_ok=True)
+        with open(target + '.part', 'wb') as file:
+            file.write(data)
+        replace(target + '.part', target)
+
+    def _write(self, filename, key, data):
+        """Write a file, and record it once it is complete."""
+        self._save(filename, data)
+        self.files[filename] = key
+        self._unsaved += 1
+        if self._unsaved >= self.checkpoint_every:
+            self.save_checkpoint()
+
+    def generate(self, selection, output_formats=OUTPUT_FORMATS):
+        """Create all files for the companies and formats.
+
+        The checkpoint is saved even if generating fails or is interrupted.
+        """
+        try:
+            for output_format in output_formats:
+                self._generate(output_format, selection)
+        finally:
+            self.save_checkpoint()
+
+    def _generate(self, output_format, selection):
+        options = contract_options(output_format, selection, self.yearly)
+        del options['letterdata']
+        extension = 'tex' if output_format == 'tex' else 'pdf'
+
+        with self.stage('render', len(selection)):
+            sources = [self.compiler.render(self.template, letterdata=[data],
+                                            **options)
+                       for data in selection]
+            keys = [self.compiler.key(self.template, source)
+                    for source in sources]
+
+        filenames = [path.join(output_format, name) for name in
+                     unique_filenames('%s.%s' % (
+                         secure_filename(data['companyname']), extension)
+                         for data in selection)]
+        pending = [index for index in range(len(selection))
+                   if not self._finished(filenames[index], keys[index])]
+        self.skipped += len(selection) - len(pending)
+
+        with self.stage('compile', len(pending)):
+            if output_format == 'tex':
+                documents = (sources[index].encode() for index in pending)
+            else:
+                documents = (pdf for (_, pdf) in self.compiler.compile_each(
+                    self.template, [selection[index] for index in pending],
+                    **options))
+            for (index, document) in zip(pending, documents):
+                self._write(filenames[index], keys[index], document)
+
+        # Document for all companies, mostly from cached company documents
+        filename = 'contracts_%s.%s' % (output_format, extension)
+        key = make_key(*keys)
+        if not selection or self._finished(filename, key):
+            return
+        with self.stage('combine', len(selection)):
+            if output_format == 'tex':
+                document = self.compiler.render(
+                    self.template, letterdata=selection, **options).encode()
+            else:
+                document = self.compiler.compile_bulk(
+                    self.template, selection, **options)
+            self._write(filename, key, document)
+
+    def invitations(self, recipients, template='invitation.tex'):
+        """Create an invitation per recipient and a document to print.
+
+        Recipients are read as needed and compiled in chunks, which are
+        split into the files of the recipients. The chunks are kept on disk
+        and combined into the document to print at the end, so only a few
+        chunks are in memory at any time. Invitations are not recorded in
+        the checkpoint.
+
+        Args:
+            recipients (iterable): letterdata, e.g. streamed from the CRM
+            template (str): Name of the invitation template
+
+        Returns:
+            int: Number of recipients
+        """
+        options = invitation_options(self.yearly)
+        (recipients, named) = tee(recipients)
+        filenames = unique_filenames(
+            path.join('invitations', '%s.pdf' % secure_filename(
+                data['companyname'])) for data in named)
+        count = 0
+
+        makedirs(self.directory, exist_ok=True)
+        with TemporaryDirectory(dir=self.directory,
+                                prefix='.invitations') as parts:
+            chunks = []
+            start = perf_counter()
+            for (chunk, pdf) in self.compiler.compile_stream(
+                    template, recipients, **options):
+                chunks.append(path.join(parts, '%06i.pdf' % len(chunks)))
+                with open(chunks[-1], 'wb') as file:
+                    file.write(pdf)
+
+                documents = split_pdf(pdf, len(chunk))
+                if documents is None:
+                    documents = [self.compiler.compile(
+                        template, self.compiler.render(
+                            template, letterdata=[data], **options))
+                        for data in chunk]
+                for document in documents:
+                    self._save(next(filenames), document)
+                count += len(chunk)
+            self.stages['invite'] = [perf_counter() - start, count]
+
+            if not chunks:
+                return 0
+            with self.stage('print', count):
+                target = path.join(self.directory, 'invitations.pdf')
+                with open(target + '.part', 'wb') as file:
+                    concat_pdfs(chunks, file)
+                replace(target + '.part', target)
+                for chunk in chunks:
+                    remove(chunk)
+        return count
+
+    def report(self):
+        """Return the throughput of every stage as lines of text."""
+        lines = ["%-8s %8s %10s %10s" % ('stage', 'items', 'seconds',
+                                         'items/s')]
+        for (name, (seconds, items)) in self.stages.items():
+            lines.append("%-8s %8i %10.2f %10.1f" % (
+                name, items, seconds, items / seconds if seconds else 0))
+        if self.skipped:
+            lines.append("%i files were already finished." % self.skipped)
+        return lines
+
+
+def load_config():
+    """Load the settings like the app does."""
+    config = Config(path.dirname(path.abspath(__file__)))
+    config.from_pyfile('settings.py')
+    config.from_pyfile(getenv("CONTRACTOR_CONFIG",
+                              path.join(getcwd(), 'config.py')))
+    config.setdefault('STORAGE_DIR', path.abspath('./.cache'))
+    config.setdefault('LOCALE', 'de_CH.utf-8')
+    return config
+
+
+def _stream_recipients(crm):
+    """Yield the companies from the CRM page by page, report errors."""
+    for (company, data, error) in crm.iter_companies():
+        if error is None:
+            yield data
+        else:
+            print("Skipped %s: %s" % (company['name'], error),
+                  file=sys.stderr)
+
+
+def _generate(generator, crm, store, stored, filters, output_formats):
+    """Import the companies (unless stored) and generate the contracts."""
+    if not stored:
+        with generator.stage('import', 0):
+            (data, errors) = crm.get_companies()
+            store.save(data, errors)
+        generator.stages['import'][1] = len(data)
+        for (name, error) in sorted(errors.items()):
+            print("Skipped %s: %s" % (name, error), file=sys.stderr)
+
+    selection = store.query(**filters)
+    print("Generating %s for %i companies." % (', '.join(output_formats),
+                                              len(selection)))
+    generator.generate(selection, output_formats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory', help="output directory")
+    parser.add_argument('--formats', default=','.join(OUTPUT_FORMATS),
+                        help="comma separated output formats")
+    parser.add_argument('--filter', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help="only companies matching the filter, one of %s"
+                        % ', '.join(FILTER_NAMES))
+    parser.add_argument('--stored', action='store_true',
+                        help="use the stored companies, skip the CRM")
+    parser.add_argument('--workers', type=int,
+                        help="concurrent tex processes")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="do not use or fill the cache of the app")
+    parser.add_argument('--invitations', action='store_true',
+                        help="create invitations instead of contracts")
+    args = parser.parse_args()
+
+    output_formats = args.formats.split(',')
+    unknown = set(output_formats) - set(OUTPUT_FORMATS)
+    if unknown:
+        parser.error("unknown formats: %s" % ', '.join(sorted(unknown)))
+    filters = dict(item.partition('=')[::2] for item in args.filter)
+    if args.invitations and filters and not args.stored:
+        parser.error("filters for invitations need --stored")
+
+    config = load_config()
+    setlocale(LC_TIME, config['LOCALE'])
+    storage = config['STORAGE_DIR']
+
+    store = CompanyStore(path.join(storage, 'companies.db'))
+    try:
+        # Check the filters before contacting the CRM
+        store.iter_query(**filters)
+    except ValueError as error:
+        parser.error(str(error))
+
+    tex = create_environment(fragment_cache=TTLCache(
+        maxsize=config['TEX_FRAGMENT_CACHE_SIZE'], ttl=float('inf')))
+    cache = None
+    if not args.no_cache:
+        cache = FileCache(path.join(storage, 'pdf'),
+                          max_size=config['STORAGE_MAX_SIZE'])
+    formats = None
+    if config['TEX_PRECOMPILE_PREAMBLE']:
+        formats = FormatCache(path.join(storage, 'formats'))
+    compiler = ParallelCompiler(tex,
+                                workers=args.workers or config['TEX_WORKERS'],
+                                chunk_size=config['TEX_CHUNK_SIZE'],
+                                cache=cache, formats=formats)
+    generator = BatchGenerator(compiler, args.directory,
+                               config['YEARLY_SETTINGS'])
+
+    crm = Importer(config['SOAP_USERNAME'], config['SOAP_PASSWORD'],
+                   retries=config['CRM_RETRIES'],
+                   backoff=config['CRM_BACKOFF'])
+    try:
+        if args.invitations:
+            if args.stored:
+                recipients = store.iter_query(**filters)
+            else:
+                recipients = _stream_recipients(crm)
+            print("Generating invitations.")
+            print("Created %i invitations." % generator.invitations(
+                recipients))
+        else:
+            _generate(generator, crm, store, args.stored, filters,
+                      output_formats)
+    except KeyboardInterrupt:
+        print("Interrupted." if args.invitations else
+              "Interrupted, run again to resume.", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        crm.close()
+        compiler.pool.shutdown()
+        print('\n'.join(generator.report()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+
+"""Provide in-process caches for expensive results, e.g. CRM data.
+
+The `Snapshot` keeps the result of a loader function (like
+`Importer.get_companies`) in memory and shares it between all requests.
+
+Once a value exists, readers never wait for the loader again:
+
+- If the snapshot is older than its ttl, the stale value is returned and
+  a refresh is started in the background (stale-while-revalidate)
+- A refresher thread can be started to reload the value periodically, so
+  readers usually don't even see stale data
+- `refresh()` reloads immediately, e.g. for a "refresh now" button
+
+Only the very first call has to wait for the loader.
+
+Subscribers are notified after every load, e.g. to prepare documents for
+the new data before anyone asks for them.
+
+The `TTLCache` is a small key-value store for many independent entries, e.g.
+validated login sessions. Entries expire after a ttl and the least recently
+used entries are evicted once the cache is full.
+"""
+
+from collections import OrderedDict
+from threading import Event, Lock, RLock, Thread
+from time import monotonic
+from datetime import datetime as dt
+
+
+class Snapshot(object):
+    """Shared, periodically refreshed result of a loader function.
+
+    Args:
+        loader (callable): Function without arguments returning the value
+        ttl (int): Seconds after which the value is considered stale
+    """
+
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+
+        self._value = None
+        self._loaded_at = None  # monotonic time, for ttl
+        self.timestamp = None  # datetime, to display to users
+        self.generation = 0  # Increases with every successful load
+        self.error = None  # Last error of a background refresh
+        self._expired = False  # Set for seeded values
+
+        self._lock = Lock()  # Protects value and timestamps
+        self._loading = Lock()  # Ensures only one load at a time
+        self._stop = Event()
+        self._thread = None
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        """Call callback with the previous and new value after every load.
+
+        Callbacks run in the loading thread and should return quickly.
+        The previous value is None for the first value.
+        """
+        self._subscribers.append(callback)
+
+    def _notify(self, previous, value):
+        for callback in self._subscribers:
+            callback(previous, value)
+
+    @property
+    def loaded(self):
+        """True if a value is available."""
+        return self._loaded_at is not None
+
+    @property
+    def age(self):
+        """Seconds since the last successful load, None if never loaded."""
+        if self._loaded_at is None:
+            return None
+        return monotonic() - self._loaded_at
+
+    @property
+    def stale(self):
+        """True if there is no value or it is older than the ttl."""
+        return (not self.loaded) or self._expired or (self.age > self.ttl)
+
+    def seed(self, value, timestamp=None, stale=True):
+        """Provide an initial value, e.g. from persistent storage.
+
+        The value is served immediately, but considered stale, so the first
+        reader triggers a refresh in the background. Pass `stale=False` if
+        the value has just been read from the source, then it is kept until
+        the ttl has passed.
+        """
+        with self._lock:
+            previous = self._value
+            self._value = value
+            self._loaded_at = monotonic()
+            self._expired = stale
+            if not stale:
+                self.error = None
+            self.timestamp = timestamp or dt.now()
+            self.generation += 1
+        self._notify(previous, value)
+
+    def get(self):
+        """Return the current value.
+
+        Blocks only if no value has been loaded yet. A stale value is
+        returned immediately and refreshed in the background.
+        """
+        with self._lock:
+            value, loaded = self._value, self.loaded
+            generation = self.generation
+
+        if not loaded:
+            return self._load(generation)
+
+        if self.stale:
+            self.refresh_async()
+        return value
+
+    def refresh(self):
+        """Reload the value now and return it.
+
+        Concurrent calls are collapsed: If a load is already running, wait
+        for it and return its result instead of loading again.
+        Exceptions of the loader are raised, the old value is kept.
+        """
+        return self._load(self.generation)
+
+    def _load(self, generation):
+        """Load unless the generation has changed while waiting."""
+        with self._loading:
+            if self.generation != generation:
+                # Someone else loaded while we were waiting
+                return self._value
+
+            value = self.loader()
+
+            with self._lock:
+                previous = self._value
+                self._value = value
+                self._loaded_at = monotonic()
+                self.timestamp = dt.now()
+                self.generation += 1
+                self.error = None
+                self._expired = False
+
+            self._notify(previous, value)
+            return value
+
+    def refresh_async(self):
+        """Start a refresh in the background unless one is running."""
+        if self._loading.locked():
+            return
+        Thread(target=self._refresh_quietly, daemon=True).start()
+
+    def _refresh_quietly(self):
+        """Refresh and store errors instead of raising them."""
+        try:
+            self.refresh()
+        except Exception as error:
+            self.error = error
+
+    def start(self, interval):
+        """Start a thread refreshing the value every `interval` seconds.
+
+        The first load is done by the thread as well, so starting does not
+        block.
+        """
+        if self._thread is not None:
+            return
+
+        def _run():
+            while not self._stop.is_set():
+                self._refresh_quietly()
+                self._stop.wait(interval)
+
+        self._stop.clear()
+        self._thread = Thread(target=_run, name='snapshot-refresher',
+                              daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the refresher thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class TTLCache(object):
+    """Thread-safe mapping with expiring entries and LRU eviction.
+
+    Args:
+        maxsize (int): Maximum number of entries
+        ttl (int): Seconds until an entry expires
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._data = OrderedDict()  # key: (expiry, value), oldest first
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        """Check for an unexpired entry, without counting a hit or miss."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[0] > monotonic()
+
+    def get(self, key, default=None):
+        """Return the value for key, default if missing or expired."""
+        with self._lock:
+            try:
+                (expires, value) = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires <= monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Store value, evicting the least recently used entries if full."""
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove the entry for key and return its value."""
+        with self._lock:
+            try:
+                return self._data.pop(key)[1]
+            except KeyError:
+                return default
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""Store parsed company data locally in SQLite.
+
+The parsed companies (the `LetterData` created by the importer) are
+saved after every import. This has two advantages:
+
+- After a restart, the stored companies can be served immediately, while
+  the CRM is contacted in the background
+- Companies can be filtered by booth, days, packets, country and
+  representative with indexed queries, e.g. to create contracts for all
+  companies with a big booth on both days
+
+Every record is stored as json, along with indexed columns for filtering.
+Enums are stored by name. Companies registered for neither fair day have
+no `days`, which is stored as NULL.
+
+The store only holds a snapshot which is replaced on every save, so if the
+schema changes (see `SCHEMA_VERSION`), older databases are simply cleared.
+"""
+
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime as dt
+from os import makedirs, path
+from threading import Lock
+
+from .choices import BoothChoice, PacketChoice
+from .letterdata import LetterData
+
+PACKETS = ['media', 'business', 'first']
+
+# Increase if SCHEMA changes, older databases are cleared
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS companies (
+    id TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    boothchoice TEXT NOT NULL,
+    size TEXT NOT NULL,
+    days TEXT,
+    media INTEGER NOT NULL,
+    business INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    country TEXT NOT NULL,
+    representative TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS companies_boothchoice ON companies (boothchoice);
+CREATE INDEX IF NOT EXISTS companies_size_days ON companies (size, days);
+CREATE INDEX IF NOT EXISTS companies_days ON companies (days);
+CREATE INDEX IF NOT EXISTS companies_media ON companies (media);
+CREATE INDEX IF NOT EXISTS companies_business ON companies (business);
+CREATE INDEX IF NOT EXISTS companies_first ON companies (first);
+CREATE INDEX IF NOT EXISTS companies_country ON companies (country);
+CREATE INDEX IF NOT EXISTS companies_representative
+    ON companies (representative);
+
+CREATE TABLE IF NOT EXISTS errors (
+    name TEXT PRIMARY KEY,
+    error TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Filters and the sql condition they map to
+FILTERS = {
+    'booth': "boothchoice = ?",
+    'size': "size = ?",
+    'days': "days = ?",
+    'country': "country = ?",
+    'representative': "representative = ?",
+}
+
+# All filters accepted by `CompanyStore.query`
+FILTER_NAMES = ['booth', 'size', 'days', 'packet', 'country',
+                'representative']
+
+
+def _dump(letterdata):
+    """Convert letterdata to json, enums are stored by name."""
+    record = dict(letterdata)
+    record['boothchoice'] = letterdata['boothchoice'].name
+    for packet in PACKETS:
+        record[packet] = letterdata[packet] and letterdata[packet].name
+    return json.dumps(record)
+
+
+def _load(record):
+    """Restore letterdata from json."""
+    fields = json.loads(record)
+    fields['boothchoice'] = BoothChoice[fields['boothchoice']]
+    for packet in PACKETS:
+        if fields[packet] is not None:
+            fields[packet] = PacketChoice[fields[packet]]
+    return LetterData(**fields)
+
+
+class CompanyStore(object):
+    """SQLite database with the imported companies.
+
+    Args:
+        filename (str): Path to the database, created if needed
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = Lock()  # Serialize writes
+
+        makedirs(path.dirname(path.abspath(filename)), exist_ok=True)
+        with closing(self._connect()) as connection:
+            (version,) = connection.execute(
+                "PRAGMA user_version").fetchone()
+            if version < SCHEMA_VERSION:
+                # Only a snapshot, filled again by the next save
+                connection.executescript(
+                    "DROP TABLE IF EXISTS companies;"
+                    "DROP TABLE IF EXISTS errors;"
+                    "DROP TABLE IF EXISTS meta;")
+            connection.executescript(SCHEMA)
+            connection.execute("PRAGMA user_version = %i" % SCHEMA_VERSION)
+
+    def _connect(self):
+        return sqlite3.connect(self.filename)
+
+    @property
+    def saved_at(self):
+        """Time of the last save as datetime, None if nothing is stored."""
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT value FROM meta WHERE key = 'saved_at'").fetchone()
+        return dt.strptime(row[0], '%Y-%m-%dT%H:%M:%S') if row else None
+
+    def save(self, data, errors):
+        """Replace all stored companies and errors."""
+        rows = [(
+            company['id'],
+            position,
+            company['boothchoice'].name,
+            company['boothchoice'].size,
+            company['days'],
+            company['media'] is not None,
+            company['business'] is not None,
+            company['first'] is not None,
+            company['companycountry'],
+            company['amivrepresentative'],
+            _dump(company),
+        ) for (position, company) in enumerate(data)]
+
+        with self._lock, closing(self._connect()) as connection:
+            with connection:  # Transaction
+                connection.execute("DELETE FROM companies")
+                connection.executemany(
+                    "INSERT INTO companies VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("DELETE FROM errors")
+                connection.executemany("INSERT INTO errors VALUES (?, ?)",
+                                       errors.items())
+                connection.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('saved_at', ?)",
+                    (dt.now().strftime('%Y-%m-%dT%H:%M:%S'),))
+
+    def load(self):
+        """Return all stored companies and errors as (data, errors)."""
+        with closing(self._connect()) as connection:
+            errors = dict(connection.execute("SELECT name, error FROM errors"))
+        return (self.query(), errors)
+
+    def query(self, packet=None, **filters):
+        """Return stored companies matching all filters, in import order.
+
+        Args:
+            packet (str): Only companies with this packet, i.e. 'media',
+                'business' or 'first'
+            **filters: Any of 'booth' (the BoothChoice name, e.g. 'bA2'),
+                'size', 'days', 'country' and 'representative'
+
+        Returns:
+            list: letterdata of matching companies
+        """
+        return list(self.iter_query(packet=packet, **filters))
+
+    def iter_query(self, packet=None, **filters):
+        """Same as `query`, but yield the companies one at a time.
+
+        Filters are checked immediately, the database is only read while
+        iterating.
+
+        Returns:
+            iterator: letterdata of matching companies
+        """
+        conditions = []
+        parameters = []
+        for (name, value) in sorted(filters.items()):
+            try:
+                conditions.append(FILTERS[name])
+            except KeyError:
+                raise ValueError("Unknown filter '%s'" % name)
+            parameters.append(value)
+
+        if packet is not None:
+            if packet not in PACKETS:
+                raise ValueError("Unknown packet '%s'" % packet)
+            conditions.append("%s = 1" % packet)
+
+        statement = "SELECT record FROM companies"
+        if conditions:
+            statement += " WHERE " + " AND ".join(conditions)
+        statement += " ORDER BY position"
+
+        def _iterate():
+            with closing(self._connect()) as connection:
+                for (record,) in connection.execute(statement, parameters):
+                    yield _load(record)
+
+        return _iterate()
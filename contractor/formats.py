@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+r"""Precompile the preamble of tex documents into formats.
+
+Most of the time of a single xelatex run is spent loading the amivletter
+class, its packages and fonts. This only depends on the preamble (everything
+before `\begin{document}`), which is the same for every document created
+from a template.
+
+With [mylatexformat](https://ctan.org/pkg/mylatexformat), the preamble can
+be dumped into a format file once. Compiling with this format skips the
+preamble and continues with the document right away.
+
+Formats are stored by a hash of the preamble, the tex engine and the
+amivtex version, so a new format is built automatically if the class or the
+templates change.
+
+Not every preamble can be dumped. If building a format fails, it is not
+tried again and documents are compiled without a format.
+"""
+
+from os import makedirs, path, replace
+from tempfile import TemporaryDirectory
+from threading import Lock
+import subprocess
+
+from .storage import make_key
+
+BEGIN_DOCUMENT = r'\begin{document}'
+
+
+def split_preamble(source):
+    r"""Return the preamble of source, None if there is no document.
+
+    Everything before `\begin{document}` is part of the preamble.
+    """
+    (preamble, found, _) = source.partition(BEGIN_DOCUMENT)
+    return preamble if found else None
+
+
+class FormatCache(object):
+    """Build and store formats for preambles in a directory.
+
+    Args:
+        directory (str): Directory for the format files, created if needed
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._failed = set()  # Names of formats which can not be built
+        self._lock = Lock()  # Only build one format at a time
+
+        makedirs(directory, exist_ok=True)
+
+    def get(self, source, tex_engine='xelatex', version=''):
+        """Return the format for the preamble of source, build if needed.
+
+        Args:
+            source (str): The tex source
+            tex_engine (str): The tex command
+            version (str): Version of the tex installation
+
+        Returns:
+            str: Path of the format without extension, None if there is no
+                format for this source.
+        """
+        preamble = split_preamble(source)
+        if preamble is None:
+            return None
+
+        name = 'preamble-%s' % make_key(tex_engine, version, preamble)[:32]
+        fmt = path.join(self.directory, name)
+
+        if name in self._failed:
+            return None
+        if path.exists(fmt + '.fmt'):
+            return fmt
+
+        with self._lock:
+            if not path.exists(fmt + '.fmt'):
+                try:
+                    self._build(preamble, name, tex_engine)
+                except (OSError, subprocess.CalledProcessError):
+                    self._failed.add(name)
+                    return None
+
+        return fmt
+
+    def discard(self, fmt):
+        """Mark a format as broken, it will not be used again."""
+        self._failed.add(path.basename(fmt))
+
+    def _build(self, preamble, name, tex_engine):
+        """Dump the preamble into the format file `name`.fmt."""
+        # Build in the target directory to allow moving atomically
+        with TemporaryDirectory(dir=self.directory) as tempdir:
+            texfile = path.join(tempdir, name + '.tex')
+            with open(texfile, 'wb') as file:
+                file.write((preamble + BEGIN_DOCUMENT +
+                            '\n\\end{document}\n').encode('utf-8'))
+
+            subprocess.check_output([
+                tex_engine, '-ini',
+                '-interaction=batchmode',
+                '-output-directory', tempdir,
+                '-jobname=%s' % name,
+                '&%s' % tex_engine, 'mylatexformat.ltx', texfile,
+            ], cwd=tempdir)
+
+            replace(path.join(tempdir, name + '.fmt'),
+                    path.join(self.directory, name + '.fmt'))
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Run long tasks (like bulk contract generation) in the background.
+
+A request submits a job and returns immediately. The job runs in a worker
+thread and reports its progress, which can be polled until the result is
+ready for download.
+
+Jobs are identified by a key describing their input. Submitting a job with
+the same key as a queued, running or finished job returns the existing job
+instead of doing the work twice, unless the result of the finished job is
+not available anymore (e.g. evicted from a cache).
+
+Finished jobs are kept for a while, so the result can be downloaded, and
+are removed afterwards.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from uuid import uuid4
+
+
+class Job(object):
+    """A task running in the background.
+
+    Attributes:
+        id (str): Random id to identify the job in urls
+        key (str): Description of the input, used to find identical jobs
+        status (str): One of 'queued', 'running', 'done' and 'failed'
+        done (int): Number of finished items, e.g. companies
+        total (int): Total number of items
+        result: Return value of the task, once it is done
+        error (str): Error message, if the task failed
+    """
+
+    def __init__(self, key, total):
+        self.id = uuid4().hex
+        self.key = key
+        self.status = 'queued'
+        self.done = 0
+        self.total = total
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+        self._lock = Lock()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def advance(self, n=1):
+        """Mark n more items as done."""
+        with self._lock:
+            self.done += n
+
+    def run(self, function):
+        """Call function with the advance method and store the result."""
+        self.status = 'running'
+        try:
+            self.result = function(self.advance)
+        except Exception as error:
+            self.error = str(error)
+            status = 'failed'
+        else:
+            self.done = self.total
+            status = 'done'
+        # Set the time first, finished jobs always need it
+        self.finished_at = monotonic()
+        self.status = status
+
+    def as_dict(self):
+        """Return the job status, e.g. to send it as json."""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'error': self.error,
+        }
+
+
+class JobQueue(object):
+    """Run jobs in worker threads.
+
+    Args:
+        workers (int): Number of jobs running at the same time
+        retention (int): Seconds to keep finished jobs
+        available (callable): Optional, called with the result of a
+            finished job, returns False if the result is gone and the job
+            must not be reused
+    """
+
+    def __init__(self, workers=1, retention=3600, available=None):
+        self.retention = retention
+        self.available = available
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+        self._jobs = {}  # id: job
+        self._lock = Lock()
+
+    def submit(self, key, total, function):
+        """Start a job, or return an existing job with the same key.
+
+        Failed jobs are not reused, so they can be retried. Finished jobs
+        with unavailable results are removed and started again.
+
+        Args:
+            key (str): Description of the input
+            total (int): Number of items to process
+            function (callable): Task to run, is called with a function
+                to report progress, which expects the number of finished
+                items as argument.
+
+        Returns:
+            Job: The new or existing job
+        """
+        with self._lock:
+            self._cleanup()
+
+            for job in list(self._jobs.values()):
+                if job.key != key or job.status == 'failed':
+                    continue
+                if (job.status == 'done' and self.available is not None and
+                        not self.available(job.result)):
+                    del self._jobs[job.id]
+                    continue
+                return job
+
+            job = Job(key, total)
+            self._jobs[job.id] = job
+
+        self.pool.submit(job.run, function)
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given id, None if it does not exist."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _cleanup(self):
+        """Remove finished jobs after the retention time."""
+        now = monotonic()
+        expired = [job_id for (job_id, job) in self._jobs.items()
+                   if job.finished and
+                   (now - job.finished_at) >= self.retention]
+        for job_id in expired:
+            del self._jobs[job_id]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+"""Compact records for the company data used in letters and contracts.
+
+Thousands of companies are kept in memory (the snapshot of the CRM and the
+local copy of the importer), so `LetterData` uses `__slots__` instead of a
+dict per company.
+
+Templates use attribute access (`data.companyname`). For the remaining
+code, records can also be used like a read-only dict (`data['id']`,
+`dict(data)`).
+"""
+
+
+class LetterData(object):
+    """Data of a single company.
+
+    Args:
+        id (str): CRM id of the account
+        companyname (str): Name of the company
+        companyaddress (str): Street
+        companycity (str): Postal code and city
+        companycountry (str): Country, empty for Switzerland
+        companyrepresentative (str): Contact person of the company
+        amivrepresentative (str): Responsible AMIV member
+        boothchoice (BoothChoice): Booth size, category and days
+        days (str): 'first', 'second' or 'both', None if unknown
+        media (PacketChoice): PacketChoice.media or None
+        business (PacketChoice): PacketChoice.business or None
+        first (PacketChoice): PacketChoice.first or None
+    """
+
+    __slots__ = ('id', 'companyname', 'companyaddress', 'companycity',
+                 'companycountry', 'companyrepresentative',
+                 'amivrepresentative', 'boothchoice', 'days',
+                 'media', 'business', 'first')
+
+    def __init__(self, id, companyname, companyaddress, companycity,
+                 companycountry, companyrepresentative, amivrepresentative,
+                 boothchoice, days, media=None, business=None, first=None):
+        self.id = id
+        self.companyname = companyname
+        self.companyaddress = companyaddress
+        self.companycity = companycity
+        self.companycountry = companycountry
+        self.companyrepresentative = companyrepresentative
+        self.amivrepresentative = amivrepresentative
+        self.boothchoice = boothchoice
+        self.days = days
+        self.media = media
+        self.business = business
+        self.first = first
+
+    def keys(self):
+        """Return the field names, like a dict."""
+        return self.__slots__
+
+    def __getitem__(self, key):
+        """Return a field by name, like a dict."""
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def as_dict(self):
+        """Return the fields as a new dict."""
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, LetterData):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key)
+                   for key in self.__slots__)
+
+    def __repr__(self):
+        return '<LetterData %s: %s>' % (self.id, self.companyname)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Collect timings and counts for the stages of a request.
+
+Every stage of the hot path (checking the amivapi session, requests to the
+CRM, parsing accounts, rendering templates, running xelatex and sending
+the file) is timed with `METRICS.timer`. Timings are recorded in a
+histogram per stage, errors and cache hits in counters. Stages can be
+nested, e.g. `pdf` (creating a pdf in the app) includes `render` and
+`xelatex`.
+
+`METRICS.render` returns everything in the Prometheus text format, which is
+exposed at `/metrics` by the app.
+
+Timings of stages running in the thread handling a request are also
+collected per request, to be sent in a `Server-Timing` header:
+
+```
+>>> with METRICS.timer('crm'):
+...     ...
+>>> METRICS.breakdown()
+[('crm', 0.25)]
+```
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+
+from flask import g, has_request_context
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60)
+
+# name: (type, help)
+DESCRIPTIONS = {
+    'contractor_stage_seconds': (
+        'histogram', "Time spent in each stage of handling requests."),
+    'contractor_cache_hits_total': (
+        'counter', "Number of cache hits."),
+    'contractor_cache_misses_total': (
+        'counter', "Number of cache misses."),
+    'contractor_compile_failures_total': (
+        'counter', "Number of failed tex compilations."),
+    'contractor_compiles': (
+        'gauge', "Number of running and queued compilations."),
+    'contractor_compiles_shared_total': (
+        'counter', "Number of requests sharing a running compilation."),
+    'contractor_compiles_rejected_total': (
+        'counter', "Number of compilations rejected due to overload."),
+    'contractor_previews_total': (
+        'counter', "Number of letter previews by result."),
+    'contractor_split_documents_total': (
+        'counter', "Number of company documents split from a single pdf."),
+    'contractor_crm_errors_total': (
+        'counter', "Number of failed requests to the CRM."),
+    'contractor_crm_retries_total': (
+        'counter', "Number of repeated requests to the CRM."),
+    'contractor_crm_logins_total': (
+        'counter', "Number of new CRM sessions."),
+    'contractor_parse_errors_total': (
+        'counter', "Number of CRM accounts which could not be parsed."),
+    'contractor_auth_errors_total': (
+        'counter', "Number of failed requests to amivapi."),
+    'contractor_companies': (
+        'gauge', "Number of imported companies and errors."),
+    'contractor_companies_age_seconds': (
+        'gauge', "Time since the companies have been imported."),
+    'contractor_tex_workers': (
+        'gauge', "Number of tex workers by state."),
+    'contractor_tex_queued': (
+        'gauge', "Number of compilations waiting for a tex worker."),
+    'contractor_pregenerated_total': (
+        'counter', "Number of background compilations by result."),
+    'contractor_storage_bytes': (
+        'gauge', "Size of the cache of compiled documents."),
+}
+
+
+class Histogram(object):
+    """Counts of observations in cumulative buckets, like Prometheus."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        """Yield (suffix, extra labels, value) for all samples."""
+        total = 0
+        for (bound, count) in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield ('_bucket', (('le', str(bound)),), total)
+        yield ('_sum', (), self.sum)
+        yield ('_count', (), self.count)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for (key, value) in labels)
+
+
+class Metrics(object):
+    """Thread-safe collection of counters, gauges and histograms.
+
+    Metrics are identified by name and labels (as keyword arguments).
+    Metrics not listed in `DESCRIPTIONS` are rendered as untyped unless
+    they are described with `describe`.
+    """
+
+    def __init__(self):
+        self.descriptions = dict(DESCRIPTIONS)
+        self._values = {}  # name: {labels: value or Histogram}
+        self._lock = Lock()
+
+    def describe(self, name, kind, help_text):
+        """Add the type ('counter', 'gauge' or 'histogram') and help."""
+        self.descriptions[name] = (kind, help_text)
+
+    def count(self, name, amount=1, **labels):
+        """Increase a counter."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """Set a gauge, or a counter maintained elsewhere."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            if key not in values:
+                values[key] = Histogram()
+            values[key].observe(value)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the stage, also in the breakdown of the current request."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.observe('contractor_stage_seconds', elapsed, stage=stage)
+            if has_request_context():
+                timings = g.get('timings')
+                if timings is None:
+                    timings = g.timings = []
+                timings.append((stage, elapsed))
+
+    def breakdown(self):
+        """Return (stage, seconds) timed in the current request so far.
+
+        Stages timed more than once are added up.
+        """
+        if not has_request_context():
+            return []
+
+        totals = {}
+        order = []
+        for (stage, elapsed) in g.get('timings', []):
+            if stage not in totals:
+                order.append(stage)
+                totals[stage] = 0
+            totals[stage] += elapsed
+        return [(stage, totals[stage]) for stage in order]
+
+    def get(self, name, **labels):
+        """Return the current value (or Histogram) of a metric, or None."""
+        with self._lock:
+            return self._values.get(name, {}).get(
+                tuple(sorted(labels.items())))
+
+    def render(self):
+        """Return all metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._values):
+                (kind, help_text) = self.descriptions.get(
+                    name, ('untyped', ''))
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+                samples = sorted(self._values[name].items(),
+                                 key=lambda item: item[0])
+                for (labels, value) in samples:
+                    if isinstance(value, Histogram):
+                        for (suffix, extra, sample) in value.samples():
+                            lines.append('%s%s%s %s' % (
+                                name, suffix,
+                                _format_labels(labels + extra), sample))
+                    else:
+                        lines.append('%s%s %s' % (
+                            name, _format_labels(labels), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+"""The metrics of the app, shared by all modules."""
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+"""Compile documents in the background before they are requested.
+
+After the company data has been refreshed, the documents users are likely
+to download next (e.g. the contracts of changed companies and the document
+for all companies) are compiled speculatively. Since compiled documents are
+cached, the request finds them ready instead of waiting for xelatex.
+
+Speculative work must not slow down real requests:
+
+- Only a few tasks run at the same time (`workers`)
+- Tasks only start while the app is not busy otherwise, e.g. while no
+  compilations of requests are waiting for a tex worker
+- Scheduling new tasks cancels all tasks for older data: Tasks which have
+  not started yet are skipped, running tasks are stopped the next time they
+  report progress
+
+Tasks are scheduled in stages, every stage starts once all tasks of the
+previous stage are finished, e.g. the document for all companies is only
+compiled after the contracts of single companies, so it can reuse them.
+"""
+
+from concurrent.futures import CancelledError, ThreadPoolExecutor, wait
+from threading import Event, Lock
+
+from .metrics import METRICS
+
+
+class Cancelled(CancelledError):
+    """Raised in a task if newer tasks have been scheduled.
+
+    Requests sharing the compilation of the task (see
+    `contractor.scheduler.CompileScheduler`) compile it themselves.
+    """
+
+
+class Pregenerator(object):
+    """Run stages of background tasks, cancelled by newer ones.
+
+    Args:
+        workers (int): Number of tasks running at the same time
+        busy (callable): Optional, returns True while the app is busy, new
+            tasks are not started until it returns False
+        poll (float): Seconds between checks if the app is still busy
+    """
+
+    def __init__(self, workers=1, busy=None, poll=0.5):
+        self.busy = busy
+        self.poll = poll
+        self.generation = 0
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        # Runs the stages one after another
+        self._runner = ThreadPoolExecutor(max_workers=1)
+        self._lock = Lock()
+        self._stopped = Event()  # Set to stop waiting for the app
+
+    def schedule(self, stages):
+        """Cancel all previous tasks and run new ones.
+
+        Args:
+            stages (list): Lists of tasks. Tasks are called with a function
+                to report progress, which raises `Cancelled` if the task
+                should stop, and accepts (and ignores) a number of items.
+
+        Returns:
+            Future: Done once all stages are finished or cancelled
+        """
+        with self._lock:
+            self.generation += 1
+            generation = self.generation
+            self._stopped.set()
+            self._stopped = Event()
+        return self._runner.submit(self._run, generation, stages)
+
+    def cancel(self):
+        """Cancel all tasks."""
+        self.schedule([])
+
+    def cancelled(self, generation):
+        """True if tasks of generation should stop."""
+        return generation != self.generation
+
+    def _run(self, generation, stages):
+        for tasks in stages:
+            if self.cancelled(generation):
+                return
+            wait([self.pool.submit(self._call, generation, task)
+                  for task in tasks])
+
+    def _call(self, generation, task):
+        """Wait until the app is not busy, then run the task."""
+        stopped = self._stopped
+        while (self.busy is not None and not self.cancelled(generation) and
+               self.busy()):
+            stopped.wait(self.poll)
+
+        def check(*args):
+            if self.cancelled(generation):
+                raise Cancelled
+
+        try:
+            check()
+            task(check)
+        except Cancelled:
+            result = 'cancelled'
+        except Exception:
+            # The same request will fail again, and report the error
+            result = 'failed'
+        else:
+            result = 'done'
+        METRICS.count('contractor_pregenerated_total', result=result)
+
+    def close(self):
+        """Cancel all tasks and wait for running tasks."""
+        self.cancel()
+        self._runner.shutdown()
+        self.pool.shutdown()
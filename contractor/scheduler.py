@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""Admission control for compilations requested by users.
+
+Compiling documents for all companies takes a while and a lot of memory.
+If several people request the same document at once, it should only be
+compiled once, and if too many documents are requested, new requests
+should be rejected quickly instead of piling up.
+
+The `CompileScheduler` sits in front of the compiler:
+
+- Only a few compilations run at the same time, the others wait in a queue
+- If the queue is full, `Overloaded` is raised, which the app answers with
+  `503 Service Unavailable` and a `Retry-After` header
+- Waiting compilations start by priority: Previews of single companies go
+  first, then documents for all companies, then background work
+- Requests for a compilation which is already queued or running (with the
+  same key) wait for it and share its result instead of compiling again.
+  If the compilation is cancelled (raises `CancelledError`, e.g. outdated
+  background work), they run their own compilation instead
+"""
+
+from concurrent.futures import CancelledError, Future
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition
+
+from .metrics import METRICS
+
+# Priorities, lower numbers start first
+PREVIEW = 0
+BULK = 1
+BACKGROUND = 2
+
+
+class Overloaded(Exception):
+    """Raised if a compilation can not be queued.
+
+    Attributes:
+        retry_after (int): Seconds after which clients may retry
+    """
+
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__(
+            "Too many compilations, retry in %i seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+class CompileScheduler(object):
+    """Limit, queue, prioritize and deduplicate compilations.
+
+    Args:
+        concurrency (int): Maximum number of running compilations
+        queue_size (int): Maximum number of waiting compilations
+        retry_after (int): Seconds clients are asked to wait if the queue
+            is full
+    """
+
+    def __init__(self, concurrency=2, queue_size=10, retry_after=30):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.retry_after = retry_after
+
+        self.running = 0
+        self._waiting = []  # heap of (priority, ticket)
+        self._flights = {}  # key: Future with the result
+        self._tickets = count()
+        self._condition = Condition()
+
+    @property
+    def waiting(self):
+        """Number of queued compilations."""
+        return len(self._waiting)
+
+    def run(self, key, function, priority=BULK, reject=True):
+        """Call function once a slot is free and return its result.
+
+        If a compilation with the same key is queued or running, wait for
+        it and return its result instead.
+
+        Args:
+            key (str): Describes the input, equal keys give equal results
+            function (callable): The compilation, called without arguments
+            priority (int): `PREVIEW`, `BULK` or `BACKGROUND`
+            reject (bool): Raise `Overloaded` if the queue is full,
+                otherwise wait anyway (e.g. for background jobs)
+
+        Raises:
+            Overloaded: If the queue is full
+            CancelledError: If function raises it. Callers sharing the
+                compilation call their own function instead.
+        """
+        with self._condition:
+            flight = self._flights.get(key)
+            owner = flight is None
+            if owner:
+                busy = self.running >= self.concurrency
+                if reject and busy and self.waiting >= self.queue_size:
+                    METRICS.count('contractor_compiles_rejected_total')
+                    raise Overloaded(self.retry_after)
+
+                flight = self._flights[key] = Future()
+                self._wait_for_slot(priority)
+            else:
+                METRICS.count('contractor_compiles_shared_total')
+
+        if not owner:
+            try:
+                return flight.result()
+            except CancelledError:
+                return self.run(key, function, priority, reject)
+
+        try:
+            result = function()
+        except BaseException as error:
+            self._finish(key)
+            if isinstance(error, CancelledError):
+                flight.cancel()
+            else:
+                flight.set_exception(error)
+            raise
+        self._finish(key)
+        flight.set_result(result)
+        return result
+
+    def _finish(self, key):
+        """Free the slot, new calls with key start a new compilation."""
+        with self._condition:
+            self.running -= 1
+            del self._flights[key]
+            self._condition.notify_all()
+
+    def _wait_for_slot(self, priority):
+        """Wait until it is our turn and a slot is free, then take it.
+
+        Must be called with the condition acquired.
+        """
+        ticket = (priority, next(self._tickets))
+        heappush(self._waiting, ticket)
+        while (self._waiting[0] != ticket or
+               self.running >= self.concurrency):
+            self._condition.wait()
+        heappop(self._waiting)
+        self.running += 1
+        if self._waiting and self.running < self.concurrency:
+            # The next one may have woken up before us and waits again,
+            # although a slot is free
+            self._condition.notify_all()
+
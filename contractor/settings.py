@@ -6,6 +6,87 @@ from datetime import datetime as dt
 
 # URL for amivapi
 AMIVAPI_URL = 'https://api-dev.amiv.ethz.ch/'
+# Seconds to wait for amivapi, and number of kept-alive connections
+AMIVAPI_TIMEOUT = 5
+AMIVAPI_POOLSIZE = 4
+# Validated sessions are cached for n seconds, at most this many at once
+AMIVAPI_SESSION_TTL = 60
+AMIVAPI_SESSION_CACHE_SIZE = 1024
+
+# Company data from the CRM is cached in memory
+# Seconds after which the data is stale and reloaded in the background
+CRM_SNAPSHOT_TTL = 600
+# Seconds between automatic reloads, set to None to disable
+CRM_REFRESH_INTERVAL = 300
+# Reloads only import companies modified since the last reload
+# Import all companies every n reloads anyway, None to disable
+CRM_FULL_SYNC_EVERY = 12
+# The CRM is contacted on first use, with a pool of logged in sessions
+# Maximum number of sessions used at the same time
+CRM_SESSIONS = 2
+# Failed requests are retried n times, waiting CRM_BACKOFF seconds before
+# the first retry and twice as long before every further retry
+CRM_RETRIES = 3
+CRM_BACKOFF = 1
+
+# Documents for all companies are compiled in parallel chunks
+# Maximum number of concurrent xelatex runs, None to use all cores
+TEX_WORKERS = None
+# Maximum number of companies per chunk
+TEX_CHUNK_SIZE = 20
+# Instead of chunks, compile every company separately and reuse the pages of
+# unchanged companies from the previous document, so only changed companies
+# are compiled again after an update. Companies are still compiled in chunks,
+# which are split at the markers of the template.
+TEX_INCREMENTAL_BULK = True
+# Precompile the preamble of documents into a format (requires the
+# mylatexformat package), falls back to normal compilation if it fails
+TEX_PRECOMPILE_PREAMBLE = True
+# Rendered contracts of single companies are kept in memory
+# Maximum number of cached contracts
+TEX_FRAGMENT_CACHE_SIZE = 10000
+# xelatex runs on long-lived workers (one per TEX_WORKERS)
+# Seconds until a compilation is aborted, None to wait forever
+TEX_TIMEOUT = 120
+# Replace the scratch directory of a worker after n jobs, None to disable
+TEX_RECYCLE_AFTER = 100
+# Compilations requested by users are queued, identical requests share one
+# compilation. Maximum number of compilations running at the same time
+COMPILE_CONCURRENCY = 2
+# Maximum number of waiting compilations, further requests are answered
+# with '503 Service Unavailable' and asked to retry after n seconds
+COMPILE_QUEUE_SIZE = 10
+COMPILE_RETRY_AFTER = 30
+# Previews of the custom letter show the first page as image with this
+# resolution (dpi), if `pdftoppm` is installed, and are updated once the
+# letter has not been edited for n seconds
+PREVIEW_RESOLUTION = 60
+PREVIEW_DEBOUNCE = 0.5
+
+# Compiled documents are cached in STORAGE_DIR (default: './.cache')
+# Maximum size of the cache in bytes, None for no limit
+STORAGE_MAX_SIZE = 500 * 1024 * 1024
+
+# Documents for all companies are created in background jobs
+# Number of jobs running at the same time
+JOB_WORKERS = 1
+# Seconds to keep results of finished jobs for download
+JOB_RETENTION = 3600
+
+# Contracts are compiled in the background after every refresh of the
+# companies, so downloads are usually ready. Per output format, compile the
+# contracts of changed companies ('single') and the document for all
+# companies ('bulk'), formats not listed are not compiled in advance
+PREGENERATE = {
+    'mail': ['single', 'bulk'],
+    'email': ['single'],
+}
+# Number of background compilations at the same time
+PREGENERATE_WORKERS = 1
+
+# Timings of all stages are exported at /metrics
+# Also send the timings of each request in a 'Server-Timing' header
+METRICS_TIMING_HEADER = False
 
 # Yearly fair settings, move to CRM as soon as possible
 YEARLY_SETTINGS = {
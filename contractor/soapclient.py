@@ -1,22 +1,39 @@
 # -*- coding: utf-8 -*-
 
-"""Provide a connector to the AMIV sugarcrm."""
+"""Provide a connector to the AMIV sugarcrm.
 
-from amivcrm import AMIVCRM
+The connection is only established when the CRM is needed for the first
+time, so the app can start (and serve stored companies) even if the CRM is
+down. Requests use a small pool of logged in sessions, which are kept
+instead of logging in and out for every request. Expired sessions are
+replaced by logging in again, and failed requests are retried with
+exponential backoff.
+"""
+
+from threading import BoundedSemaphore, Lock
+from time import sleep
+
+from amivcrm import AMIVCRM, APPNAME, URL
+from suds import WebFault
+from suds.client import Client as SOAPClient
 
 from .choices import BoothChoice, PacketChoice
+from .letterdata import LetterData
+from .metrics import METRICS
+
+# Fields needed to list companies and find changes
+LIST_FIELDS = [
+    'id',
+    'date_modified',
+]
 
-# Fields needed
+# Fields needed for letters and contracts
 FIELDS = [
     'id',
     'name',
     'assigned_user_name',
     'shipping_address_street',
-    'shipping_address_street_2',
-    'shipping_address_street_3',
-    'shipping_address_street_4',
     'shipping_address_city',
-    'shipping_address_state',
     'shipping_address_postalcode',
     'shipping_address_country',
     'tag1_c',
@@ -25,123 +42,438 @@ FIELDS = [
     'packet_c',
     'mediapaket_c',
     'kategorie_c',
-    'kontaktinfo_c'
+    'kontaktinfo_c',
+    'date_modified',
 ]
 
+# SOAP fault code of the CRM if a session is invalid, e.g. expired
+INVALID_SESSION = '11'
+
+# Companies participating in the fair
+PARTICIPATING = "accounts_cstm.messeteilnahme_c = 1"
+# Companies are listed in the order (and collation) of the CRM
+ORDER = "accounts.name"
+# Specific companies, format with a comma separated list of quoted ids
+BY_ID = "accounts.id IN (%s)"
+
+# Fields which must not be None, because of the way the amiv letter works
+REQUIRED = [
+    'shipping_address_street',
+    'shipping_address_postalcode',
+    'shipping_address_city',
+]
+
+# Lookup tables to parse accounts
+# The field 'tischgroesse_c' is weirdly formatted.
+# 'kein' == small both
+# 'ein' == big booth
+# 'zwei' == startup
+BOOTH_SIZES = {'kein': 'startup', 'ein': 'small', 'zwei': 'big'}
+# Map katA to A etc
+CATEGORIES = {"kat" + letter: letter for letter in ['A', 'B', 'C']}
+# (day 1, day 2): (days, number of days)
+DAYS = {
+    (True, True): ("both", 2),
+    (True, False): ("first", 1),
+    (False, True): ("second", 1),
+    (False, False): (None, 1),
+}
+# (booth size, category, number of days): choice
+BOOTHS = {choice.value: choice for choice in BoothChoice}
+# packet_c: (business, first)
+PACKETS = {
+    "business": (PacketChoice.business, None),
+    "first": (None, PacketChoice.first),
+}
+NO_PACKET = (None, None)
+# Countries not printed in letters
+HOME_COUNTRIES = {"Schweiz", None}
+
+
+def parse_account(response):
+    """Parse a single account for the template.
+
+    Args:
+        response (dict): soap response as a dict
+
+    Returns:
+        LetterData: Data formatted for contract creation.
+    """
+    missing = [field for field in REQUIRED if response[field] is None]
+    if missing:
+        raise Exception("The following fields are missing: " +
+                        ', '.join(missing))
+
+    # With size, category and days we can get the right choice
+    size = response['tischgroesse_c']
+    if size not in BOOTH_SIZES:
+        raise ValueError("Unrecognized value for 'tischgroesse_c': %s"
+                         % size)
+    (days, n_days) = DAYS[(response['tag1_c'] == '1',
+                           response['tag2_c'] == '1')]
+    booth = (BOOTH_SIZES[size], CATEGORIES[response['kategorie_c']], n_days)
+    if booth not in BOOTHS:
+        raise ValueError("%r is not a valid BoothChoice" % (booth,))
+
+    # Get person that did the fair signup:
+    # Always at the beginning of the "kontaktinfo_c" field.
+    # TODO (Alex): This seems a little hacked to me. As soon as we have a
+    #   proper way to identify the main contact we should switch
+    try:
+        name = ''.join(response['kontaktinfo_c'].split(',')[0:2])
+    except Exception:
+        raise ValueError("Company representative could not be imported "
+                         "from field 'kontaktinfo_c': with content "
+                         "'%s'" % response.get('kontaktinfo_c', None))
+
+    # Include country only if its not "Schweiz" and is specified
+    country = response.get('shipping_address_country')
+    (business, first) = PACKETS.get(response['packet_c'], NO_PACKET)
+
+    return LetterData(
+        id=response['id'],
+        companyname=response['name'],
+        companyaddress=response['shipping_address_street'],
+        companycity="%s %s" % (response['shipping_address_postalcode'],
+                               response['shipping_address_city']),
+        companycountry="" if country in HOME_COUNTRIES else country,
+        companyrepresentative=name,
+        amivrepresentative=response['assigned_user_name'],
+        boothchoice=BOOTHS[booth],
+        days=days,
+        media=(PacketChoice.media
+               if response['mediapaket_c'] == "mediaPaket" else None),
+        business=business,
+        first=first,
+    )
+
+
+def parse_accounts(response):
+    """Parse a batch of accounts in one pass, collecting errors.
+
+    Returns:
+        list: (account, letterdata, error) tuples in the order of the
+            response, where either letterdata or error is None
+    """
+    results = []
+    append = results.append
+    for account in response:
+        try:
+            append((account, parse_account(account), None))
+        except Exception as e:
+            append((account, None, str(e)))
+    return results
+
+
+class SessionPool(object):
+    """Logged in sessions, shared by concurrent requests.
+
+    Sessions are created when needed, but at most `size` at once. If all
+    sessions are in use, requests wait for a free one.
+
+    Args:
+        login (callable): Function returning a new session
+        size (int): Maximum number of sessions
+    """
+
+    def __init__(self, login, size=2):
+        self.login = login
+        self._idle = []
+        self._slots = BoundedSemaphore(size)
+        self._lock = Lock()
+
+    def acquire(self):
+        """Return an idle session, or log in if there is none."""
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        try:
+            return self.login()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, session):
+        """Return a session to the pool after use."""
+        with self._lock:
+            self._idle.append(session)
+        self._slots.release()
+
+    def discard(self, session):
+        """Remove a session, e.g. if it has expired."""
+        self._slots.release()
+
+    def clear(self):
+        """Remove and return all idle sessions."""
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        return idle
+
+
+def _session_expired(error):
+    """True if the CRM has rejected the session of a request."""
+    return (isinstance(error, WebFault) and
+            str(getattr(error.fault, 'faultcode', '')) == INVALID_SESSION)
+
 
 class Importer(AMIVCRM):
-    """Wrapper around CRM class to provide some data parsing."""
+    """Wrapper around CRM class to provide some data parsing.
 
-    def __init__(self, *args, **kwargs):
-        super(Importer, self).__init__(*args, **kwargs)
+    Besides importing all companies at once with `get_companies`, the
+    importer can keep a local copy of the companies and `sync` it.
 
-    def _parse_response(self, response):
-        """Parse data for the template.
+    Syncing is done in two tiers: A light list with only the ids and
+    modification dates of all participating companies is requested, and
+    only new or modified companies are imported with all fields, in batches.
+    Imported companies are kept, and also used for `get_company` if they
+    have not changed.
 
-        Args:
-            response (dict): soap response as a dict
+    Nothing is requested from the CRM before the first import, see the
+    module docstring for sessions and retries.
+
+    Args:
+        username (str): The soap username
+        password (str): The soap password
+        url (str): CRM url
+        appname (str): The soap appname
+        full_sync_every (int): Import all companies instead of only the
+            modified ones every n syncs, as a fallback for missed changes.
+            None to only sync fully the first time (or if requested).
+        batch_size (int): Maximum number of companies imported per request
+        sessions (int): Maximum number of sessions used at the same time
+        retries (int): How often failed requests are repeated
+        backoff (float): Seconds to wait before the first retry, doubled
+            for every further retry
+    """
+
+    def __init__(self, username, password, url=URL, appname=APPNAME,
+                 full_sync_every=None, batch_size=100, sessions=2,
+                 retries=3, backoff=1):
+        # Don't call super, it would connect to the CRM immediately
+        self.username = username
+        self.password = password
+        self.url = url
+        self.appname = appname
+        self.full_sync_every = full_sync_every
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+
+        self._client = None
+        self._client_lock = Lock()
+        self.sessions = SessionPool(self._login, size=sessions)
+
+        # id: (name, letterdata, error, modification date)
+        # Changed by requests (`get_company`) while syncing, so guarded
+        self._records = {}
+        self._records_lock = Lock()
+        self._syncs = 0
+        self._force_full = True
+
+    def _connect(self):
+        """Create the SOAP client, which loads the service description."""
+        return SOAPClient(self.url)
+
+    @property
+    def client(self):
+        """The SOAP client, created on first use."""
+        with self._client_lock:
+            if self._client is None:
+                self._client = self._connect()
+            return self._client
+
+    def _login(self):
+        """Return a new session as (client, session id).
+
+        Every session has its own copy of the client, so sessions can be
+        used concurrently.
+        """
+        client = self.client.clone()
+        auth = {'user_name': self.username, 'password': self.password}
+        session_id = client.service.login(auth, self.appname).id
+        METRICS.count('contractor_crm_logins_total')
+        return (client, session_id)
+
+    def _call(self, method, **kwargs):
+        """Call a SOAP method with a session from the pool.
+
+        If the session has expired, the request is repeated immediately with
+        a new session. Other errors are retried after waiting.
+        """
+        attempt = 0
+        while True:
+            session = None
+            try:
+                session = self.sessions.acquire()
+                (client, session_id) = session
+                result = getattr(client.service, method)(session=session_id,
+                                                         **kwargs)
+            except Exception as error:
+                if session is not None:
+                    self.sessions.discard(session)
+                if attempt >= self.retries:
+                    raise
+                METRICS.count('contractor_crm_retries_total')
+                if not _session_expired(error):
+                    sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+            else:
+                self.sessions.release(session)
+                return result
+
+    def close(self):
+        """Log out of all idle sessions."""
+        for (client, session_id) in self.sessions.clear():
+            try:
+                client.service.logout(session_id)
+            except Exception:
+                pass
+
+    def get(self, module_name, query="", order_by="", select_fields=None,
+            max_results=None):
+        """Get list of module entries matching the query.
+
+        Same as `AMIVCRM.get`, but with a session from the pool. The CRM
+        returns at most a page of entries, see `get_pages` for all.
+
+        Yields:
+            dict: Parsed entry
+        """
+        kwargs = {} if max_results is None else {'max_results': max_results}
+        response = self._call('get_entry_list', module_name=module_name,
+                              query=query, order_by=order_by,
+                              select_fields=select_fields, offset=0,
+                              **kwargs)
+        for entry in response.entry_list:
+            yield self._parse(entry)
+
+    def getentry(self, module_name, entry_id, select_fields=None):
+        """Get single entry specified by id.
+
+        Same as `AMIVCRM.getentry`, but with a session from the pool.
 
         Returns:
-            dict: Data formatted for contract creation.
+            dict: Result, None if nothing found.
         """
-        # Because of the way the amiv letter works, street and city must not be
-        # None
-        missing = [field for field in ['shipping_address_street',
-                                       'shipping_address_postalcode',
-                                       'shipping_address_city']
-                   if response[field] is None]
-
-        if len(missing) > 0:
-            raise Exception("The following fields are missing: " +
-                            ', '.join(missing))
-
-        # Basic fields
-        letterdata = {
-            'id': response['id'],
-            'amivrepresentative': response['assigned_user_name'],
-            'companyname': response['name'],
-            'companyaddress': response['shipping_address_street'],
-            'companycity': ("%s %s" % (response['shipping_address_postalcode'],
-                                       response['shipping_address_city'])),
-        }
-
-        # Get packets
-        letterdata['media'] = (
-            PacketChoice.media
-            if response['mediapaket_c'] == "mediaPaket" else None)
-
-        letterdata['business'] = (
-            PacketChoice.business
-            if response['packet_c'] == "business" else None)
-
-        letterdata['first'] = (
-            PacketChoice.first
-            if response['packet_c'] == "first" else None)
-
-        # Include country only if its not "Schweiz" and is specified
-        country = response.get('shipping_address_country', "Schweiz")
-        if country in ["Schweiz", None]:
-            letterdata['companycountry'] = ""
-        else:
-            letterdata['companycountry'] = response['shipping_address_country']
-
-        # Get fair days
-        if (response['tag1_c'] == '1') and (response['tag2_c'] == '1'):
-            # Both days
-            n_days = 2
-            letterdata['days'] = "both"
-        else:
-            # only one day
-            n_days = 1
-
-            # Check which day to print correct date on contract
-            if response['tag1_c'] == '1':
-                letterdata['days'] = "first"
-            if response['tag2_c'] == '1':
-                letterdata['days'] = "second"
-
-        # Get booth choice
-        # The field 'tischgroesse_c' is weirdly formatted.
-        # 'kein' == small both
-        # 'ein' == big booth
-        # 'zwei' == startup
-        if response['tischgroesse_c'] == 'kein':
-            boothsize = "startup"
-        elif response['tischgroesse_c'] == 'ein':
-            boothsize = "small"
-        elif response['tischgroesse_c'] == 'zwei':
-            boothsize = "big"
-        else:
-            raise ValueError("Unrecognized value for 'tischgroesse_c': " +
-                             response['tischgroesse_c'])
-
-        # Get kategory, map katA to A etc
-        mapping = {"kat" + letter: letter for letter in ['A', 'B', 'C']}
-        category = mapping[response['kategorie_c']]
-
-        # With size, category and days we can get the right choice
-        letterdata['boothchoice'] = BoothChoice((boothsize, category, n_days))
-
-        # Get person that did the fair signup:
-        # Always at the beginning of the "kontaktinfo_c" field.
-        # TODO (Alex): This seems a little hacked to me. As soon as we have a
-        #   proper way to identify the main contact we should switch
-        try:
-            name = ''.join(response['kontaktinfo_c'].split(',')[0:2])
-        except Exception:
-            raise ValueError("Company representative could not be imported "
-                             "from field 'kontaktinfo_c': with content "
-                             "'%s'" % response.get('kontaktinfo_c', None))
+        response = self._call('get_entry', id=entry_id,
+                              module_name=module_name,
+                              select_fields=select_fields)
+        parsed = self._parse(response.entry_list[0])
 
-        letterdata['companyrepresentative'] = name
+        # Entries which don't exist have the field 'deleted' set to '1'
+        if parsed.get('deleted') == '1':
+            return None
+        return parsed
 
-        return letterdata
+    def _parse_response(self, response):
+        """Parse data for the template, see `parse_account`."""
+        return parse_account(response)
+
+    def _request(self, request):
+        """Call request() to contact the CRM, timing it and counting errors.
+
+        Responses are read completely, so parsing is timed separately.
+        """
+        with METRICS.timer('crm'):
+            try:
+                return request()
+            except Exception:
+                METRICS.count('contractor_crm_errors_total')
+                raise
 
     def get_company(self, company_id):
-        """Get data for a single company by id."""
-        response = self.getentry("Accounts", company_id, select_fields=FIELDS)
+        """Get data for a single company by id.
+
+        If the company has been imported before, only its modification date
+        is requested, and it is imported again only if it has changed.
+        """
+        record = self._records.get(company_id)
+        if record is not None and record[1] is not None:
+            current = self._request(lambda: self.getentry(
+                "Accounts", company_id, select_fields=LIST_FIELDS))
+            if current is not None and current['date_modified'] == record[3]:
+                return record[1]
+
+        response = self._request(lambda: self.getentry(
+            "Accounts", company_id, select_fields=FIELDS))
 
-        return self._parse_response(response)
+        with METRICS.timer('parse'):
+            parsed = self._parse_response(response)
+        with self._records_lock:
+            self._records[company_id] = (response['name'], parsed, None,
+                                         response['date_modified'])
+        return parsed
+
+    def _parse_all(self, response):
+        """Parse all accounts of a response, see `parse_accounts`."""
+        with METRICS.timer('parse'):
+            results = parse_accounts(response)
+        errors = sum(error is not None for (_, _, error) in results)
+        if errors:
+            METRICS.count('contractor_parse_errors_total', errors)
+        return results
+
+    def get_pages(self, module_name, query="", order_by="",
+                  select_fields=None, page_size=100):
+        """Get module entries matching the query, one page at a time.
+
+        Same as `get`, but the entries are requested in pages, and every
+        page is yielded as soon as it has arrived. The CRM may return fewer
+        entries than requested if page_size is above its limit, so pages
+        are requested until one is empty.
+
+        Yields:
+            list: Parsed entries of a page
+        """
+        offset = 0
+        while True:
+            response = self._call('get_entry_list', module_name=module_name,
+                                  query=query, order_by=order_by,
+                                  select_fields=select_fields,
+                                  offset=offset, max_results=page_size)
+
+            page = [self._parse(entry) for entry in response.entry_list]
+            if not page:
+                return
+            yield page
+            offset = response.next_offset
+
+    def iter_companies(self, page_size=100, record=False):
+        """Import companies page by page, ordered by name.
+
+        Every page is parsed and yielded as soon as it arrives, so the
+        first companies can be shown before all are imported, and only a
+        page is kept in memory at once.
+
+        Args:
+            page_size (int): Number of companies per request
+            record (bool): Once all companies have been read, keep them
+                like a full `sync`, so the next sync only imports changes
+
+        Yields:
+            tuple: (account, letterdata, error), see `parse_accounts`
+        """
+        pages = self.get_pages("Accounts", query=PARTICIPATING,
+                               order_by=ORDER,
+                               select_fields=FIELDS, page_size=page_size)
+        records = {}
+        while True:
+            page = self._request(lambda: next(pages, None))
+            if page is None:
+                break
+            for result in self._parse_all(page):
+                (company, parsed, error) = result
+                records[company['id']] = (company['name'], parsed, error,
+                                          company['date_modified'])
+                yield result
+
+        if record:
+            with self._records_lock:
+                self._records = records
+            self._force_full = False
+            self._syncs += 1
 
     def get_companies(self):
         """Get the data from soap to fill in the template.
@@ -152,21 +484,104 @@ class Importer(AMIVCRM):
                 The dictionary contains all errors and has the schema:
                 companyname: reason for error.
         """
-        response = self.get("Accounts",
-                            query="accounts_cstm.messeteilnahme_c = 1",
-                            order_by="accounts.name",
-                            select_fields=FIELDS)
-
-        # Parse data to fit template and collect errors
         data = []
         errors = {}
 
-        for company in response:
-            try:
-                parsed = self._parse_response(company)
-            except Exception as e:
-                errors[company['name']] = str(e)
+        for (company, parsed, error) in self.iter_companies():
+            if error is None:
+                data.append(parsed)
             else:
+                errors[company['name']] = error
+
+        return (data, errors)
+
+    def request_full_sync(self):
+        """Make the next sync a full sync."""
+        self._force_full = True
+
+    def sync(self):
+        """Update the local data from the CRM and return it.
+
+        Only accounts which are new or have been modified since the last
+        sync are imported, deleted and de-registered companies are removed.
+
+        The modification dates reported by the CRM are compared for every
+        account, so the local clock does not matter.
+
+        Returns:
+            tuple (list, dict): Same as `get_companies`, in the same order.
+        """
+        full = (self._force_full or
+                bool(self.full_sync_every and
+                     (self._syncs % self.full_sync_every == 0)))
+        self._force_full = False
+
+        try:
+            records = self._fetch_changes(full)
+        except Exception:
+            # Try again next time
+            self._force_full = self._force_full or full
+            raise
+
+        with self._records_lock:
+            self._records = records
+        self._syncs += 1
+        return self._collect()
+
+    def _fetch_changes(self, full):
+        """List all accounts, import new and changed ones.
+
+        Returns:
+            dict: The new records
+        """
+        listing = self._request(lambda: [
+            (company['id'], company['date_modified'])
+            for page in self.get_pages("Accounts", query=PARTICIPATING,
+                                       order_by=ORDER,
+                                       select_fields=LIST_FIELDS)
+            for company in page])
+
+        records = {}
+        changed = []
+        for (_id, modified) in listing:
+            record = None if full else self._records.get(_id)
+            if record is not None and record[3] == modified:
+                records[_id] = record
+            else:
+                changed.append(_id)
+
+        while changed:
+            (batch, changed) = (changed[:self.batch_size],
+                                changed[self.batch_size:])
+            ids = ', '.join("'%s'" % _id.replace("'", "''") for _id in batch)
+            response = self._request(lambda: list(self.get(
+                "Accounts", query="%s AND %s" % (PARTICIPATING, BY_ID % ids),
+                select_fields=FIELDS, max_results=len(batch))))
+            for (company, parsed, error) in self._parse_all(response):
+                records[company['id']] = (company['name'], parsed, error,
+                                          company['date_modified'])
+
+            # If the CRM limits the page size, request the rest again.
+            # Accounts which are not returned at all have been removed or
+            # de-registered since listing them.
+            missing = [_id for _id in batch if _id not in records]
+            if missing and response:
+                changed = missing + changed
+
+        # Keep the order of the listing
+        return {_id: records[_id] for (_id, _) in listing if _id in records}
+
+    def _collect(self):
+        """Return local data as (data, errors), ordered like the CRM."""
+        data = []
+        errors = {}
+        with self._records_lock:
+            records = list(self._records.values())
+
+        for (name, parsed, error, _) in records:
+            if error is None:
                 data.append(parsed)
+            else:
+                errors[name] = error
 
         return (data, errors)
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+"""Provide a file cache in the storage directory.
+
+Compiled documents are stored under a key, usually a hash of everything
+that determines the output (tex source, template and amivtex version).
+If the same document is requested again, it can be served from disk
+instead of compiling it again.
+
+Files are written atomically (written to a temporary file first and then
+moved into place), so readers never see partial files, even with several
+processes sharing the directory.
+
+If the cache grows larger than its maximum size, the least recently used
+files are removed. Every hit updates the modification time of the file,
+which is used to determine the least recently used files. The size is
+kept as a running total, so the directory is only listed when files have
+to be removed, not on every write.
+
+Cached documents can be sent from disk with `file_response`, with the hash
+of their content (see `file_digest`) as strong ETag, so browsers can
+revalidate them and download them again only if the content has changed.
+Range requests are supported as well.
+"""
+
+from hashlib import sha256
+from os import fstat, makedirs, path, listdir, remove, replace, stat, utime
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from flask import Response, request
+from werkzeug.wsgi import wrap_file
+
+
+def make_key(*parts):
+    """Hash all parts (str or bytes) into a single key."""
+    digest = sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(sha256(part).digest())
+    return digest.hexdigest()
+
+
+class FileCache(object):
+    """Store files by key in a directory.
+
+    Args:
+        directory (str): Directory for the files, created if needed
+        max_size (int): Maximum size of all files in bytes, None for no limit
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()  # Guards counters, size and eviction
+        self._size = None  # Running total, computed on first use
+
+        makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        """Return the filename for a key (which may not exist)."""
+        return path.join(self.directory, key)
+
+    def get_path(self, key):
+        """Return the filename for key if cached, None otherwise."""
+        filename = self.path(key)
+        try:
+            # Mark as recently used
+            utime(filename)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return filename
+
+    def get(self, key):
+        """Return the content for key, None if not cached."""
+        filename = self.get_path(key)
+        if filename is None:
+            return None
+
+        try:
+            with open(filename, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            # Evicted in the meantime
+            return None
+
+    def put(self, key, data):
+        """Store data (bytes) atomically under key."""
+        with NamedTemporaryFile(dir=self.directory, prefix='.tmp',
+                                delete=False) as file:
+            file.write(data)
+
+        filename = self.path(key)
+        with self._lock:
+            try:
+                replaced = stat(filename).st_size
+            except FileNotFoundError:
+                replaced = 0
+            replace(file.name, filename)
+            if self._size is not None:
+                self._size += len(data) - replaced
+
+        if self.max_size is not None and self.size > self.max_size:
+            self.evict(self.max_size)
+
+    def __contains__(self, key):
+        return path.exists(self.path(key))
+
+    def _entries(self):
+        """Return (mtime, size, filename) for all cached files."""
+        entries = []
+        for name in listdir(self.directory):
+            if name.startswith('.tmp'):
+                continue
+            filename = path.join(self.directory, name)
+            try:
+                info = stat(filename)
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, info.st_size, filename))
+        return entries
+
+    @property
+    def size(self):
+        """Size of all cached files in bytes.
+
+        Files written or removed by other processes are only noticed the
+        next time files are evicted.
+        """
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for (_, size, _) in self._entries())
+            return self._size
+
+    def evict(self, max_size):
+        """Remove least recently used files until size is below max_size."""
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for (_, size, _) in entries)
+
+            for (_, size, filename) in entries:
+                if total <= max_size:
+                    break
+                try:
+                    remove(filename)
+                except FileNotFoundError:
+                    pass
+                total -= size
+            self._size = total
+
+    def clear(self):
+        """Remove all cached files."""
+        self.evict(0)
+
+    def stats(self):
+        """Return a dict with hit and miss counts as well as size."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'files': len(self._entries()),
+            'size': self.size,
+        }
+
+
+def file_digest(file, block_size=1 << 16):
+    """Return the sha256 of the content of a file opened in binary mode.
+
+    The file is read from the start, and rewound afterwards.
+    """
+    digest = sha256()
+    file.seek(0)
+    for block in iter(lambda: file.read(block_size), b''):
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def file_response(file, etag, mimetype, filename=None, inline=False):
+    """Send an open file as response to the current request.
+
+    The file is sent with `wsgi.file_wrapper` if the server provides it,
+    e.g. bjoern uses sendfile, otherwise in blocks. Clients have to
+    revalidate the response every time, which is answered with
+    `304 Not Modified` if the ETag has not changed. Range requests are
+    answered with `206 Partial Content`.
+
+    Args:
+        file: File opened in binary mode, closed after sending
+        etag (str): Strong ETag, e.g. the content hash
+        mimetype (str): Mimetype of the content
+        filename (str): Optional, send as attachment with this name
+        inline (bool): Let browsers show the file instead of downloading
+            it, filename is only a suggestion for saving it then
+    """
+    try:
+        size = fstat(file.fileno()).st_size
+    except (AttributeError, OSError):
+        # Not a real file, e.g. BytesIO
+        size = len(file.getbuffer())
+
+    response = Response(wrap_file(request.environ, file), mimetype=mimetype,
+                        direct_passthrough=True)
+    response.content_length = size
+    if filename is not None:
+        response.headers['Content-Disposition'] = '%s; filename=%s' % (
+            'inline' if inline else 'attachment', filename)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True,
+                                     complete_length=size)
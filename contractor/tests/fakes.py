@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-ins for external services used in tests.
+
+`FakeAMIVAPI` is a tiny http server implementing the parts of the amivapi
+`/sessions` resource used for login. It runs in a background thread and
+counts the requests it receives.
+
+`FakeSOAPClient` replaces the SOAP connection of the importer with a dict of
+accounts, which can be created with `make_account`. `FakeImporter` is an
+importer using it.
+
+`install_fake_tex` creates a fake `xelatex` command, which writes a blank
+pdf with one page per company instead of compiling.
+"""
+
+import json
+import re
+import sys
+from os import chmod, path
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs, urlparse
+from uuid import uuid4
+
+from suds import WebFault
+
+from contractor.soapclient import INVALID_SESSION, Importer
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeAMIVAPI(object):
+    """Minimal amivapi serving `/sessions`.
+
+    Every user can log in with the password 'pass'.
+
+    Usage:
+
+    ```
+    with FakeAMIVAPI() as api:
+        app.config['AMIVAPI_URL'] = api.url
+    ```
+    """
+
+    password = 'pass'
+
+    def __init__(self):
+        self.sessions = {}  # token: session
+        self.requests = []  # (method, path) of every request
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                """Keep test output clean."""
+
+            def _reply(self, status, data=None):
+                body = json.dumps(data).encode() if data is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                api.requests.append(('GET', self.path))
+                token = self.headers.get('Authorization')
+                query = parse_qs(urlparse(self.path).query)
+                where = json.loads(query.get('where', ['{}'])[0])
+
+                session = api.sessions.get(token)
+                if session is None or where.get('token') != token:
+                    return self._reply(401, {'_error': 'unauthorized'})
+                self._reply(200, {'_items': [session]})
+
+            def do_POST(self):
+                api.requests.append(('POST', self.path))
+                length = int(self.headers.get('Content-Length', 0))
+                form = parse_qs(self.rfile.read(length).decode())
+                username = form.get('username', [''])[0]
+
+                if form.get('password', [''])[0] != api.password:
+                    return self._reply(401, {'_error': 'wrong password'})
+                token = api.login(username)
+                self._reply(201, {'token': token})
+
+            def do_DELETE(self):
+                api.requests.append(('DELETE', self.path))
+                session_id = self.path.rsplit('/', 1)[-1]
+                for (token, session) in list(api.sessions.items()):
+                    if session['_id'] == session_id:
+                        del api.sessions[token]
+                        return self._reply(204)
+                self._reply(404)
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        """Base url of the running server."""
+        return 'http://127.0.0.1:%s/' % self._server.server_address[1]
+
+    def login(self, username):
+        """Create a session directly and return the token."""
+        token = uuid4().hex
+        self.sessions[token] = {
+            '_id': uuid4().hex,
+            '_etag': uuid4().hex,
+            'token': token,
+            'user': {'firstname': username, 'lastname': 'Tester'},
+        }
+        return token
+
+    def count(self, method=None):
+        """Number of requests received, optionally only for one method."""
+        return len([r for r in self.requests
+                    if method is None or r[0] == method])
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def make_account(index, **fields):
+    """Return a valid CRM account, fields can be overwritten.
+
+    The choices (booth, days, packets) vary with the index.
+    """
+    size = ['kein', 'ein', 'zwei'][index % 3]
+    account = {
+        'id': 'account-%05i' % index,
+        'name': 'Company %05i' % index,
+        'assigned_user_name': 'Pablö',
+        'shipping_address_street': "Teststrüüt %i" % index,
+        'shipping_address_street_2': None,
+        'shipping_address_street_3': None,
+        'shipping_address_street_4': None,
+        'shipping_address_city': 'Testingtàn',
+        'shipping_address_state': None,
+        'shipping_address_postalcode': '%04i' % (1000 + index % 9000),
+        'shipping_address_country': ['Schweiz', None, 'Faraway'][index % 3],
+        'tag1_c': '1' if index % 4 != 1 else '0',
+        'tag2_c': '1' if index % 4 != 0 else '0',
+        'tischgroesse_c': size,
+        'packet_c': [None, 'business', 'first'][index % 3],
+        'mediapaket_c': 'mediaPaket' if index % 2 else None,
+        # Startups have their own category
+        'kategorie_c': 'katC' if size == 'kein' else ['katA', 'katB'][
+            index % 2],
+        'kontaktinfo_c': 'Sr.,Senior,senior@example.com',
+        'date_modified': '2018-01-01 00:00:00',
+        'messeteilnahme_c': '1',
+    }
+    account.update(fields)
+    return account
+
+
+class _Result(object):
+    """Object with attributes, like the responses of suds."""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def _entry(fields):
+    return _Result(name_value_list=[_Result(name=name, value=value)
+                                    for (name, value) in fields.items()])
+
+
+class FakeSOAPClient(object):
+    """Replaces the SOAP client of the importer with a dict of accounts.
+
+    Implements the parts of the SugarCRM SOAP service used by the importer.
+    Only the queries used by the importer are understood: the fair
+    participation filter and a list of ids.
+
+    Every request is recorded in `calls` as (query, select_fields). Sessions
+    can be expired with `expire_sessions`, and the next requests fail with
+    the exceptions in `failures`. Like the CRM, pages can be limited to
+    `page_limit` entries.
+
+    Args:
+        accounts (list): Accounts, see `make_account`
+        latency (float): Seconds every request takes, also creating the
+            client (which loads the service description)
+    """
+
+    def __init__(self, accounts=(), latency=0):
+        self.accounts = {account['id']: account for account in accounts}
+        self.latency = latency
+        self.calls = []
+        self.failures = []
+        self.logins = 0
+        self.page_limit = None  # Maximum entries per page, like the CRM
+        self.service = self  # Requests are made with client.service
+
+        self._sessions = set()
+        self._wait()
+
+    def clone(self):
+        return self
+
+    def _wait(self):
+        if self.latency:
+            sleep(self.latency)
+
+    def _check(self, session):
+        self._wait()
+        if self.failures:
+            raise self.failures.pop(0)
+        if session not in self._sessions:
+            raise WebFault(_Result(faultcode=INVALID_SESSION,
+                                   faultstring='Invalid Session ID'), None)
+
+    def expire_sessions(self):
+        self._sessions.clear()
+
+    def login(self, auth, appname):
+        self._wait()
+        self.logins += 1
+        session = uuid4().hex
+        self._sessions.add(session)
+        return _Result(id=session)
+
+    def logout(self, session):
+        self._sessions.discard(session)
+
+    @staticmethod
+    def _select(account, select_fields):
+        if not select_fields:
+            return dict(account)
+        return {field: account.get(field) for field in select_fields}
+
+    def get_entry_list(self, session, module_name, query="", order_by="",
+                       select_fields=None, offset=0, max_results=None):
+        self._check(session)
+        self.calls.append((query, select_fields))
+
+        results = [account for account in self.accounts.values()
+                   if account.get('messeteilnahme_c') == '1']
+
+        ids = re.search(r"accounts.id IN \(([^)]*)\)", query)
+        if ids:
+            ids = set(re.findall(r"'([^']*)'", ids.group(1)))
+            results = [account for account in results
+                       if account['id'] in ids]
+
+        if order_by:
+            field = order_by.split('.')[-1]
+            results.sort(key=lambda account: account[field])
+
+        limits = [limit for limit in (max_results, self.page_limit)
+                  if limit is not None]
+        end = offset + min(limits) if limits else None
+        page = results[offset:end]
+        return _Result(
+            entry_list=[_entry(self._select(account, select_fields))
+                        for account in page],
+            result_count=len(page),
+            next_offset=offset + len(page))
+
+    def get_entry(self, id, session, module_name, select_fields=None):
+        self._check(session)
+        self.calls.append(("id = '%s'" % id, select_fields))
+
+        account = self.accounts.get(id)
+        if account is None:
+            fields = {'id': id, 'deleted': '1'}
+        else:
+            fields = self._select(account, select_fields)
+        return _Result(entry_list=[_entry(fields)])
+
+
+class FakeImporter(Importer):
+    """Importer using a `FakeSOAPClient` instead of the CRM.
+
+    ```
+    crm = FakeImporter([make_account(i) for i in range(10)])
+    ```
+
+    The accounts and recorded calls of the client are available as
+    `crm.accounts` and `crm.calls`.
+    """
+
+    def __init__(self, accounts=(), latency=0, **kwargs):
+        kwargs.setdefault('backoff', 0)
+        super(FakeImporter, self).__init__('fake', 'fake', **kwargs)
+        self._accounts = accounts
+        self._latency = latency
+
+    def _connect(self):
+        return FakeSOAPClient(self._accounts, self._latency)
+
+    @property
+    def accounts(self):
+        return self.client.accounts
+
+    @property
+    def calls(self):
+        return self.client.calls
+
+    @calls.setter
+    def calls(self, calls):
+        self.client.calls = calls
+
+
+FAKE_XELATEX = """#!%s
+# Fake xelatex: blank pdf with a page per company, formats are empty files
+# Named destinations are added, one per page, like `\\special{pdf:dest}`
+import os, re, sys
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import TextStringObject
+args = sys.argv[1:]
+outdir = args[args.index('-output-directory') + 1]
+if '-ini' in args:
+    name = [arg for arg in args if arg.startswith('-jobname=')][0][9:]
+    open(os.path.join(outdir, name + '.fmt'), 'w').close()
+    sys.exit(0)
+with open(args[-1]) as file:
+    source = file.read()
+markers = re.findall(r'pdf:dest \\((.*?)\\)', source)
+pages = max(source.count('\\\\name{'), len(markers)) or 1
+writer = PdfFileWriter()
+for _ in range(pages):
+    writer.addBlankPage(width=595, height=842)
+for (page, name) in enumerate(markers):
+    writer.addNamedDestination(TextStringObject(name), page)
+with open(os.path.join(outdir, 'temp.pdf'), 'wb') as file:
+    writer.write(file)
+with open(os.path.join(outdir, 'temp.log'), 'w') as file:
+    file.write('Output written on temp.pdf')
+"""
+
+
+def install_fake_tex(directory):
+    """Create a fake `xelatex` command in directory.
+
+    Put the directory at the front of the PATH to use it.
+    """
+    command = path.join(directory, 'xelatex')
+    with open(command, 'w') as file:
+        file.write(FAKE_XELATEX % sys.executable)
+    chmod(command, 0o755)
+    return command
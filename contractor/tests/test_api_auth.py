@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the amivapi login.
+
+A local amivapi stub is used, so we can count how often it is contacted.
+"""
+
+from unittest import TestCase
+
+from flask import Flask, g
+
+from contractor.api_auth import api_auth, protected, COOKIE
+from contractor.tests.fakes import FakeAMIVAPI
+
+
+class AuthTest(TestCase):
+    """Test session validation and caching."""
+
+    def setUp(self):
+        self.api = FakeAMIVAPI().start()
+
+        self.app = Flask('contractor')
+        self.app.config.from_object('contractor.settings')
+        self.app.config['AMIVAPI_URL'] = self.api.url
+        self.app.register_blueprint(api_auth)
+
+        @self.app.route('/')
+        @protected
+        def index():
+            return g.username
+
+        # Cookies are sent explicitly in the tests
+        self.client = self.app.test_client(use_cookies=False)
+
+    def tearDown(self):
+        self.api.stop()
+
+    def _get(self, url, token):
+        return self.client.get(url,
+                               headers={'Cookie': '%s=%s' % (COOKIE, token)})
+
+    def test_unauthenticated(self):
+        """Without token, no request to amivapi is needed."""
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.api.count(), 0)
+
+    def test_invalid_token(self):
+        """Invalid tokens are rejected and not cached."""
+        for _ in range(2):
+            response = self._get('/', 'invalid')
+            self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.api.count('GET'), 2)
+
+    def test_login(self):
+        """Logging in sets the token cookie."""
+        response = self.client.post('/login', data={'user': 'pablo',
+                                                    'password': 'pass'})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(COOKIE, response.headers['Set-Cookie'])
+        self.assertEqual(self.api.count('POST'), 1)
+
+    def test_session_is_cached(self):
+        """Only the first request validates the session with amivapi."""
+        token = self.api.login('Pablo')
+
+        for _ in range(5):
+            response = self._get('/', token)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, b'Pablo Tester')
+
+        self.assertEqual(self.api.count('GET'), 1)
+
+    def test_session_expires(self):
+        """Expired cache entries are validated again."""
+        self.app.extensions['api_auth']['sessions'].ttl = 0
+        token = self.api.login('Pablo')
+
+        self._get('/', token)
+        self._get('/', token)
+        self.assertEqual(self.api.count('GET'), 2)
+
+    def test_logout_invalidates(self):
+        """After logout the cached session can not be used anymore."""
+        token = self.api.login('Pablo')
+        self._get('/', token)
+
+        self._get('/logout', token)
+        self.assertEqual(self.api.count('DELETE'), 1)
+
+        response = self._get('/', token)
+        self.assertEqual(response.status_code, 302)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for streamed zip archives."""
+
+from unittest import TestCase
+from io import BytesIO
+from zipfile import ZipFile
+
+from contractor.archive import stream_zip, unique_filenames
+
+
+class ArchiveTest(TestCase):
+    """Test zip creation."""
+
+    def test_stream_zip(self):
+        """The streamed parts form a valid archive."""
+        files = [('a.pdf', b'first'), ('b.pdf', b'second' * 1000)]
+        parts = list(stream_zip(iter(files)))
+
+        # One part per file and one for the central directory
+        self.assertEqual(len(parts), 3)
+
+        with ZipFile(BytesIO(b''.join(parts))) as archive:
+            self.assertEqual(archive.namelist(), ['a.pdf', 'b.pdf'])
+            self.assertEqual(archive.read('b.pdf'), b'second' * 1000)
+            self.assertIsNone(archive.testzip())
+
+    def test_lazy(self):
+        """Files are only requested when the previous one has been sent."""
+        requested = []
+
+        def files():
+            for name in ['a', 'b']:
+                requested.append(name)
+                yield (name, b'data')
+
+        parts = stream_zip(files())
+        next(parts)
+        self.assertEqual(requested, ['a'])
+
+    def test_unique_filenames(self):
+        """Duplicates get a counter."""
+        names = ['a.pdf', 'a.pdf', 'b', 'b', 'a.pdf']
+        self.assertEqual(list(unique_filenames(names)),
+                         ['a.pdf', 'a_2.pdf', 'b', 'b_2', 'a_3.pdf'])
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for generating documents from the command line.
+
+The compiler from the tests for parallel compilation is used, every company
+is a page with its id as width.
+"""
+
+from os import listdir, path, remove
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from jinja2 import DictLoader
+from jinjatex import Jinjatex
+
+from contractor.batch import (BatchGenerator, contract_options,
+                              invitation_options)
+from contractor.storage import FileCache
+from contractor.tests.test_parallel import FakeCompiler, _widths
+
+YEARLY = {'fairtitle': 'Fair', 'president': 'President',
+          'sender': 'Sender', 'days': {}, 'prices': {}}
+
+
+class BatchTest(TestCase):
+    """Test files, checkpoints and resuming."""
+
+    def setUp(self):
+        loader = DictLoader({
+            # Contract only for email, marked for splitting
+            'contract.tex':
+                "((* for data in letterdata *))"
+                "contractor-((( loop.index0 ))),((( data.id ))),"
+                "((* if not contract_only *))((( data.id ))),((* endif *))"
+                "((* endfor *))",
+            'invitation.tex':
+                "((* for data in letterdata *))"
+                "contractor-((( loop.index0 ))),((( data.id ))),"
+                "((* endfor *))",
+            'unmarked.tex':
+                "((* for data in letterdata *))((( data.id ))),"
+                "((* endfor *))",
+        })
+        self.compiler = FakeCompiler(Jinjatex(loader=loader), chunk_size=4)
+        self.letterdata = [{'id': 100 + index,
+                            'companyname': 'Company %i' % (index % 8)}
+                           for index in range(10)]
+        self._directory = TemporaryDirectory(prefix='contractor')
+        self.directory = self._directory.name
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def _generate(self, **kwargs):
+        generator = BatchGenerator(self.compiler, self.directory, YEARLY,
+                                   **kwargs)
+        generator.generate(self.letterdata, ['mail', 'email'])
+        return generator
+
+    def _read(self, *parts):
+        with open(path.join(self.directory, *parts), 'rb') as file:
+            return file.read()
+
+    def test_options(self):
+        """Output formats select the parts of the document."""
+        options = contract_options('email', [], YEARLY)
+        self.assertTrue(options['contract_only'])
+        self.assertFalse(options['letter_only'])
+        self.assertTrue(contract_options('letter', [], YEARLY)['letter_only'])
+        self.assertEqual(invitation_options(YEARLY)['fairtitle'], 'Fair')
+
+    def test_files(self):
+        """Every format has a file per company and one for all."""
+        with TemporaryDirectory(prefix='contractor') as cache:
+            self.compiler.cache = FileCache(cache)
+            generator = self._generate()
+
+        self.assertEqual(sorted(listdir(self.directory)), [
+            'checkpoint.json', 'contracts_email.pdf', 'contracts_mail.pdf',
+            'email', 'mail'])
+        # Duplicate names get a counter
+        self.assertIn('Company_1_2.pdf', listdir(path.join(self.directory,
+                                                           'email')))
+        self.assertEqual(_widths(self._read('mail', 'Company_3.pdf')),
+                         [103, 103])
+        self.assertEqual(_widths(self._read('contracts_email.pdf')),
+                         [data['id'] for data in self.letterdata])
+
+        # Chunks of four companies per format, the documents for all
+        # companies are combined from the cached company documents
+        self.assertEqual(len(self.compiler.sources), 6)
+        self.assertEqual([line.split()[0] for line in generator.report()],
+                         ['stage', 'render', 'compile', 'combine'])
+
+    def test_resume(self):
+        """Finished files are not created again."""
+        self._generate()
+        self.compiler.sources = []
+
+        generator = self._generate()
+        self.assertEqual(self.compiler.sources, [])
+        self.assertEqual(generator.skipped, 20)
+
+        # Missing files and changed companies are created again
+        remove(path.join(self.directory, 'email', 'Company_2.pdf'))
+        self.letterdata[5]['id'] = 999
+        self._generate()
+        # One company for mail, both together for email, and without cache
+        # the documents for all companies in three chunks each
+        self.assertEqual(len(self.compiler.sources), 8)
+        self.assertEqual(_widths(self._read('email', 'Company_5.pdf')),
+                         [999])
+        self.assertEqual(_widths(self._read('contracts_mail.pdf'))[10:12],
+                         [999, 999])
+
+    def test_invitations(self):
+        """Invitations are created for streamed recipients."""
+        generator = BatchGenerator(self.compiler, self.directory, YEARLY)
+        count = generator.invitations(iter(self.letterdata))
+
+        self.assertEqual(count, 10)
+        self.assertEqual(sorted(listdir(self.directory)),
+                         ['invitations', 'invitations.pdf'])
+        self.assertEqual(len(listdir(path.join(self.directory,
+                                               'invitations'))), 10)
+        self.assertEqual(_widths(self._read('invitations', 'Company_1.pdf')),
+                         [101])
+        self.assertEqual(_widths(self._read('invitations.pdf')),
+                         [data['id'] for data in self.letterdata])
+        # A tex run per chunk
+        self.assertEqual(len(self.compiler.sources), 3)
+
+    def test_invitations_unmarked(self):
+        """Without markers, every recipient is compiled on its own."""
+        generator = BatchGenerator(self.compiler, self.directory, YEARLY)
+        generator.invitations(iter(self.letterdata[:5]),
+                              template='unmarked.tex')
+        self.assertEqual(_widths(self._read('invitations', 'Company_4.pdf')),
+                         [104])
+        self.assertEqual(len(self.compiler.sources), 2 + 5)
+
+    def test_interrupted(self):
+        """The checkpoint is saved if generating fails."""
+        compile_pdf = self.compiler._compile
+
+        def fail_last_chunk(source):
+            if source.count('contractor-') == 2:
+                raise RuntimeError
+            return compile_pdf(source)
+        self.compiler._compile = fail_last_chunk
+
+        with self.assertRaises(RuntimeError):
+            self._generate(checkpoint_every=100)
+        self.assertEqual(len(listdir(path.join(self.directory, 'mail'))), 8)
+
+        self.compiler._compile = compile_pdf
+        self.compiler.sources = []
+        generator = self._generate()
+        self.assertEqual(generator.skipped, 8)
+        self.assertEqual(len(listdir(path.join(self.directory, 'mail'))), 10)
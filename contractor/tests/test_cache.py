@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the in-memory caches.
+
+The loaders are simple counters, so no CRM connection is needed.
+"""
+
+from unittest import TestCase
+from threading import Event, Thread
+from time import sleep
+
+from contractor.cache import Snapshot, TTLCache
+
+
+class Loader(object):
+    """Callable counting calls, optionally blocking until released."""
+
+    def __init__(self, block=False):
+        self.calls = 0
+        self.release = Event()
+        if not block:
+            self.release.set()
+
+    def __call__(self):
+        self.release.wait()
+        self.calls += 1
+        return self.calls
+
+
+class SnapshotTest(TestCase):
+    """Tests for the Snapshot."""
+
+    def test_first_get_loads(self):
+        """The first reader loads the value, later readers reuse it."""
+        loader = Loader()
+        snapshot = Snapshot(loader, ttl=60)
+
+        self.assertFalse(snapshot.loaded)
+        self.assertEqual(snapshot.get(), 1)
+        self.assertEqual(snapshot.get(), 1)
+        self.assertEqual(loader.calls, 1)
+        self.assertIsNotNone(snapshot.timestamp)
+
+    def test_stale_value_is_served(self):
+        """Stale values are returned immediately and refreshed later."""
+        loader = Loader()
+        snapshot = Snapshot(loader, ttl=0)
+        snapshot.get()
+
+        # Block the loader, readers must still get the old value
+        loader.release.clear()
+        self.assertEqual(snapshot.get(), 1)
+        self.assertEqual(snapshot.get(), 1)
+
+        loader.release.set()
+        for _ in range(100):
+            if snapshot.generation == 2:
+                break
+            sleep(0.01)
+        self.assertEqual(snapshot.get(), 2)
+
+    def test_refresh(self):
+        """Manual refresh reloads immediately."""
+        loader = Loader()
+        snapshot = Snapshot(loader, ttl=60)
+        snapshot.get()
+
+        self.assertEqual(snapshot.refresh(), 2)
+        self.assertEqual(snapshot.get(), 2)
+
+    def test_concurrent_refresh_is_collapsed(self):
+        """Readers waiting for a running load share its result."""
+        loader = Loader(block=True)
+        snapshot = Snapshot(loader, ttl=60)
+        results = []
+
+        threads = [Thread(target=lambda: results.append(snapshot.get()))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        loader.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(loader.calls, 1)
+
+    def test_errors_keep_old_value(self):
+        """A failing refresh keeps the previous value."""
+        values = iter([1])
+
+        def loader():
+            return next(values)
+
+        snapshot = Snapshot(loader, ttl=60)
+        snapshot.get()
+
+        with self.assertRaises(StopIteration):
+            snapshot.refresh()
+        self.assertEqual(snapshot.get(), 1)
+
+        # Errors in the background are stored
+        snapshot._refresh_quietly()
+        self.assertIsInstance(snapshot.error, StopIteration)
+
+    def test_refresher_thread(self):
+        """The refresher thread loads periodically."""
+        loader = Loader()
+        snapshot = Snapshot(loader, ttl=60)
+        snapshot.start(0.01)
+        try:
+            for _ in range(100):
+                if loader.calls >= 3:
+                    break
+                sleep(0.01)
+        finally:
+            snapshot.stop()
+
+        self.assertGreaterEqual(loader.calls, 3)
+
+    def test_seed(self):
+        """Seeded values are served immediately and refreshed."""
+        loader = Loader(block=True)
+        snapshot = Snapshot(loader, ttl=60)
+        snapshot.seed('stored')
+
+        self.assertTrue(snapshot.stale)
+        self.assertEqual(snapshot.get(), 'stored')
+
+        loader.release.set()
+        for _ in range(100):
+            if not snapshot.stale:
+                break
+            sleep(0.01)
+        self.assertEqual(snapshot.get(), 1)
+
+    def test_seed_fresh(self):
+        """Fresh seeded values are kept until the ttl has passed."""
+        loader = Loader()
+        snapshot = Snapshot(loader, ttl=60)
+        snapshot.seed('streamed', stale=False)
+
+        self.assertFalse(snapshot.stale)
+        self.assertEqual(snapshot.get(), 'streamed')
+        self.assertEqual(loader.calls, 0)
+
+    def test_subscribe(self):
+        """Subscribers receive the previous and new value of every load."""
+        snapshot = Snapshot(Loader(), ttl=60)
+        calls = []
+        snapshot.subscribe(lambda previous, value:
+                           calls.append((previous, value)))
+
+        snapshot.seed('stored')
+        snapshot.refresh()
+        snapshot.refresh()
+        self.assertEqual(calls, [(None, 'stored'), ('stored', 1), (1, 2)])
+
+
+class TTLCacheTest(TestCase):
+    """Tests for the TTLCache."""
+
+    def test_contains(self):
+        """Membership checks do not count as hits or misses."""
+        cache = TTLCache(ttl=60)
+        cache.set('key', 'value')
+        self.assertIn('key', cache)
+        self.assertNotIn('other', cache)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+        cache.ttl = 0
+        cache.set('expired', 'value')
+        self.assertNotIn('expired', cache)
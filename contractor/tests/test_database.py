@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the local company store."""
+
+import sqlite3
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from os import path
+
+from contractor.choices import BoothChoice, PacketChoice
+from contractor.database import CompanyStore
+from contractor.letterdata import LetterData
+from contractor.tests.fakes import FakeImporter, make_account
+
+
+def _company(index, booth, days, media=None, business=None, first=None,
+             country='', representative='Pablö'):
+    return LetterData(
+        id='id%s' % index,
+        companyname='Company %s' % index,
+        companyaddress='Street %s' % index,
+        companycity='1234 City',
+        companycountry=country,
+        companyrepresentative='Sr. Senior',
+        amivrepresentative=representative,
+        boothchoice=booth,
+        days=days,
+        media=media,
+        business=business,
+        first=first,
+    )
+
+
+class StoreTest(TestCase):
+    """Test saving, loading and querying companies."""
+
+    def setUp(self):
+        self._dir = TemporaryDirectory(prefix='contractor')
+        self.filename = path.join(self._dir.name, 'sub', 'companies.db')
+        self.store = CompanyStore(self.filename)
+
+        self.data = [
+            _company(0, BoothChoice.bA2, 'both', media=PacketChoice.media),
+            _company(1, BoothChoice.sB1, 'first',
+                     business=PacketChoice.business, country='Faraway'),
+            _company(2, BoothChoice.bB2, 'both', first=PacketChoice.first,
+                     representative='Other'),
+            _company(3, BoothChoice.su1, 'second'),
+        ]
+        self.errors = {'Broken Inc.': 'Missing street'}
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _ids(self, companies):
+        return [company['id'] for company in companies]
+
+    def test_empty(self):
+        """A new store has no data."""
+        self.assertIsNone(self.store.saved_at)
+        self.assertEqual(self.store.load(), ([], {}))
+
+    def test_roundtrip(self):
+        """Saved data is restored including enums and order."""
+        self.store.save(self.data, self.errors)
+
+        # Open again to check persistence
+        store = CompanyStore(self.filename)
+        self.assertIsNotNone(store.saved_at)
+        self.assertEqual(store.load(), (self.data, self.errors))
+
+    def test_no_days(self):
+        """Companies registered for neither day can be stored."""
+        crm = FakeImporter([make_account(0),
+                            make_account(99, tag1_c='0', tag2_c='0')])
+        (data, errors) = crm.sync()
+        self.assertIsNone(data[1]['days'])
+
+        self.store.save(data, errors)
+        self.assertEqual(self.store.load(), (data, errors))
+        self.assertEqual(self._ids(self.store.query(days='first')),
+                         [data[0]['id']])
+
+    def test_old_schema(self):
+        """Databases with an older schema are cleared."""
+        with sqlite3.connect(self.filename) as connection:
+            connection.execute("PRAGMA user_version = 0")
+        self.store.save(self.data, self.errors)
+
+        store = CompanyStore(self.filename)
+        self.assertIsNone(store.saved_at)
+        self.assertEqual(store.load(), ([], {}))
+
+        store.save(self.data, self.errors)
+        self.assertEqual(CompanyStore(self.filename).load(),
+                         (self.data, self.errors))
+
+    def test_save_replaces(self):
+        """Saving replaces everything."""
+        self.store.save(self.data, self.errors)
+        self.store.save(self.data[:1], {})
+        self.assertEqual(self.store.load(), (self.data[:1], {}))
+
+    def test_query(self):
+        """Filters can be combined."""
+        self.store.save(self.data, self.errors)
+        query = self.store.query
+
+        self.assertEqual(self._ids(query(size='big', days='both')),
+                         ['id0', 'id2'])
+        self.assertEqual(self._ids(query(booth='sB1')), ['id1'])
+        self.assertEqual(self._ids(query(packet='media')), ['id0'])
+        self.assertEqual(self._ids(query(packet='first', size='big')),
+                         ['id2'])
+        self.assertEqual(self._ids(query(country='Faraway')), ['id1'])
+        self.assertEqual(self._ids(query(representative='Pablö',
+                                         size='big')), ['id0'])
+        self.assertEqual(query(size='huge'), [])
+
+    def test_invalid_filters(self):
+        """Unknown filters and packets are rejected."""
+        with self.assertRaises(ValueError):
+            self.store.query(color='red')
+        with self.assertRaises(ValueError):
+            self.store.query(packet='gold')
+
+    def test_iter_query(self):
+        """Companies can be read one at a time, filters are checked first."""
+        self.store.save(self.data, self.errors)
+        companies = self.store.iter_query(size='big')
+        self.assertEqual(next(companies)['id'], 'id0')
+        self.assertEqual(self._ids(companies), ['id2'])
+
+        with self.assertRaises(ValueError):
+            self.store.iter_query(color='red')
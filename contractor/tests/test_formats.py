@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for precompiled preamble formats.
+
+A fake tex engine is used, which writes the format or pdf file along with
+the arguments it has been called with.
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from tempfile import TemporaryDirectory
+from os import chmod, path, listdir
+import sys
+
+from jinja2 import DictLoader
+from jinjatex import Error, Jinjatex
+
+from contractor.formats import FormatCache, split_preamble
+from contractor.tex import ParallelCompiler, compile_tex
+
+FAKE_ENGINE = """#!%s
+import os, sys
+args = sys.argv[1:]
+fmt = [arg for arg in args if arg.startswith('-fmt=')]
+if fmt and os.environ.get('FAKE_TEX_BROKEN_FORMAT'):
+    sys.exit(1)
+outdir = args[args.index('-output-directory') + 1]
+if '-ini' in args:
+    name = [arg for arg in args if arg.startswith('-jobname=')][0][9:]
+    with open(os.path.join(outdir, name + '.fmt'), 'w') as file:
+        file.write(open(args[-1]).read())
+else:
+    with open(os.path.join(outdir, 'temp.log'), 'w') as file:
+        file.write('log')
+    with open(os.path.join(outdir, 'temp.pdf'), 'w') as file:
+        file.write(' '.join(fmt + [os.environ.get('TEXFORMATS', '')]))
+"""
+
+SOURCE = "\\documentclass{amivletter}\n\\begin{document}\nHi\n\\end{document}"
+
+
+class FormatTest(TestCase):
+    """Test building and using formats."""
+
+    def setUp(self):
+        self._dir = TemporaryDirectory(prefix='contractor')
+        self.directory = self._dir.name
+
+        self.engine = path.join(self.directory, 'faketex')
+        with open(self.engine, 'w') as file:
+            file.write(FAKE_ENGINE % sys.executable)
+        chmod(self.engine, 0o755)
+
+        self.formats = FormatCache(path.join(self.directory, 'formats'))
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_split_preamble(self):
+        """The preamble is everything before the document."""
+        self.assertEqual(split_preamble(SOURCE),
+                         "\\documentclass{amivletter}\n")
+        self.assertIsNone(split_preamble("no document"))
+
+    def test_build(self):
+        """Formats are built once and reused."""
+        fmt = self.formats.get(SOURCE, self.engine)
+        self.assertTrue(path.exists(fmt + '.fmt'))
+        with open(fmt + '.fmt') as file:
+            self.assertTrue(file.read().startswith(split_preamble(SOURCE)))
+
+        # Same preamble, same format
+        other = SOURCE.replace('Hi', 'Bye')
+        self.assertEqual(self.formats.get(other, self.engine), fmt)
+        self.assertEqual(len(listdir(self.formats.directory)), 1)
+
+    def test_rebuild(self):
+        """A new preamble or version creates a new format."""
+        fmt = self.formats.get(SOURCE, self.engine)
+        self.assertNotEqual(self.formats.get(SOURCE, self.engine, 'v2'), fmt)
+        self.assertNotEqual(
+            self.formats.get('%' + SOURCE, self.engine), fmt)
+
+    def test_failure(self):
+        """Failed builds are not retried."""
+        self.assertIsNone(self.formats.get(SOURCE, 'does-not-exist'))
+        self.assertIsNone(self.formats.get("no document", self.engine))
+
+        fmt = self.formats.get(SOURCE, self.engine)
+        self.formats.discard(fmt)
+        self.assertIsNone(self.formats.get(SOURCE, self.engine))
+
+    def test_compile_with_format(self):
+        """The format is passed to the engine."""
+        fmt = self.formats.get(SOURCE, self.engine)
+
+        pdf = compile_tex(SOURCE, self.engine, fmt=fmt).decode()
+        self.assertIn('-fmt=%s' % path.basename(fmt), pdf)
+        self.assertIn(self.formats.directory, pdf)
+
+        self.assertEqual(compile_tex(SOURCE, self.engine).strip(), b'')
+
+    def test_compile_errors(self):
+        """Missing engines raise errors."""
+        with self.assertRaises(Error):
+            compile_tex(SOURCE, 'does-not-exist')
+
+    def test_fallback(self):
+        """If the format is broken, compile without it."""
+        tex = Jinjatex(tex_engine=self.engine,
+                       loader=DictLoader({'test.tex': SOURCE}))
+        compiler = ParallelCompiler(tex, formats=self.formats)
+
+        self.assertIn(b'-fmt=', compiler.compile_template('test.tex', []))
+
+        with patch.dict('os.environ', {'FAKE_TEX_BROKEN_FORMAT': '1'}):
+            self.assertNotIn(b'-fmt=',
+                             compiler.compile_template('test.tex', []))
+        # The broken format is not used anymore
+        self.assertNotIn(b'-fmt=', compiler.compile_template('test.tex', []))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for background jobs."""
+
+from unittest import TestCase
+from threading import Event
+
+from contractor.jobs import JobQueue
+
+
+def _wait(job):
+    """Wait until the job is finished."""
+    for _ in range(500):
+        if job.finished:
+            return
+        Event().wait(0.01)
+    raise AssertionError("Job did not finish")
+
+
+class JobTest(TestCase):
+    """Tests for submitting and deduplicating jobs."""
+
+    def test_result_and_progress(self):
+        """Jobs run in the background and report progress."""
+        queue = JobQueue()
+        release = Event()
+        reported = Event()
+
+        def task(progress):
+            progress(2)
+            reported.set()
+            release.wait()
+            return 'result'
+
+        job = queue.submit('key', 5, task)
+        reported.wait(5)
+        self.assertEqual(job.status, 'running')
+        self.assertEqual(job.as_dict()['done'], 2)
+
+        release.set()
+        _wait(job)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.result, 'result')
+        self.assertEqual(job.done, 5)
+        self.assertIs(queue.get(job.id), job)
+
+    def test_failure(self):
+        """Errors are stored in the job."""
+        def task(progress):
+            raise ValueError('broken')
+
+        job = JobQueue().submit('key', 1, task)
+        _wait(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, 'broken')
+
+    def test_deduplication(self):
+        """Identical jobs are only run once, failed jobs can be retried."""
+        queue = JobQueue()
+        calls = []
+
+        def task(progress):
+            calls.append(1)
+            if len(calls) == 1:
+                raise ValueError('broken')
+
+        failed = queue.submit('key', 1, task)
+        _wait(failed)
+        job = queue.submit('key', 1, task)
+        self.assertIsNot(job, failed)
+        _wait(job)
+
+        self.assertIs(queue.submit('key', 1, task), job)
+        self.assertIsNot(queue.submit('other', 1, task), job)
+        _wait(queue.submit('other', 1, task))
+        self.assertEqual(len(calls), 3)
+
+    def test_unavailable_result(self):
+        """Jobs are started again if their result is gone."""
+        results = {'first'}
+        queue = JobQueue(available=results.__contains__)
+        job = queue.submit('key', 1, lambda progress: 'first')
+        _wait(job)
+        self.assertIs(queue.submit('key', 1, lambda progress: 'second'), job)
+
+        results.clear()
+        again = queue.submit('key', 1, lambda progress: 'second')
+        self.assertIsNot(again, job)
+        _wait(again)
+        self.assertEqual(again.result, 'second')
+        self.assertIsNone(queue.get(job.id))
+
+    def test_retention(self):
+        """Finished jobs are removed after the retention time."""
+        queue = JobQueue(retention=0)
+        job = queue.submit('key', 1, lambda progress: None)
+        _wait(job)
+
+        queue.submit('other', 1, lambda progress: None)
+        self.assertIsNone(queue.get(job.id))
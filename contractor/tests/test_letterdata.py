@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for parsing CRM accounts into letterdata."""
+
+from unittest import TestCase
+
+from contractor.choices import BoothChoice, PacketChoice
+from contractor.letterdata import LetterData
+from contractor.soapclient import parse_account, parse_accounts
+from contractor.tests.fakes import make_account
+
+
+class ParseTest(TestCase):
+    """Test the table-driven parser."""
+
+    def test_fields(self):
+        """All fields are converted."""
+        data = parse_account(make_account(5))
+
+        self.assertIsInstance(data, LetterData)
+        self.assertEqual(data.id, 'account-00005')
+        self.assertEqual(data.companyname, 'Company 00005')
+        self.assertEqual(data.companyaddress, 'Teststrüüt 5')
+        self.assertEqual(data.companycity, '1005 Testingtàn')
+        self.assertEqual(data.companycountry, 'Faraway')
+        self.assertEqual(data.companyrepresentative, 'Sr.Senior')
+        self.assertEqual(data.amivrepresentative, 'Pablö')
+        self.assertEqual(data.boothchoice, BoothChoice.bB1)
+        self.assertEqual(data.days, 'second')
+        self.assertEqual(data.media, PacketChoice.media)
+        self.assertEqual(data.business, None)
+        self.assertEqual(data.first, PacketChoice.first)
+
+    def test_choices(self):
+        """Booths, days, packets and countries are looked up."""
+        cases = [
+            (dict(tischgroesse_c='kein', kategorie_c='katC', tag1_c='1',
+                  tag2_c='0'), BoothChoice.su1, 'first'),
+            (dict(tischgroesse_c='ein', kategorie_c='katA', tag1_c='0',
+                  tag2_c='1'), BoothChoice.sA1, 'second'),
+            (dict(tischgroesse_c='zwei', kategorie_c='katB', tag1_c='1',
+                  tag2_c='1'), BoothChoice.bB2, 'both'),
+        ]
+        for (fields, booth, days) in cases:
+            data = parse_account(make_account(0, **fields))
+            self.assertEqual((data.boothchoice, data.days), (booth, days))
+
+        data = parse_account(make_account(
+            0, packet_c='business', mediapaket_c=None,
+            shipping_address_country='Schweiz'))
+        self.assertEqual((data.media, data.business, data.first),
+                         (None, PacketChoice.business, None))
+        self.assertEqual(data.companycountry, '')
+
+    def test_errors(self):
+        """Invalid accounts raise errors."""
+        broken = [
+            dict(shipping_address_city=None),
+            dict(tischgroesse_c='drei'),
+            dict(kategorie_c='katZ'),
+            dict(tischgroesse_c='kein', kategorie_c='katA'),
+            dict(kontaktinfo_c=None),
+        ]
+        for fields in broken:
+            with self.assertRaises(Exception):
+                parse_account(make_account(0, **fields))
+
+    def test_batch(self):
+        """Batches keep their order and collect errors."""
+        accounts = [make_account(index) for index in range(5)]
+        accounts[2]['tischgroesse_c'] = 'drei'
+
+        results = parse_accounts(accounts)
+        self.assertEqual([account for (account, _, _) in results], accounts)
+        self.assertEqual([data is None for (_, data, _) in results],
+                         [False, False, True, False, False])
+        self.assertEqual(results[2][2],
+                         "Unrecognized value for 'tischgroesse_c': drei")
+
+
+class LetterDataTest(TestCase):
+    """Test the record type."""
+
+    def setUp(self):
+        self.data = parse_account(make_account(1))
+
+    def test_slots(self):
+        """Records have no dict and no other attributes."""
+        self.assertFalse(hasattr(self.data, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.data.color = 'red'
+
+    def test_mapping(self):
+        """Records can be used like a dict."""
+        self.assertEqual(self.data['companyname'], self.data.companyname)
+        self.assertEqual(dict(self.data), self.data.as_dict())
+        self.assertEqual(LetterData(**dict(self.data)), self.data)
+        with self.assertRaises(KeyError):
+            self.data['color']
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for collecting and exporting metrics."""
+
+from unittest import TestCase
+
+from flask import Flask
+
+from contractor.metrics import Histogram, Metrics
+
+
+class MetricsTest(TestCase):
+    """Test counters, histograms, timers and the text format."""
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_histogram(self):
+        """Buckets are cumulative, bounds are inclusive."""
+        histogram = Histogram(buckets=(1, 2))
+        for value in [0.5, 1, 1.5, 3]:
+            histogram.observe(value)
+
+        self.assertEqual(list(histogram.samples()), [
+            ('_bucket', (('le', '1'),), 2),
+            ('_bucket', (('le', '2'),), 3),
+            ('_bucket', (('le', '+Inf'),), 4),
+            ('_sum', (), 6.0),
+            ('_count', (), 4),
+        ])
+
+    def test_counters(self):
+        """Counters are increased per label."""
+        self.metrics.count('contractor_cache_hits_total', cache='pdf')
+        self.metrics.count('contractor_cache_hits_total', 2, cache='pdf')
+        self.metrics.count('contractor_cache_hits_total', cache='other')
+
+        self.assertEqual(
+            self.metrics.get('contractor_cache_hits_total', cache='pdf'), 3)
+        self.assertIsNone(self.metrics.get('contractor_crm_errors_total'))
+
+    def test_render(self):
+        """Metrics are rendered in the Prometheus text format."""
+        self.metrics.count('contractor_crm_errors_total')
+        self.metrics.set('custom', 5, label='a "quoted"\nvalue')
+        self.metrics.observe('contractor_stage_seconds', 0.3, stage='crm')
+
+        lines = self.metrics.render().splitlines()
+        self.assertIn('# TYPE contractor_crm_errors_total counter', lines)
+        self.assertIn('contractor_crm_errors_total 1', lines)
+        self.assertIn('# TYPE custom untyped', lines)
+        self.assertIn('custom{label="a \\"quoted\\"\\nvalue"} 5', lines)
+        self.assertIn('# TYPE contractor_stage_seconds histogram', lines)
+        self.assertIn('contractor_stage_seconds_bucket'
+                      '{stage="crm",le="0.25"} 0', lines)
+        self.assertIn('contractor_stage_seconds_bucket'
+                      '{stage="crm",le="0.5"} 1', lines)
+        self.assertIn('contractor_stage_seconds_count{stage="crm"} 1', lines)
+
+    def test_timer(self):
+        """Timers are recorded and added to the breakdown of requests."""
+        with self.metrics.timer('outside'):
+            pass
+        self.assertEqual(self.metrics.breakdown(), [])
+
+        with Flask('test').test_request_context():
+            for stage in ['auth', 'crm', 'auth']:
+                with self.metrics.timer(stage):
+                    pass
+            self.assertEqual([stage for (stage, _) in
+                              self.metrics.breakdown()], ['auth', 'crm'])
+
+        self.assertEqual(self.metrics.get('contractor_stage_seconds',
+                                          stage='auth').count, 2)
+        self.assertEqual(self.metrics.get('contractor_stage_seconds',
+                                          stage='outside').count, 1)
+
+    def test_timer_errors(self):
+        """Stages are timed even if they fail."""
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('failing'):
+                raise ValueError
+        self.assertEqual(self.metrics.get('contractor_stage_seconds',
+                                          stage='failing').count, 1)
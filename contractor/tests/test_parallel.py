@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for parallel compilation in chunks.
+
+Instead of xelatex, a fake compiler creates a blank page per company. The
+width of the page is the company id, so we can check the order of pages.
+Markers (`contractor-<index>`) become named destinations of the next page.
+"""
+
+from unittest import TestCase
+from io import BytesIO
+from os import path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from jinja2 import DictLoader
+from jinjatex import Jinjatex
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.generic import TextStringObject
+
+from contractor.tex import (MARKER, ParallelCompiler, chunks, concat_pdfs,
+                            iter_chunks, merge_pdfs, splice_pdfs, split_pdf)
+from contractor.storage import FileCache
+
+
+def _pdf(widths, markers=None):
+    """Create a pdf with one blank page per width.
+
+    markers is an optional dict of named destinations {name: page}.
+    """
+    writer = PdfFileWriter()
+    for width in widths:
+        writer.addBlankPage(width=width, height=100)
+    for (name, page) in (markers or {}).items():
+        writer.addNamedDestination(TextStringObject(name), page)
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def _widths(pdf):
+    """Return the widths of all pages."""
+    reader = PdfFileReader(BytesIO(pdf))
+    return [int(page.mediaBox.getWidth()) for page in reader.pages]
+
+
+class FakeCompiler(ParallelCompiler):
+    """Compile 'documents' which are just comma separated widths."""
+
+    def __init__(self, *args, **kwargs):
+        super(FakeCompiler, self).__init__(*args, **kwargs)
+        self.sources = []
+        self.drafts = []
+
+    def _compile(self, source, draft=False):
+        self.sources.append(source)
+        self.drafts.append(draft)
+        (widths, markers) = ([], {})
+        for item in source.split(','):
+            if item.startswith(MARKER):
+                markers[item] = len(widths)
+            elif item:
+                widths.append(int(item))
+        return _pdf(widths, markers)
+
+
+class ParallelTest(TestCase):
+    """Tests for the parallel compiler."""
+
+    def setUp(self):
+        loader = DictLoader({
+            'test.tex': "((* for data in letterdata *))"
+                        "((( data.id ))),((* endfor *))",
+            # Two pages per company
+            'pages.tex': "((* for data in letterdata *))"
+                         "((( data.id ))),((( data.id ))),((* endfor *))",
+            # Two pages per company, the first one marked
+            'split.tex': "((* for data in letterdata *))"
+                         "contractor-((( loop.index0 ))),"
+                         "((( data.id ))),((( data.id ))),((* endfor *))",
+        })
+        self.tex = Jinjatex(loader=loader)
+        self.letterdata = [{'id': 100 + index} for index in range(25)]
+
+    def test_chunks(self):
+        """Chunks keep order and have at most the given size."""
+        self.assertEqual(chunks([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+        self.assertEqual(chunks([], 2), [])
+        self.assertEqual(list(iter_chunks(iter([1, 2, 3, 4, 5]), 2)),
+                         [[1, 2], [3, 4], [5]])
+
+    def test_merge(self):
+        """Merged pdf contains all pages in order."""
+        merged = merge_pdfs([_pdf([100, 101]), _pdf([102])])
+        self.assertEqual(_widths(merged), [100, 101, 102])
+
+    def test_concat(self):
+        """Pdf files are combined one after another."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            filenames = []
+            for widths in [[100, 101], [102], [103, 104]]:
+                filenames.append(path.join(directory, '%s.pdf' % widths[0]))
+                with open(filenames[-1], 'wb') as file:
+                    file.write(_pdf(widths, {'contractor-0': 0}))
+
+            output = BytesIO()
+            concat_pdfs(filenames, output)
+        self.assertEqual(_widths(output.getvalue()),
+                         [100, 101, 102, 103, 104])
+
+    def test_splice(self):
+        """Page ranges of several pdfs are combined."""
+        first = _pdf([100, 101, 102])
+        spliced = splice_pdfs([(first, 1, 2), (_pdf([200]), 0, 1),
+                               (first, 0, 1)])
+        self.assertEqual(_widths(spliced), [101, 102, 200, 100])
+
+    def test_split(self):
+        """Pdfs are split at the marked pages."""
+        pdf = _pdf([100, 101, 102, 103], {'contractor-0': 0,
+                                          'contractor-1': 1,
+                                          'contractor-2': 3})
+        self.assertEqual([_widths(part) for part in split_pdf(pdf, 3)],
+                         [[100], [101, 102], [103]])
+
+        # Missing or wrong markers
+        self.assertIsNone(split_pdf(pdf, 4))
+        self.assertIsNone(split_pdf(_pdf([100, 101]), 2))
+        self.assertIsNone(split_pdf(_pdf([100, 101], {'contractor-0': 1,
+                                                      'contractor-1': 1}),
+                                    2))
+
+    def test_compile_stream(self):
+        """Records are only read as needed, chunks are yielded in order."""
+        compiler = FakeCompiler(self.tex, workers=2, chunk_size=4)
+        read = []
+
+        def _records():
+            for data in self.letterdata:
+                read.append(data)
+                yield data
+
+        chunks = compiler.compile_stream('test.tex', _records())
+        (chunk, pdf) = next(chunks)
+        self.assertEqual(chunk, self.letterdata[:4])
+        self.assertEqual(_widths(pdf), [data['id'] for data in chunk])
+        # Only a chunk per worker is compiled ahead
+        self.assertLessEqual(len(read), 12)
+
+        self.assertEqual(sum(len(chunk) for (chunk, _) in chunks), 21)
+
+    def test_compile_in_chunks(self):
+        """All companies are compiled in order."""
+        compiler = FakeCompiler(self.tex, workers=4, chunk_size=4)
+        pdf = compiler.compile_template('test.tex', self.letterdata)
+
+        self.assertEqual(len(compiler.sources), 7)
+        self.assertEqual(_widths(pdf), [data['id'] for data in
+                                        self.letterdata])
+
+    def test_same_as_serial(self):
+        """The result has the same pages as a single document."""
+        serial = FakeCompiler(self.tex, workers=1,
+                              chunk_size=len(self.letterdata))
+        parallel = FakeCompiler(self.tex, workers=3, chunk_size=2)
+
+        self.assertEqual(
+            _widths(serial.compile_template('test.tex', self.letterdata)),
+            _widths(parallel.compile_template('test.tex', self.letterdata)))
+        self.assertEqual(len(serial.sources), 1)
+
+    def test_empty(self):
+        """Without companies a single document is compiled."""
+        compiler = FakeCompiler(self.tex, chunk_size=4)
+        compiler.compile_template('test.tex', [])
+        self.assertEqual(compiler.sources, [''])
+
+    def test_cache(self):
+        """Unchanged documents and chunks are not compiled again."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, chunk_size=10,
+                                    cache=FileCache(directory))
+
+            first = compiler.compile_template('test.tex', self.letterdata)
+            self.assertEqual(len(compiler.sources), 3)
+
+            # Everything cached
+            second = compiler.compile_template('test.tex', self.letterdata)
+            self.assertEqual(len(compiler.sources), 3)
+            self.assertEqual(first, second)
+
+            # Only the changed chunk is compiled
+            self.letterdata[-1]['id'] = 999
+            compiler.compile_template('test.tex', self.letterdata)
+            self.assertEqual(len(compiler.sources), 4)
+
+    def test_preview(self):
+        """Previews show the first page of a draft, cached by variables."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, cache=FileCache(directory))
+            letterdata = self.letterdata[:3]
+
+            # Without pdftoppm, the first page is sent as pdf
+            with patch('contractor.tex.rasterize', return_value=None):
+                page = compiler.preview('test.tex', letterdata=letterdata)
+            self.assertEqual(_widths(page), [100])
+            self.assertEqual(compiler.drafts, [True])
+
+            with patch('contractor.tex.rasterize') as rasterize:
+                self.assertEqual(compiler.preview(
+                    'test.tex', letterdata=letterdata), page)
+                self.assertFalse(rasterize.called)
+
+                # Other variables or resolutions are new previews
+                rasterize.return_value = b'\x89PNG'
+                self.assertEqual(compiler.preview(
+                    'test.tex', 120, letterdata=letterdata), b'\x89PNG')
+                self.assertEqual(rasterize.call_args[0][1], 120)
+                compiler.preview('test.tex', letterdata=letterdata[1:])
+            self.assertEqual(len(compiler.sources), 3)
+
+    def test_compile_each(self):
+        """Every company gets its own document, in order."""
+        compiler = FakeCompiler(self.tex, workers=3)
+        results = list(compiler.compile_each('test.tex', self.letterdata))
+
+        self.assertEqual([data for (data, _) in results], self.letterdata)
+        for (data, pdf) in results:
+            self.assertEqual(_widths(pdf), [data['id']])
+
+    def test_compile_each_schedule(self):
+        """Every chunk is compiled through the schedule function."""
+        compiler = FakeCompiler(self.tex, workers=2, chunk_size=10)
+        parts = []
+
+        def _schedule(part, compile_part):
+            parts.append(len(part))
+            return compile_part()
+
+        results = list(compiler.compile_each('split.tex', self.letterdata,
+                                             schedule=_schedule))
+        self.assertEqual(sorted(parts), [5, 10, 10])
+        self.assertEqual([data for (data, _) in results], self.letterdata)
+
+    def test_compile_each_split(self):
+        """Chunks are compiled once and split into company documents."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, workers=2, chunk_size=10,
+                                    cache=FileCache(directory))
+            results = list(compiler.compile_each('split.tex',
+                                                 self.letterdata))
+            self.assertEqual(len(compiler.sources), 3)
+            self.assertEqual([data for (data, _) in results], self.letterdata)
+            for (data, pdf) in results:
+                self.assertEqual(_widths(pdf), [data['id']] * 2)
+
+            # Company documents are cached, e.g. for single contracts
+            compiler.sources = []
+            self.letterdata[3]['id'] = 999
+            list(compiler.compile_each('split.tex', self.letterdata))
+            compiler.compile_bulk('split.tex', self.letterdata)
+            self.assertEqual(len(compiler.sources), 1)
+
+    def test_bulk(self):
+        """Only new and changed companies are compiled again."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, workers=3,
+                                    cache=FileCache(directory))
+
+            def _compile():
+                pdf = compiler.compile_bulk('pages.tex', self.letterdata)
+                self.assertEqual(_widths(pdf), [
+                    data['id'] for data in self.letterdata for _ in 'xx'])
+
+            _compile()
+            self.assertEqual(len(compiler.sources), 25)
+
+            # Change one company, insert one, remove one and reorder
+            self.letterdata[3]['id'] = 999
+            self.letterdata.insert(10, {'id': 500})
+            del self.letterdata[0]
+            self.letterdata.reverse()
+            compiler.sources = []
+            _compile()
+            self.assertEqual(sorted(compiler.sources),
+                             ['500,500,', '999,999,'])
+
+            # Everything cached
+            compiler.sources = []
+            _compile()
+            self.assertEqual(compiler.sources, [])
+
+    def test_bulk_split(self):
+        """Missing companies are compiled in chunks and split."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, chunk_size=10,
+                                    cache=FileCache(directory))
+            finished = []
+
+            def _compile():
+                pdf = compiler.compile_bulk('split.tex', self.letterdata,
+                                            progress=finished.append)
+                self.assertEqual(_widths(pdf), [
+                    data['id'] for data in self.letterdata for _ in 'xx'])
+
+            _compile()
+            self.assertEqual(len(compiler.sources), 3)
+            self.assertEqual(sum(finished), 25)
+
+            # Page ranges of the split documents are reused
+            self.letterdata[3]['id'] = 999
+            self.letterdata.insert(10, {'id': 500})
+            compiler.sources = []
+            _compile()
+            self.assertEqual(len(compiler.sources), 1)
+
+    def test_stored(self):
+        """Documents can be returned as cache key without reading them."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            cache = FileCache(directory)
+            compiler = FakeCompiler(self.tex, chunk_size=10, cache=cache)
+
+            for compile_pdf in [compiler.compile_template,
+                                compiler.compile_bulk]:
+                for letterdata in [self.letterdata[:1], self.letterdata]:
+                    key = compile_pdf('test.tex', letterdata, stored=True)
+                    with open(cache.path(key), 'rb') as file:
+                        self.assertEqual(
+                            file.read(), compile_pdf('test.tex', letterdata))
+                    # Cached already
+                    self.assertEqual(
+                        compile_pdf('test.tex', letterdata, stored=True), key)
+
+    def test_bulk_options(self):
+        """Compiled companies are shared by documents with other options."""
+        with TemporaryDirectory(prefix='contractor') as directory:
+            compiler = FakeCompiler(self.tex, cache=FileCache(directory))
+            compiler.compile_bulk('test.tex', self.letterdata)
+            compiler.compile_bulk('test.tex', self.letterdata[1:],
+                                  other='option')
+            self.assertEqual(len(compiler.sources), 25)
+
+    def test_bulk_without_cache(self):
+        """Without cache, chunks are compiled."""
+        compiler = FakeCompiler(self.tex, chunk_size=10)
+        pdf = compiler.compile_bulk('test.tex', self.letterdata)
+        self.assertEqual(len(compiler.sources), 3)
+        self.assertEqual(_widths(pdf), [data['id'] for data in
+                                        self.letterdata])
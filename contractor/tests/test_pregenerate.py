@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for compiling in the background.
+
+Tasks only record their calls, nothing is compiled.
+"""
+
+from unittest import TestCase
+from threading import Event
+
+from contractor.metrics import METRICS
+from contractor.pregenerate import Pregenerator
+
+
+class PregeneratorTest(TestCase):
+    """Test stages, cancellation and waiting while the app is busy."""
+
+    def setUp(self):
+        self.calls = []
+        self.pregenerator = Pregenerator(workers=2, poll=0.01)
+
+    def tearDown(self):
+        self.pregenerator.close()
+
+    def _task(self, name, block=None, finished=None):
+        def _run(check):
+            if block is not None:
+                block.wait(5)
+            check(1)
+            self.calls.append(name)
+            if finished is not None:
+                finished.set()
+        return _run
+
+    def test_stages(self):
+        """Stages run one after another."""
+        (release, fast) = (Event(), Event())
+        done = self.pregenerator.schedule([
+            [self._task('slow', release), self._task('fast', finished=fast)],
+            [self._task('last')],
+        ])
+        # The second stage waits for the slow task
+        fast.wait(5)
+        self.assertFalse(done.done())
+        release.set()
+        done.result(5)
+        self.assertEqual(self.calls, ['fast', 'slow', 'last'])
+
+    def test_cancel(self):
+        """Scheduling again cancels running and pending tasks."""
+        release = Event()
+        before = METRICS.get('contractor_pregenerated_total',
+                             result='cancelled') or 0
+
+        first = self.pregenerator.schedule([
+            [self._task('running', release)],
+            [self._task('pending')],
+        ])
+        second = self.pregenerator.schedule([[self._task('new')]])
+        release.set()
+        first.result(5)
+        second.result(5)
+
+        self.assertEqual(self.calls, ['new'])
+        self.assertEqual(METRICS.get('contractor_pregenerated_total',
+                                     result='cancelled'), before + 1)
+
+    def test_busy(self):
+        """Tasks wait while the app is busy."""
+        busy = Event()
+        busy.set()
+        self.pregenerator.busy = busy.is_set
+
+        done = self.pregenerator.schedule([[self._task('task')]])
+        self.assertFalse(done.done())
+        self.assertEqual(self.calls, [])
+
+        busy.clear()
+        done.result(5)
+        self.assertEqual(self.calls, ['task'])
+
+    def test_errors(self):
+        """Failing tasks do not stop other tasks."""
+        def fail(check):
+            raise ValueError
+
+        self.pregenerator.schedule([[fail], [self._task('next')]]).result(5)
+        self.assertEqual(self.calls, ['next'])
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for limiting, prioritizing and sharing compilations.
+
+Compilations are replaced by functions waiting for events.
+"""
+
+from concurrent.futures import CancelledError
+from threading import Event, Thread
+from time import sleep
+from unittest import TestCase
+
+from contractor.scheduler import (CompileScheduler, Overloaded, PREVIEW,
+                                  BULK, BACKGROUND)
+
+
+class CompileSchedulerTest(TestCase):
+    """Test the scheduler with blocking functions."""
+
+    def setUp(self):
+        self.scheduler = CompileScheduler(concurrency=1, queue_size=2,
+                                          retry_after=5)
+        self.calls = []
+        self.results = {}
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join(5)
+
+    def _function(self, name, release=None):
+        def _compile():
+            self.calls.append(name)
+            if release is not None:
+                release.wait(5)
+            return name
+        return _compile
+
+    def _start(self, key, function, **kwargs):
+        """Run in a thread, store the result (or error) by thread index."""
+        index = len(self.threads)
+
+        def _run():
+            try:
+                self.results[index] = self.scheduler.run(key, function,
+                                                         **kwargs)
+            except Exception as error:
+                self.results[index] = error
+        thread = Thread(target=_run)
+        thread.start()
+        self.threads.append(thread)
+
+    def _wait_for(self, condition):
+        for _ in range(500):
+            if condition():
+                return
+            sleep(0.01)
+        self.fail("Timeout")
+
+    def test_run(self):
+        """Results are returned, slots are free afterwards."""
+        self.assertEqual(self.scheduler.run('a', self._function('a')), 'a')
+        self.assertEqual(self.scheduler.running, 0)
+        self.assertEqual(self.scheduler.waiting, 0)
+
+    def test_shared(self):
+        """Identical compilations run once, all callers get the result."""
+        release = Event()
+        for _ in range(3):
+            self._start('key', self._function('first', release))
+        self._wait_for(lambda: self.calls)
+        release.set()
+        self.tearDown()
+
+        self.assertEqual(self.calls, ['first'])
+        self.assertEqual(list(self.results.values()), ['first'] * 3)
+
+    def test_shared_errors(self):
+        """Errors are raised for all callers."""
+        release = Event()
+
+        def fail():
+            release.wait(5)
+            raise ValueError('broken')
+
+        self._start('key', fail)
+        self._wait_for(lambda: self.scheduler.running)
+        self._start('key', self._function('never'))
+        sleep(0.05)
+        release.set()
+        self.tearDown()
+
+        self.assertEqual(self.calls, [])
+        self.assertTrue(all(isinstance(result, ValueError)
+                            for result in self.results.values()))
+        self.assertEqual(len(self.results), 2)
+
+    def test_cancelled(self):
+        """Callers sharing a cancelled compilation run their own."""
+        release = Event()
+
+        def cancel():
+            release.wait(5)
+            raise CancelledError
+
+        self._start('key', cancel, priority=BACKGROUND)
+        self._wait_for(lambda: self.scheduler.running)
+        self._start('key', self._function('own'))
+        sleep(0.05)
+        release.set()
+        self.tearDown()
+
+        self.assertEqual(self.calls, ['own'])
+        self.assertIsInstance(self.results[0], CancelledError)
+        self.assertEqual(self.results[1], 'own')
+        self.assertEqual(self.scheduler._flights, {})
+
+    def test_limit(self):
+        """Compilations wait for a slot, and are rejected if too many wait.
+        """
+        release = Event()
+        self._start('running', self._function('running', release))
+        self._wait_for(lambda: self.scheduler.running)
+        self._start('a', self._function('a'))
+        self._start('b', self._function('b'))
+        self._wait_for(lambda: self.scheduler.waiting == 2)
+        self.assertEqual(self.calls, ['running'])
+
+        with self.assertRaises(Overloaded) as context:
+            self.scheduler.run('c', self._function('c'))
+        self.assertEqual(context.exception.retry_after, 5)
+
+        # Identical requests and background work are not rejected
+        self._start('a', self._function('a'))
+        self._start('d', self._function('d'), reject=False)
+        self._wait_for(lambda: self.scheduler.waiting == 3)
+
+        release.set()
+        self.tearDown()
+        self.assertEqual(self.calls, ['running', 'a', 'b', 'd'])
+        self.assertEqual([self.results[index] for index in range(5)],
+                         ['running', 'a', 'b', 'a', 'd'])
+
+    def test_free_slots_are_used(self):
+        """All waiting compilations start if several slots are free."""
+        self.scheduler.concurrency = 2
+        self.scheduler.queue_size = 10
+        release = Event()
+        for name in ['running', 'running2']:
+            self._start(name, self._function(name, release))
+        self._wait_for(lambda: self.scheduler.running == 2)
+
+        started = Event()
+        both = Event()
+        together = []
+
+        def _wait_for_both(name):
+            def _compile():
+                if started.is_set():
+                    both.set()
+                started.set()
+                together.append(both.wait(1))
+                return name
+            return _compile
+
+        for name in ['a', 'b']:
+            self._start(name, _wait_for_both(name))
+        self._wait_for(lambda: self.scheduler.waiting == 2)
+        release.set()
+        self.tearDown()
+
+        # a and b wait for each other, so both need a slot at once
+        self.assertEqual(together, [True, True])
+
+    def test_priority(self):
+        """Previews start before bulk documents and background work."""
+        self.scheduler.queue_size = 10
+        release = Event()
+        self._start('running', self._function('running', release))
+        self._wait_for(lambda: self.scheduler.running)
+        for (name, priority) in [('background', BACKGROUND), ('bulk', BULK),
+                                 ('preview', PREVIEW), ('bulk2', BULK)]:
+            self._start(name, self._function(name), priority=priority)
+            self._wait_for(lambda: name in self.scheduler._flights)
+
+        release.set()
+        self.tearDown()
+        self.assertEqual(self.calls, ['running', 'preview', 'bulk', 'bulk2',
+                                      'background'])
+
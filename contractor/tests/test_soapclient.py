@@ -1,45 +1,141 @@
 # -*- coding: utf-8 -*-
 
-"""Simple tests to check basic functionality of the CRM connection.
+"""Simple tests to check basic functionality of the CRM import.
 
-We have no way of verifying imported data, but we will assert all we can:
+The CRM is replaced by `FakeSOAPClient`, so the tests run offline. We assert:
 
-* Are the necessary config values set?
-* Can the connector establish a connection?
-* Can the import be done without crashing? Are some companies imported?
+* Can the import be done without crashing? Are all companies imported?
+* Are broken accounts reported as errors?
+* Are failing CRM requests retried and counted?
+* Is the CRM only contacted when needed? Are sessions reused?
+* Are companies yielded page by page?
 """
 
+from threading import Thread
 from unittest import TestCase
-from app import app
-from contractor.soapclient import CRMImporter
 
+from suds import WebFault
 
-class CRMTest(TestCase):
-    """CRM test class."""
+from contractor.metrics import METRICS
+from contractor.letterdata import LetterData
+from contractor.soapclient import INVALID_SESSION, Importer, _session_expired
+from contractor.tests.fakes import FakeImporter, _Result, make_account
 
-    def test_config(self):
-        """Check app config."""
-        self.assertIn('SOAP_URL', app.config)
-        self.assertIn('SOAP_APPNAME', app.config)
-        self.assertIn('SOAP_USERNAME', app.config)
-        self.assertIn('SOAP_PASSWORD', app.config)
 
-    def test_soap_server_reachable(self):
-        """Try to create a connector.
+class CRMTest(TestCase):
+    """CRM test class."""
 
-        Raises exception if server is not available.
-        """
-        CRMImporter(app)
+    def setUp(self):
+        self.crm = FakeImporter([make_account(index) for index in range(20)])
 
     def test_import(self):
         """Call the import function.
 
-        Check if anything is imported.
+        Check if everything is imported, ordered by name.
         """
-        conn = CRMImporter(app)
+        (data, errors) = self.crm.get_companies()
+
+        self.assertEqual(len(data), 20)
+        self.assertEqual(errors, {})
+        self.assertTrue(all(isinstance(item, LetterData) for item in data))
+        names = [item.companyname for item in data]
+        self.assertEqual(names, sorted(names))
+
+    def test_import_errors(self):
+        """Broken accounts are skipped and reported by name."""
+        broken = make_account(20, shipping_address_street=None)
+        self.crm.accounts[broken['id']] = broken
+
+        (data, errors) = self.crm.get_companies()
+        self.assertEqual(len(data), 20)
+        self.assertEqual(list(errors), [broken['name']])
+        self.assertIn('shipping_address_street', errors[broken['name']])
+
+    def test_single_company(self):
+        """A single company can be imported by id."""
+        company = self.crm.get_company('account-00003')
+        self.assertEqual(company.companyname, 'Company 00003')
+
+    def test_crm_errors(self):
+        """Failing requests are retried, then raised and counted."""
+        self.crm.retries = 2
+        self.crm.client.failures = [ConnectionError()] * 3
+
+        before = METRICS.get('contractor_crm_errors_total') or 0
+        with self.assertRaises(ConnectionError):
+            self.crm.get_companies()
+        self.assertEqual(METRICS.get('contractor_crm_errors_total'),
+                         before + 1)
+
+        # Temporary failures are retried
+        self.crm.client.failures = [ConnectionError()] * 2
+        self.assertEqual(len(self.crm.get_companies()[0]), 20)
+
+    def test_lazy_connection(self):
+        """The CRM is only contacted when needed."""
+        # Nothing is listening, creating the importer works anyway
+        crm = Importer('user', 'password', url='http://localhost:1/wsdl',
+                       retries=0)
+        with self.assertRaises(Exception):
+            crm.get_company('account-00003')
+
+        crm = FakeImporter([make_account(0)])
+        self.assertIsNone(crm._client)
+        crm.get_company('account-00000')
+        self.assertIsNotNone(crm._client)
+
+    def test_sessions(self):
+        """Sessions are reused, and replaced if they expire."""
+        for _ in range(3):
+            self.crm.get_company('account-00003')
+        self.assertEqual(self.crm.client.logins, 1)
+
+        self.crm.client.expire_sessions()
+        self.crm.get_company('account-00003')
+        self.assertEqual(self.crm.client.logins, 2)
+
+    def test_session_fault(self):
+        """Only the invalid session fault of the CRM is an expired session."""
+        expired = WebFault(_Result(faultcode=INVALID_SESSION,
+                                   faultstring='Invalid Session ID'), None)
+        other = WebFault(_Result(faultcode='40',
+                                 faultstring='Session storage is full'), None)
+        self.assertTrue(_session_expired(expired))
+        self.assertFalse(_session_expired(other))
+        self.assertFalse(_session_expired(Exception('Invalid Session ID')))
+
+    def test_concurrent_sessions(self):
+        """Concurrent requests use separate sessions, up to a limit."""
+        crm = FakeImporter([make_account(0)], latency=0.05, sessions=2)
+        threads = [Thread(target=crm.get_company, args=('account-00000',))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(crm.client.logins, 2)
+
+    def test_iter_companies(self):
+        """Companies and errors are yielded as pages arrive."""
+        broken = make_account(20, shipping_address_street=None)
+        self.crm.accounts[broken['id']] = broken
+        pages = []
+        get_pages = self.crm.get_pages
+
+        def record_pages(*args, **kwargs):
+            for page in get_pages(*args, **kwargs):
+                pages.append(len(page))
+                yield page
+        self.crm.get_pages = record_pages
 
-        # Import
-        conn.refresh()
+        companies = self.crm.iter_companies(page_size=8)
+        (_, first, error) = next(companies)
+        self.assertEqual(first.companyname, 'Company 00000')
+        self.assertIsNone(error)
+        # Only the first page has been requested so far
+        self.assertEqual(pages, [8])
 
-        # Check something was imported
-        self.assertTrue(len(conn.data) > 0)
+        results = list(companies)
+        self.assertEqual(pages, [8, 8, 5])
+        self.assertEqual([company['name'] for (company, _, error)
+                          in results if error is not None], ['Company 00020'])
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the file cache and sending stored files."""
+
+from hashlib import sha256
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+from os import listdir, utime
+
+from flask import Flask
+
+from contractor.storage import (FileCache, file_digest, file_response,
+                                make_key)
+
+
+class FileCacheTest(TestCase):
+    """Tests for storing, retrieving and evicting files."""
+
+    def setUp(self):
+        self._dir = TemporaryDirectory(prefix='contractor')
+        self.directory = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_make_key(self):
+        """Keys are deterministic and distinguish part boundaries."""
+        self.assertEqual(make_key('a', b'b'), make_key(b'a', 'b'))
+        self.assertNotEqual(make_key('ab', 'c'), make_key('a', 'bc'))
+
+    def test_get_put(self):
+        """Stored data can be retrieved, hits and misses are counted."""
+        cache = FileCache(self.directory)
+
+        self.assertIsNone(cache.get('key'))
+        cache.put('key', b'data')
+        self.assertEqual(cache.get('key'), b'data')
+        self.assertIn('key', cache)
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_no_temporary_files_left(self):
+        """Writing is atomic and leaves only the final file."""
+        cache = FileCache(self.directory)
+        cache.put('key', b'data')
+        self.assertEqual(listdir(self.directory), ['key'])
+
+    def test_evict_least_recently_used(self):
+        """If the cache is too large, the oldest files are removed."""
+        cache = FileCache(self.directory, max_size=10)
+        cache.put('first', b'12345')
+        cache.put('second', b'12345')
+        # Make sure 'first' is older, then use it
+        utime(cache.path('first'), (0, 0))
+        utime(cache.path('second'), (1, 1))
+        cache.get('first')
+
+        cache.put('third', b'12345')
+        self.assertIn('first', cache)
+        self.assertNotIn('second', cache)
+        self.assertIn('third', cache)
+        self.assertEqual(cache.size, 10)
+
+    def test_size_is_tracked(self):
+        """The directory is only listed once, not on every write."""
+        cache = FileCache(self.directory, max_size=1000)
+        with patch('contractor.storage.listdir',
+                   side_effect=listdir) as list_files:
+            for index in range(50):
+                cache.put('key%i' % index, b'12345')
+            cache.put('key0', b'1234567890')
+            self.assertEqual(list_files.call_count, 1)
+        self.assertEqual(cache.size, 255)
+
+        cache.max_size = 100
+        cache.put('last', b'12345')
+        self.assertEqual(cache.size, 100)
+        self.assertEqual(cache.size, FileCache(self.directory).size)
+
+    def test_file_digest(self):
+        """Files are hashed from the start and rewound."""
+        cache = FileCache(self.directory)
+        cache.put('key', b'0123456789')
+        with open(cache.path('key'), 'rb') as file:
+            file.read(3)
+            self.assertEqual(file_digest(file, block_size=4),
+                             sha256(b'0123456789').hexdigest())
+            self.assertEqual(file.read(), b'0123456789')
+
+    def test_stats(self):
+        """Stats contain counters and size."""
+        cache = FileCache(self.directory)
+        cache.put('key', b'data')
+        cache.get('key')
+
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 0,
+                                         'files': 1, 'size': 4})
+
+
+class FileResponseTest(TestCase):
+    """Tests for ETags, conditional and range requests."""
+
+    def setUp(self):
+        self._dir = TemporaryDirectory(prefix='contractor')
+        self.cache = FileCache(self._dir.name)
+        self.cache.put('key', b'0123456789')
+        self.etag = sha256(b'0123456789').hexdigest()
+
+        self.app = Flask('contractor')
+
+        @self.app.route('/')
+        def index():
+            return file_response(open(self.cache.path('key'), 'rb'),
+                                 self.etag, 'application/pdf',
+                                 filename='test.pdf')
+
+        @self.app.route('/inline')
+        def inline():
+            return file_response(open(self.cache.path('key'), 'rb'),
+                                 self.etag, 'image/png',
+                                 filename='test.png', inline=True)
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_send(self):
+        """The file is sent with ETag, and has to be revalidated."""
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(), b'0123456789')
+        self.assertEqual(response.headers['ETag'], '"%s"' % self.etag)
+        self.assertEqual(response.headers['Content-Length'], '10')
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'attachment; filename=test.pdf')
+        response.close()
+
+    def test_inline(self):
+        """Files can be shown by the browser instead of downloaded."""
+        response = self.client.get('/inline')
+        self.assertEqual(response.headers['Content-Disposition'],
+                         'inline; filename=test.png')
+        response.close()
+
+    def test_not_modified(self):
+        """Unchanged files are not sent again."""
+        response = self.client.get(
+            '/', headers={'If-None-Match': '"%s"' % self.etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        response.close()
+
+        response = self.client.get('/', headers={'If-None-Match': '"old"'})
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_range(self):
+        """Parts of the file can be requested."""
+        response = self.client.get('/', headers={'Range': 'bytes=2-5'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.get_data(), b'2345')
+        self.assertEqual(response.headers['Content-Range'], 'bytes 2-5/10')
+        response.close()
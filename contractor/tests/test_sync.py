@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the incremental CRM sync.
+
+A fake CRM is used, so no connection is needed.
+"""
+
+import re
+from unittest import TestCase
+
+from contractor.soapclient import FIELDS, LIST_FIELDS
+from contractor.tests.fakes import FakeImporter, make_account
+
+
+class SyncTest(TestCase):
+    """Test importing changes only."""
+
+    def setUp(self):
+        self.crm = FakeImporter([make_account(index) for index in range(10)])
+
+    def _names(self, result):
+        return [company['companyname'] for company in result[0]]
+
+    def test_full_sync_matches_get_companies(self):
+        """The first sync imports everything."""
+        self.assertEqual(self.crm.sync(), self.crm.get_companies())
+        self.assertEqual(len(self.crm.sync()[0]), 10)
+
+    def _imported(self):
+        """Return the ids of accounts requested with all fields."""
+        return [_id for (query, fields) in self.crm.calls
+                if fields == FIELDS
+                for _id in re.findall(r"'(account-\d+)'", query)]
+
+    def test_only_changes_are_imported(self):
+        """Subsequent syncs only request modified accounts in full."""
+        self.crm.sync()
+        self.crm.calls = []
+
+        changed = make_account(3, name='Changed Inc.',
+                               date_modified='2018-02-01 00:00:00')
+        self.crm.accounts[changed['id']] = changed
+        result = self.crm.sync()
+
+        # Light list of all accounts (until an empty page), then modified
+        # accounts in full
+        self.assertEqual([fields for (_, fields) in self.crm.calls],
+                         [LIST_FIELDS, LIST_FIELDS, FIELDS])
+        self.assertEqual(self._imported(), ['account-00003'])
+
+        self.assertEqual(len(result[0]), 10)
+        self.assertEqual(self._names(result)[0], 'Changed Inc.')
+
+        # Without changes, only the list is requested
+        self.crm.calls = []
+        self.crm.sync()
+        self.assertEqual([fields for (_, fields) in self.crm.calls],
+                         [LIST_FIELDS, LIST_FIELDS])
+
+    def test_batches(self):
+        """Accounts are imported in batches."""
+        self.crm.batch_size = 4
+        self.crm.sync()
+        self.assertEqual(len([fields for (_, fields) in self.crm.calls
+                              if fields == FIELDS]), 3)
+        self.assertEqual(sorted(self._imported()),
+                         sorted(self.crm.accounts))
+
+    def test_page_limit(self):
+        """Nothing is lost if the CRM returns smaller pages than requested.
+        """
+        self.crm.client.page_limit = 3
+        self.crm.batch_size = 4
+        self.assertEqual(len(self.crm.sync()[0]), 10)
+
+        # Removed before importing it
+        new = make_account(42, date_modified='2018-02-01 00:00:00')
+        self.crm.accounts[new['id']] = new
+        self.crm.request_full_sync()
+        get = self.crm.get
+
+        def remove_first(*args, **kwargs):
+            self.crm.accounts.pop('account-00000', None)
+            return get(*args, **kwargs)
+        self.crm.get = remove_first
+        self.assertEqual(len(self.crm.sync()[0]), 10)
+
+    def test_get_company(self):
+        """Imported companies are only requested again if changed."""
+        self.crm.sync()
+        self.crm.calls = []
+
+        company = self.crm.get_company('account-00003')
+        self.assertEqual(company.companyname, 'Company 00003')
+        self.assertEqual(self.crm.calls, [("id = 'account-00003'",
+                                           LIST_FIELDS)])
+
+        changed = make_account(3, name='Changed Inc.',
+                               date_modified='2018-02-01 00:00:00')
+        self.crm.accounts[changed['id']] = changed
+        self.crm.calls = []
+        company = self.crm.get_company('account-00003')
+        self.assertEqual(company.companyname, 'Changed Inc.')
+        self.assertEqual([fields for (_, fields) in self.crm.calls],
+                         [LIST_FIELDS, FIELDS])
+
+        # The update is kept
+        self.crm.calls = []
+        self.crm.sync()
+        self.assertEqual(self._imported(), [])
+
+    def test_new_accounts(self):
+        """New accounts are added."""
+        self.crm.sync()
+        new = make_account(42, date_modified='2018-02-01 00:00:00')
+        self.crm.accounts[new['id']] = new
+
+        self.assertIn('Company 00042', self._names(self.crm.sync()))
+
+    def test_removed_accounts(self):
+        """Deleted and de-registered accounts are removed."""
+        self.crm.sync()
+        del self.crm.accounts['account-00001']
+        self.crm.accounts['account-00002']['messeteilnahme_c'] = '0'
+
+        names = self._names(self.crm.sync())
+        self.assertEqual(len(names), 8)
+        self.assertNotIn('Company 00001', names)
+        self.assertNotIn('Company 00002', names)
+
+    def test_errors(self):
+        """Accounts which can not be parsed are reported and fixed later."""
+        broken = make_account(5, tischgroesse_c='riesig')
+        self.crm.accounts[broken['id']] = broken
+        (data, errors) = self.crm.sync()
+        self.assertEqual(len(data), 9)
+        self.assertIn('Company 00005', errors)
+
+        fixed = make_account(5, date_modified='2018-02-01 00:00:00')
+        self.crm.accounts[fixed['id']] = fixed
+        (data, errors) = self.crm.sync()
+        self.assertEqual(len(data), 10)
+        self.assertEqual(errors, {})
+
+    def test_full_sync(self):
+        """Full syncs can be requested and happen regularly."""
+        self.crm.full_sync_every = 3
+        imported = []
+        for _ in range(4):
+            self.crm.calls = []
+            self.crm.sync()
+            imported.append(len(self._imported()))
+
+        self.assertEqual(imported, [10, 0, 0, 10])
+
+        self.crm.request_full_sync()
+        self.crm.calls = []
+        self.crm.sync()
+        self.assertEqual(len(self._imported()), 10)
+
+    def test_order(self):
+        """Sync and streamed import use the order of the CRM."""
+        lower = make_account(10, name='acme')
+        self.crm.accounts[lower['id']] = lower
+
+        streamed = [parsed['companyname'] for (_, parsed, _)
+                    in self.crm.iter_companies(page_size=4)]
+        self.assertEqual(self._names(self.crm.sync()), streamed)
+
+    def test_recorded_stream(self):
+        """A recorded streamed import makes the next sync incremental."""
+        list(self.crm.iter_companies(record=True))
+        self.crm.calls = []
+
+        self.assertEqual(len(self.crm.sync()[0]), 10)
+        self.assertEqual(self._imported(), [])
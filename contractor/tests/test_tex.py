@@ -7,29 +7,35 @@ Note: This will test creation for input combination, so it can take a while!
 We can not check if the pdfs are correctly created, but we can assert the
 following:
 
-* All contract and output combinations work without crashing (smoke testing)
-* There will be a file created in the end
-* There will be exactly one file (cleanup works)
+* All contract and output combinations can be rendered (smoke testing)
+* All combinations can be compiled into a pdf, with one page per company
 
-This test must be run from the same directory where the "amivtex" directory is!
+Compiling requires xelatex with amivtex and is skipped otherwise.
 """
 
-from unittest import TestCase
-from tempfile import TemporaryDirectory
-import os
-from subprocess import CalledProcessError
-from pprint import pformat
+from unittest import TestCase, skipUnless
+from shutil import which
+from io import BytesIO
 from itertools import count, chain
 from datetime import datetime as dt
 
-from contractor.tex import render_tex
+from PyPDF2 import PdfFileReader
+
+from contractor.batch import invitation_options
+from contractor.cache import TTLCache
+from contractor.tex import ParallelCompiler, create_environment, split_pdf
 from contractor.choices import BoothChoice, PacketChoice
+from contractor.letterdata import LetterData
 
 
-class TEXTest(TestCase):
-    """Tess class for tex tests."""
+def _pages(pdf):
+    return PdfFileReader(BytesIO(pdf)).getNumPages()
+
+
+class ContractData(object):
+    """Company data and options for all combinations of choices."""
 
-    output_formats = ["mail", "email", "tex"]
+    output_formats = ["mail", "email", "letter"]
 
     def _data(self):
         """Get all different combinations for companies.
@@ -54,89 +60,163 @@ class TEXTest(TestCase):
                         # Companycountry can either be empty (Switzerland)
                         # Or will be specified (all other countries)
                         for companycountry in ['', 'Faraway']:
-                            yield {
+                            yield LetterData(
+                                id='id',
                                 # Data without distinct choices.
                                 # Adding some umlauts to be sure that
                                 # wont crash anything
                                 # Although we have no way to check if they are
                                 # displayed correctly
-                                'amivrepresentative': 'Pablö',
+                                amivrepresentative='Pablö',
 
-                                'companyrepresentative': 'Sr. Senior',
-                                'companyname': 'Täst Inc.',
-                                'companyaddress': "l'Teststrüüt 5",
-                                'companycity': "1234 Testingtàn",
+                                companyrepresentative='Sr. Senior',
+                                companyname='Täst Inc.',
+                                companyaddress="l'Teststrüüt 5",
+                                companycity="1234 Testingtàn",
 
-                                'companycountry': companycountry,
+                                companycountry=companycountry,
 
                                 # booth and day
-                                'boothchoice': booth,
-                                'days': days,
+                                boothchoice=booth,
+                                days=days,
 
                                 # packets
-                                'media': media,
-                                'business': business,
-                                'first': first,
-                            }
+                                media=media,
+                                business=business,
+                                first=first,
+                            )
 
-    def _loop_create_contract_combinations(self, data):
-        """Try to create all contracts at once (in all output formats).
-
-        Assert that exactly one file is created.
-
-        Args:
-            data (list): companydata to create contract for
-        """
+    def _options(self, output_format, data):
+        """Template variables for the contracts of data."""
         counter = count()
+        return dict(
+            letterdata=data,
+            contract_only=(output_format == "email"),
+            letter_only=(output_format == "letter"),
+            fairtitle="Superfair",
+            president="El Presidente",
+            sender="Herr Handlanger",
+            # Generate prices for all choices in a loop with
+            # Counter as a price
+            prices={
+                choice.name: next(counter) for choice in chain(
+                    BoothChoice, PacketChoice)
+            },
+            days={
+                'first': dt(2016, 10, 18),
+                'second': dt(2016, 10, 19),
+            },
+        )
+
+
+class TEXTest(ContractData, TestCase):
+    """Tess class for tex tests."""
+
+    def test_render_all(self):
+        """Render contracts for all companies in all output formats."""
+        tex = create_environment()
+        data = list(self._data())
 
-        # Loop through format
-        for format in self.output_formats:
-            contract_only = (format == "email")
-            return_tex = (format == "tex")
-
-            # Create a new temp dir every round so no
-            # Data gets carried over
-            with TemporaryDirectory(prefix="contractor") as dir:
-                render_tex(
-                    letterdata=data,
-                    texpath="./amivtex",
-                    output_dir=dir,
-                    contract_only=contract_only,
-                    return_tex=return_tex,
-                    fairtitle="Superfair",
-                    president="El Presidente",
-                    sender="Herr Handlanger",
-                    # Generate prices for all choicesin a loop with
-                    # Counter as a price
-                    prices={
-                        choice.name: next(counter) for choice in chain(
-                            BoothChoice, PacketChoice)
-                    },
-                    days={
-                        'first': dt(2016, 10, 18),
-                        'second': dt(2016, 10, 19),
-                    },
-                )
-
-                # Only one file (pdf or tex) is created in the end
-                n_files = len(os.listdir(dir))
-                self.assertTrue(n_files == 1)
+        for output_format in self.output_formats:
+            source = tex.render_template(
+                'contract.tex', **self._options(output_format, data))
+            self.assertEqual(source.count('\\name{'), len(data))
 
+    @skipUnless(which('xelatex'), "xelatex is not installed")
     def test_create_all(self):
-        """Try to create all contracts at once (in all output formats)."""
-        # All companies
-        try:
-            self._loop_create_contract_combinations([i for i in self._data()])
-        except CalledProcessError:
-            msg = ("Render tex failed for creation of all contracts.")
-            raise Exception(msg)
+        """Compile contracts for all companies at once (in all formats)."""
+        compiler = ParallelCompiler(create_environment())
+        data = list(self._data())
 
+        for output_format in self.output_formats:
+            pdf = compiler.compile_template(
+                'contract.tex', **self._options(output_format, data))
+            self.assertGreaterEqual(
+                PdfFileReader(BytesIO(pdf)).getNumPages(), len(data))
+
+    @skipUnless(which('xelatex'), "xelatex is not installed")
     def test_create_single(self):
-        """Try to create all contracts separately (in all output formats)."""
-        for company in self._data():
-            try:
-                self._loop_create_contract_combinations([company])
-            except CalledProcessError:
-                msg = ("Rendering tex failed for this data:\n" +
-                       pformat(company))
-                raise Exception(msg)
+        """Compile contracts for all companies separately."""
+        compiler = ParallelCompiler(create_environment())
+
+        for output_format in self.output_formats:
+            options = self._options(output_format, list(self._data()))
+            data = options.pop('letterdata')
+            for (company, pdf) in compiler.compile_each('contract.tex', data,
+                                                        **options):
+                self.assertTrue(pdf.startswith(b'%PDF'), company)
+
+    def _assert_split(self, name, data, **options):
+        """Compile two companies, check the pages of the split documents.
+
+        No blank pages may be added between companies.
+        """
+        compiler = ParallelCompiler(create_environment())
+        single = [_pages(compiler.compile_template(
+            name, letterdata=[company], **options)) for company in data]
+
+        pdf = compiler.compile_template(name, letterdata=data, **options)
+        self.assertEqual(_pages(pdf), sum(single))
+        self.assertEqual([_pages(part) for part in split_pdf(pdf, 2)],
+                         single)
+
+    @skipUnless(which('xelatex'), "xelatex is not installed")
+    def test_split(self):
+        """Contracts of two companies are split at their first pages."""
+        data = list(self._data())[:2]
+        for output_format in self.output_formats:
+            options = self._options(output_format, data)
+            del options['letterdata']
+            self._assert_split('contract.tex', data, **options)
+
+    @skipUnless(which('xelatex'), "xelatex is not installed")
+    def test_split_invitations(self):
+        """Invitations of two companies are split at their first pages."""
+        options = self._options('mail', [])
+        self._assert_split('invitation.tex', list(self._data())[:2],
+                           **invitation_options(options))
+
+class FragmentTest(ContractData, TestCase):
+    """Test memoized rendering of the contract of every company."""
+
+    def setUp(self):
+        self.cache = TTLCache(maxsize=1000, ttl=60)
+        self.tex = create_environment(fragment_cache=self.cache)
+        self.data = list(self._data())
+        for (index, company) in enumerate(self.data):
+            company.id = 'id%s' % index
+
+    def _render(self, **changes):
+        options = self._options('mail', self.data)
+        options.update(changes)
+        return self.tex.render_template('contract.tex', **options)
+
+    def test_same_output(self):
+        """Cached fragments produce the same document."""
+        uncached = create_environment()
+        for output_format in self.output_formats:
+            options = self._options(output_format, self.data)
+            self.assertEqual(
+                self.tex.render_template('contract.tex', **options),
+                uncached.render_template('contract.tex', **options))
+
+    def test_only_changes_are_rendered(self):
+        """Only changed companies and settings used by them are rendered."""
+        first = self._render()
+        self.assertEqual(self.cache.misses, len(self.data))
+
+        self.assertEqual(self._render(), first)
+        self.assertEqual(self.cache.misses, len(self.data))
+
+        # Changing a single company
+        self.data[3].companyname = 'Changed Inc.'
+        self.assertIn('Changed Inc.', self._render())
+        self.assertEqual(self.cache.misses, len(self.data) + 1)
+
+        # Settings not used in the fragment
+        self._render(fairtitle='Other fair')
+        self.assertEqual(self.cache.misses, len(self.data) + 1)
+
+        # Settings used in the fragment
+        self._render(sender='Someone else')
+        self.assertEqual(self.cache.misses, 2 * len(self.data) + 1)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""Tests for the pool of tex workers.
+
+A fake tex engine is used, which returns its output directory as pdf and
+records every call in the pool directory. Sources containing `SLEEP` take
+long, sources containing `FAIL` fail.
+"""
+
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from os import chmod, path
+from shutil import rmtree
+import sys
+
+from jinja2 import DictLoader
+from jinjatex import Error, Jinjatex
+
+from contractor.tex import ParallelCompiler, Timeout
+from contractor.workers import TexWorkerPool
+
+FAKE_ENGINE = """#!%s
+import os, sys, time
+args = sys.argv[1:]
+outdir = args[args.index('-output-directory') + 1]
+source = open(args[-1]).read()
+with open(os.path.join(outdir, '..', 'calls'), 'a') as file:
+    file.write(source.split()[0] + '\\n')
+if 'SLEEP' in source:
+    time.sleep(10)
+if 'FAIL' in source:
+    sys.exit(1)
+with open(os.path.join(outdir, 'temp.log'), 'w') as file:
+    file.write('log')
+with open(os.path.join(outdir, 'temp.pdf'), 'w') as file:
+    file.write(outdir)
+"""
+
+
+class WorkerPoolTest(TestCase):
+    """Test dispatching, timeouts and recycling."""
+
+    def setUp(self):
+        self._dir = TemporaryDirectory(prefix='contractor')
+        self.engine = path.join(self._dir.name, 'faketex')
+        with open(self.engine, 'w') as file:
+            file.write(FAKE_ENGINE % sys.executable)
+        chmod(self.engine, 0o755)
+
+        self.directory = path.join(self._dir.name, 'scratch')
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+        self._dir.cleanup()
+
+    def _pool(self, **kwargs):
+        kwargs.setdefault('workers', 1)
+        kwargs.setdefault('warmup', None)
+        pool = TexWorkerPool(self.engine, self.directory, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def _calls(self):
+        with open(path.join(self.directory, 'calls')) as file:
+            return file.read().split()
+
+    def test_scratch_directory_is_reused(self):
+        """All jobs of a worker run in the same directory."""
+        pool = self._pool()
+        first = pool.compile('first')
+        self.assertEqual(pool.compile('second'), first)
+        self.assertEqual(path.dirname(first.decode()), self.directory)
+        self.assertEqual(pool.stats()['compiled'], 2)
+
+    def test_warmup(self):
+        """Workers compile the warmup document before any jobs."""
+        pool = self._pool(workers=2, warmup='warmup')
+        pool.compile('job')
+        pool.close()
+        self.pools.remove(pool)
+
+        self.assertEqual(sorted(self._calls()), ['job', 'warmup', 'warmup'])
+
+    def test_timeout(self):
+        """Long compilations are aborted and the worker is recycled."""
+        pool = self._pool(timeout=0.5)
+        before = pool.compile('before')
+
+        with self.assertRaises(Timeout):
+            pool.compile('SLEEP')
+
+        after = pool.compile('after')
+        self.assertNotEqual(after, before)
+        self.assertFalse(path.exists(before.decode()))
+
+        stats = pool.stats()
+        self.assertEqual((stats['timeouts'], stats['recycled']), (1, 1))
+
+    def test_errors(self):
+        """Failures are raised, the worker continues."""
+        pool = self._pool()
+        with self.assertRaises(Error):
+            pool.compile('FAIL')
+        self.assertTrue(pool.compile('ok'))
+        self.assertEqual(pool.stats()['failed'], 1)
+
+    def test_recycle_after_jobs(self):
+        """Workers get a new directory after max_jobs."""
+        pool = self._pool(max_jobs=2)
+        directories = [pool.compile('job') for _ in range(3)]
+
+        self.assertEqual(directories[0], directories[1])
+        self.assertNotEqual(directories[1], directories[2])
+
+    def test_health_check(self):
+        """A broken scratch directory is replaced before the next job."""
+        pool = self._pool()
+        first = pool.compile('first')
+        rmtree(first.decode())
+
+        self.assertNotEqual(pool.compile('second'), first)
+        self.assertEqual(pool.stats()['unhealthy'], 1)
+
+    def test_cancel(self):
+        """Cancelled jobs are skipped."""
+        pool = self._pool(timeout=0.5)
+        slow = pool.submit('SLEEP')
+        cancelled = pool.submit('cancelled')
+        self.assertTrue(cancelled.cancel())
+
+        with self.assertRaises(Timeout):
+            slow.result()
+        pool.compile('last')
+        self.assertEqual(self._calls(), ['SLEEP', 'last'])
+
+    def test_stats(self):
+        """Workers are reported."""
+        stats = self._pool(workers=3).stats()
+        self.assertEqual((stats['workers'], stats['alive']), (3, 3))
+        self.assertEqual((stats['busy'], stats['queued']), (0, 0))
+
+    def test_compiler(self):
+        """The compiler runs the engine on the pool."""
+        pool = self._pool()
+        tex = Jinjatex(tex_engine=self.engine,
+                       loader=DictLoader({'test.tex': 'doc'}))
+        compiler = ParallelCompiler(tex, tex_pool=pool)
+
+        compiler.compile_template('test.tex', [])
+        self.assertEqual(pool.stats()['compiled'], 1)
@@ -0,0 +1,858 @@
+# -*- coding: utf-8 -*-
+
+"""Compile contracts for many companies in parallel.
+
+A single xelatex run for all companies only keeps one core busy. Instead,
+the companies are split into chunks, each chunk is rendered into its own
+document and the documents are compiled concurrently. The resulting pdfs are
+merged in the original order.
+
+Every company starts on a new page and the amivletter class does not share
+any state between companies, so the merged pdf has the same pages as a
+single document with all companies.
+
+The heavy lifting is done by the xelatex processes, the pool only has to
+wait for them. Therefore a thread pool is enough to keep all cores busy and
+we avoid forking the (multi-threaded) app.
+
+Optionally, compiled pdfs are stored in a `FileCache`, keyed by the tex
+source, the template and the installed amivtex version. Unchanged documents
+(and unchanged chunks of bulk documents) are not compiled again.
+
+With a cache, bulk documents can also be built incrementally with
+`compile_bulk`: every company is compiled separately, and the pages of
+unchanged companies are taken from the previous bulk document.
+
+Documents with a separate file for every company (`compile_each`) are
+compiled in chunks as well: Templates mark the first page of every company
+with a named destination `contractor-<index>`, and the pdf of a chunk is
+split at these pages, so n files need about n / chunk_size tex runs instead
+of n. Without markers, every company is compiled on its own.
+
+For editing letters, `preview` creates a quick image of the first page with
+a single, uncompressed tex run, which is cached by the template variables.
+
+For mail merges with many recipients, `compile_stream` reads the records
+lazily and only compiles a few chunks ahead, and `concat_pdfs` combines
+the compiled chunks from disk one file at a time, so memory stays bounded.
+
+Also optionally, the preamble of documents is precompiled into a format
+(see `contractor.formats`), which saves loading the class and packages for
+every compilation.
+
+Finally, the tex engine can be run by a pool of long-lived workers (see
+`contractor.workers`), which reuse their scratch directories and limit the
+number of tex processes.
+"""
+
+from collections import deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+from hashlib import sha256
+from io import BytesIO
+import json
+from os import cpu_count, environ, listdir, path, pathsep, remove
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from time import monotonic
+import subprocess
+
+from jinja2 import PackageLoader, StrictUndefined, meta
+try:
+    from jinja2 import pass_context
+except ImportError:  # Jinja2 < 3.0
+    from jinja2 import contextfunction as pass_context
+from jinjatex import Jinjatex, Error
+from PyPDF2 import PdfFileMerger, PdfFileReader, PdfFileWriter
+from PyPDF2.generic import (ArrayObject, DictionaryObject, IndirectObject,
+                            NameObject, NumberObject, StreamObject)
+from PyPDF2.utils import PyPdfError
+
+from .metrics import METRICS
+from .storage import make_key
+
+MAX_RUNS = 10  # Avoid infinite oscillations
+MARKER = 'contractor-'  # Prefix of named destinations marking companies
+
+
+def _freeze(value):
+    """Return a stable string for template variables, used in keys."""
+    return json.dumps(value, sort_keys=True, default=lambda item: (
+        dict(item) if hasattr(item, 'keys') else repr(item)))
+
+
+class Fragments(object):
+    """Render parts of documents with separate templates and memoize them.
+
+    Templates call `fragment(name, data)`, e.g. once per company in a loop.
+    The fragment template is rendered with `data` and all other variables
+    it uses from the calling template. The result is cached by the
+    template source and the values of exactly these variables, so it is
+    only rendered again if the company or a setting used by the fragment
+    changes.
+
+    Args:
+        tex (Jinjatex): The environment with the templates
+        cache (TTLCache): Optional cache for the rendered fragments
+    """
+
+    def __init__(self, tex, cache=None):
+        self.tex = tex
+        self.cache = cache
+        self._templates = {}  # name: (template, variables, version)
+
+    def _template(self, name):
+        """Return the template, the variables it needs and its version.
+
+        The template is only analyzed again if it has been reloaded.
+        """
+        env = self.tex.env
+        template = env.get_template(name)
+        known = self._templates.get(name)
+        if known is None or known[0] is not template:
+            source = env.loader.get_source(env, name)[0]
+            variables = meta.find_undeclared_variables(env.parse(source))
+            known = (template, sorted(variables - set(env.globals)),
+                     make_key(name, source))
+            self._templates[name] = known
+        return known
+
+    def render(self, context, name, data):
+        """Render template name with data and variables from context."""
+        (template, variables, version) = self._template(name)
+        values = {variable: context[variable] for variable in variables
+                  if variable in context}
+        values['data'] = data
+
+        if self.cache is None:
+            return template.render(values)
+
+        key = make_key(version, _freeze(values))
+        fragment = self.cache.get(key)
+        if fragment is None:
+            fragment = template.render(values)
+            self.cache.set(key, fragment)
+        return fragment
+
+
+def create_environment(fragment_cache=None):
+    """Create the Jinjatex environment for the tex templates.
+
+    Args:
+        fragment_cache (TTLCache): Optional cache for rendered fragments,
+            see `Fragments`
+    """
+    tex = Jinjatex(tex_engine='xelatex',
+                   loader=PackageLoader('contractor', 'tex_templates'),
+                   undefined=StrictUndefined,
+                   trim_blocks=True)
+
+    fragments = Fragments(tex, fragment_cache)
+
+    @pass_context
+    def fragment(context, name, data):
+        return fragments.render(context, name, data)
+
+    tex.env.globals['fragment'] = fragment
+
+    tex.env.filters.update({
+        # Filters to parse date, including short one to list dates nicely
+        # Format: Dienstag, 18.10.2016
+        'fulldate': lambda date: dt.strftime(date, "%A, %d.%m.%Y"),
+        # Format: Dienstag, 18.
+        'shortdate': lambda date: dt.strftime(date, "%A, %d.")
+    })
+
+    return tex
+
+
+_class_file = []  # Location of amivletter.cls, only looked up once
+_class_version = {}  # mtime: hash
+
+
+def amivtex_version():
+    """Return a hash of the installed amivletter class, '' if not found.
+
+    The class is only hashed again if it has been modified.
+    """
+    try:
+        if not _class_file:
+            found = subprocess.check_output(['kpsewhich', 'amivletter.cls'])
+            _class_file.append(found.decode().strip())
+        mtime = path.getmtime(_class_file[0])
+
+        if mtime not in _class_version:
+            with open(_class_file[0], 'rb') as file:
+                version = sha256(file.read()).hexdigest()
+            _class_version.clear()
+            _class_version[mtime] = version
+        return _class_version[mtime]
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class Timeout(Error):
+    """Compilation took too long and has been aborted."""
+
+
+def clean_directory(directory):
+    """Remove everything inside directory, but keep the directory."""
+    for name in listdir(directory):
+        filename = path.join(directory, name)
+        if path.isdir(filename) and not path.islink(filename):
+            rmtree(filename)
+        else:
+            remove(filename)
+
+
+def compile_tex(source, tex_engine='xelatex', fmt=None, directory=None,
+                timeout=None, draft=False):
+    """Compile tex source and return the pdf content.
+
+    Works like `jinjatex.render_tex`, but can use a precompiled format,
+    reuse a scratch directory and abort long compilations.
+
+    Args:
+        source (str): The tex source
+        tex_engine (str): The tex command
+        fmt (str): Optional, path to a format file (without extension)
+        directory (str): Optional, existing scratch directory, which is
+            cleaned before compiling. Defaults to a temporary directory.
+        timeout (float): Optional, maximum number of seconds for all runs
+        draft (bool): Only run tex once, even if references are not
+            resolved yet, and do not compress the pdf. Faster, for previews.
+
+    Returns:
+        bytes: The pdf
+
+    Raises:
+        Timeout: If the compilation takes longer than timeout
+    """
+    if directory is None:
+        with TemporaryDirectory() as tempdir:
+            return compile_tex(source, tex_engine, fmt=fmt,
+                               directory=tempdir, timeout=timeout,
+                               draft=draft)
+
+    clean_directory(directory)
+    texfile = path.join(directory, 'temp.tex')
+
+    # Helper to read log file
+    def read_log():
+        with open(path.join(directory, 'temp.log'), 'rb') as file:
+            return file.read().decode('utf-8', 'replace')
+
+    with open(texfile, 'wb') as file:
+        file.write(source.encode('utf-8'))
+
+    commands = [tex_engine,
+                "-output-directory", directory,
+                "-interaction=batchmode"]
+    if draft and tex_engine == 'xelatex':
+        commands.append("-output-driver=xdvipdfmx -z0")
+    env = None
+    if fmt is not None:
+        # Add the directory to the search path for formats, the
+        # trailing separator keeps the default paths
+        commands.append("-fmt=%s" % path.basename(fmt))
+        env = dict(environ,
+                   TEXFORMATS=path.dirname(fmt) + pathsep)
+    commands.append(texfile)
+
+    deadline = None if timeout is None else monotonic() + timeout
+    try:
+        for _ in range(1 if draft else MAX_RUNS):
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - monotonic(), 0)
+            subprocess.check_output(commands, env=env, cwd=directory,
+                                    timeout=remaining)
+            # Look for the keyword 'run' in the log, indicating we need
+            # to compile again to resolve references etc.
+            if 'run' not in read_log():
+                break
+
+    except FileNotFoundError:
+        # The command was not recognized
+        raise Error("The command '%s' failed. Is everything installed?"
+                    % commands[0])
+    except subprocess.TimeoutExpired:
+        # The process has already been killed
+        raise Timeout("Compilation aborted after %s seconds." % timeout)
+    except subprocess.CalledProcessError as error:
+        # Try to return tex log in error message
+        try:
+            raise Error("Something went wrong during compilation!\n"
+                        "Here is the log content:\n\n %s" % read_log())
+        except FileNotFoundError:
+            # No log! Show output of command instead
+            raise Error(error.output.decode('utf-8', 'replace'))
+
+    with open(path.join(directory, 'temp.pdf'), 'rb') as file:
+        return file.read()
+
+
+def rasterize(pdf, resolution=60):
+    """Return the first page of a pdf (bytes) as png, using `pdftoppm`.
+
+    Returns:
+        bytes: The png, or None if `pdftoppm` is not installed
+    """
+    with TemporaryDirectory() as directory:
+        filename = path.join(directory, 'page.pdf')
+        with open(filename, 'wb') as file:
+            file.write(pdf)
+        try:
+            subprocess.check_output([
+                'pdftoppm', '-png', '-r', str(resolution), '-f', '1',
+                '-l', '1', '-singlefile', filename,
+                path.join(directory, 'page')], stderr=subprocess.STDOUT)
+        except FileNotFoundError:
+            return None
+        except subprocess.CalledProcessError as error:
+            raise Error(error.output.decode('utf-8', 'replace'))
+        with open(path.join(directory, 'page.png'), 'rb') as file:
+            return file.read()
+
+
+def chunks(items, size):
+    """Split a list into consecutive chunks with at most `size` items."""
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+def iter_chunks(items, size):
+    """Like `chunks`, but for iterables, which are only read as needed."""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def merge_pdfs(pdfs):
+    """Merge pdf files (bytes) into a single pdf, keeping the order."""
+    merger = PdfFileMerger()
+    for pdf in pdfs:
+        merger.append(BytesIO(pdf))
+
+    output = BytesIO()
+    merger.write(output)
+    merger.close()
+    return output.getvalue()
+
+
+def splice_pdfs(parts):
+    """Combine page ranges of pdf files (bytes) into a single pdf.
+
+    Every pdf is only parsed once, even if several ranges are taken from it.
+
+    Args:
+        parts (list): (pdf, first page, number of pages) tuples
+
+    Returns:
+        bytes: The combined pdf
+    """
+    readers = {}  # id of pdf: reader
+    writer = PdfFileWriter()
+    for (pdf, start, count) in parts:
+        if id(pdf) not in readers:
+            readers[id(pdf)] = PdfFileReader(BytesIO(pdf))
+        reader = readers[id(pdf)]
+        for index in range(start, start + count):
+            writer.addPage(reader.getPage(index))
+
+    output = BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def concat_pdfs(filenames, output):
+    """Write the pages of pdf files into a single pdf, one file at a time.
+
+    Unlike `merge_pdfs`, only the objects of the current file are kept in
+    memory: they are renumbered and written to output immediately. Only
+    the pages are combined, outlines and destinations are dropped.
+
+    Args:
+        filenames (iterable): Paths of the pdf files, in order
+        output (file): Binary file to write the combined pdf to
+    """
+    output.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+    offsets = [None, None]  # Offsets of all objects, 1 and 2 are written last
+    pages = []  # numbers of all page objects
+    root = IndirectObject(2, 0, None)  # The page tree
+
+    def _write(number, value):
+        offsets[number - 1] = output.tell()
+        output.write(b'%i 0 obj\n' % number)
+        value.writeToStream(output, None)
+        output.write(b'\nendobj\n')
+
+    for filename in filenames:
+        with open(filename, 'rb') as file:
+            reader = PdfFileReader(file)
+            numbers = {}  # (id, generation) in the file: new number
+            queue = deque()
+
+            def _reference(reference):
+                key = (reference.idnum, reference.generation)
+                if key not in numbers:
+                    offsets.append(None)
+                    numbers[key] = len(offsets)
+                    queue.append(reference)
+                return IndirectObject(numbers[key], 0, None)
+
+            def _convert(value):
+                """Copy value, with references to the new numbers."""
+                if isinstance(value, IndirectObject):
+                    return _reference(value)
+                if isinstance(value, StreamObject):
+                    copy = value.__class__()
+                    copy._data = value._data
+                elif isinstance(value, DictionaryObject):
+                    copy = DictionaryObject()
+                elif isinstance(value, ArrayObject):
+                    return ArrayObject(_convert(item) for item in value)
+                else:
+                    return value
+                copy.update((key, _convert(item)) for (key, item)
+                            in value.items()
+                            if key not in ('/Parent', '/Length'))
+                return copy
+
+            # Pages are copied with inherited attributes, in the new tree
+            for page in reader.pages:
+                reference = _reference(page.indirectRef)
+                queue.remove(page.indirectRef)
+                copy = _convert(page)
+                copy[NameObject('/Parent')] = root
+                _write(reference.idnum, copy)
+                pages.append(reference)
+
+            while queue:
+                reference = queue.popleft()
+                _write(numbers[(reference.idnum, reference.generation)],
+                       _convert(reference.getObject()))
+
+    _write(2, DictionaryObject({
+        NameObject('/Type'): NameObject('/Pages'),
+        NameObject('/Kids'): ArrayObject(pages),
+        NameObject('/Count'): NumberObject(len(pages)),
+    }))
+    _write(1, DictionaryObject({
+        NameObject('/Type'): NameObject('/Catalog'),
+        NameObject('/Pages'): root,
+    }))
+
+    start = output.tell()
+    output.write(b'xref\n0 %i\n0000000000 65535 f \n' % (len(offsets) + 1))
+    for offset in offsets:
+        output.write(b'%010i 00000 n \n' % offset)
+    output.write(b'trailer\n<< /Size %i /Root 1 0 R >>\nstartxref\n%i\n'
+                 b'%%%%EOF\n' % (len(offsets) + 1, start))
+
+
+def count_pages(pdf):
+    """Return the number of pages of a pdf (bytes)."""
+    return PdfFileReader(BytesIO(pdf)).getNumPages()
+
+
+def split_pdf(pdf, count):
+    """Split a pdf (bytes) into the documents of count companies.
+
+    The first page of every company is marked by a named destination
+    `contractor-<index>`, see `contract.tex`.
+
+    Returns:
+        list: A pdf (bytes) per company, or None if the markers are missing
+            or do not match the number of companies
+    """
+    reader = PdfFileReader(BytesIO(pdf))
+    try:
+        destinations = reader.getNamedDestinations()
+        starts = sorted(
+            (int(title[len(MARKER):]),
+             reader.getDestinationPageNumber(destination))
+            for (title, destination) in destinations.items()
+            if title.startswith(MARKER) and title[len(MARKER):].isdigit())
+    except (PyPdfError, KeyError, ValueError):
+        return None
+
+    pages = [page for (_, page) in starts] + [reader.getNumPages()]
+    if ([index for (index, _) in starts] != list(range(count)) or
+            pages[0] != 0 or
+            any(start >= end for (start, end) in zip(pages, pages[1:]))):
+        return None
+
+    return [splice_pdfs([(pdf, start, end - start)])
+            for (start, end) in zip(pages, pages[1:])]
+
+
+class ParallelCompiler(object):
+    """Compile templates with a `letterdata` loop in parallel chunks.
+
+    The pool is shared by all requests, which limits the number of
+    concurrent xelatex processes.
+
+    Args:
+        tex (Jinjatex): The environment to render templates with
+        workers (int): Maximum number of concurrent compilations,
+            defaults to the number of cores
+        chunk_size (int): Maximum number of companies per document
+        cache (FileCache): Optional cache for compiled pdfs
+        formats (FormatCache): Optional cache for precompiled preambles
+        tex_pool (TexWorkerPool): Optional pool of tex workers, by default
+            every compilation starts the engine in a temporary directory
+    """
+
+    def __init__(self, tex, workers=None, chunk_size=20, cache=None,
+                 formats=None, tex_pool=None):
+        self.tex = tex
+        self.workers = workers or cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.formats = formats
+        self.tex_pool = tex_pool
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+
+    @property
+    def version(self):
+        """Version of the tex installation, part of all cache keys."""
+        return amivtex_version()
+
+    def _run(self, source, fmt=None, draft=False):
+        """Run the tex engine, on the tex pool if available."""
+        with METRICS.timer('xelatex'):
+            try:
+                if self.tex_pool is not None:
+                    return self.tex_pool.compile(source, fmt, draft)
+                return compile_tex(source, self.tex.tex_engine, fmt=fmt,
+                                   draft=draft)
+            except Error:
+                METRICS.count('contractor_compile_failures_total')
+                raise
+
+    def render(self, name, **options):
+        """Render the template, timed."""
+        with METRICS.timer('render'):
+            return self.tex.render_template(name, **options)
+
+    def _compile(self, source, draft=False):
+        """Compile tex source and return the pdf.
+
+        If a format for the preamble is available, use it. If compiling
+        with the format fails, the format is discarded and the source is
+        compiled without it. See `compile_tex` for draft.
+        """
+        engine = self.tex.tex_engine
+        fmt = None
+        if self.formats is not None:
+            fmt = self.formats.get(source, engine, self.version)
+
+        if fmt is not None:
+            try:
+                return self._run(source, fmt, draft)
+            except Timeout:
+                raise  # Not a problem of the format
+            except Error:
+                self.formats.discard(fmt)
+
+        return self._run(source, draft=draft)
+
+    def key(self, name, source):
+        """Return the cache key for a source rendered from template name."""
+        template = self.tex.env.loader.get_source(self.tex.env, name)[0]
+        return make_key(self.version, name, template, source)
+
+    def _cached(self, key, create, stored=False):
+        """Return cached data for key or create and store it.
+
+        With stored, return the key instead, and do not read the data, e.g.
+        to send the file `cache.path(key)` from disk. Requires a cache.
+        """
+        if stored:
+            if self.cache.get_path(key) is None:
+                self.cache.put(key, create())
+            return key
+
+        if self.cache is None:
+            return create()
+
+        data = self.cache.get(key)
+        if data is None:
+            data = create()
+            self.cache.put(key, data)
+        return data
+
+    def compile(self, name, source, stored=False):
+        """Compile source rendered from template name, using the cache.
+
+        With stored, the cache key of the pdf is returned, see `_cached`.
+        """
+        return self._cached(self.key(name, source),
+                            lambda: self._compile(source), stored)
+
+    def preview_key(self, name, resolution, **options):
+        """Return the cache key for the preview of a template."""
+        template = self.tex.env.loader.get_source(self.tex.env, name)[0]
+        return make_key('preview', self.version, name, template,
+                        str(resolution), _freeze(options))
+
+    def preview(self, name, resolution=60, stored=False, **options):
+        """Return a quick image of the first page of the template.
+
+        The template is compiled as draft, and the first page converted to
+        png (see `rasterize`), or sent as pdf if this is not possible.
+        Previews are cached by the template variables, so they are not even
+        rendered again if nothing has changed.
+
+        Returns:
+            bytes: png or pdf, or its cache key with stored (see `_cached`)
+        """
+        def _create():
+            source = self.render(name, **options)
+            with METRICS.timer('preview'):
+                page = splice_pdfs([(self._compile(source, draft=True),
+                                     0, 1)])
+                return rasterize(page, resolution) or page
+
+        return self._cached(self.preview_key(name, resolution, **options),
+                            _create, stored)
+
+    def compile_template(self, name, letterdata, progress=None, stored=False,
+                         **options):
+        """Render and compile the template, return the merged pdf.
+
+        Without any letterdata, a single (empty) document is compiled.
+
+        Args:
+            name (str): Template name
+            letterdata (list): Company data, split into chunks
+            progress (callable): Optional, called with the number of
+                companies every time a chunk is finished
+            stored (bool): Return the cache key of the pdf instead, see
+                `_cached`
+            **options: Remaining template variables
+        """
+        parts = chunks(letterdata, self.chunk_size) or [[]]
+        sources = [self.render(name, letterdata=part, **options)
+                   for part in parts]
+
+        def _compile(index, stored=False):
+            pdf = self.compile(name, sources[index], stored)
+            if progress is not None:
+                progress(len(parts[index]))
+            return pdf
+
+        if len(sources) == 1:
+            # Nothing to parallelize (or merge)
+            return _compile(0, stored)
+
+        def _compile_chunks():
+            # map keeps the order of the chunks
+            return merge_pdfs(list(self.pool.map(_compile,
+                                                 range(len(sources)))))
+
+        keys = [self.key(name, source) for source in sources]
+        return self._cached(make_key(*keys), _compile_chunks, stored)
+
+    def compile_bulk(self, name, letterdata, progress=None, stored=False,
+                     **options):
+        """Compile every company separately and combine the pages.
+
+        A manifest records which pages of the combined pdf belong to which
+        company document. When the same template is compiled again with the
+        same options, the pages of unchanged companies are taken from the
+        previous combined pdf, and only new or changed companies are
+        compiled, so a few edits in the CRM only need a few compilations.
+
+        Missing companies are compiled in chunks with `compile_split`, so a
+        template with markers needs a tex run per chunk, not per company.
+        Company documents are also cached on their own, and shared with
+        `compile_each` and single contracts.
+
+        Without a cache, this is the same as `compile_template`.
+
+        Args:
+            name (str): Template name
+            letterdata (list): Company data
+            progress (callable): Optional, called with the number of
+                companies every time a chunk is finished
+            stored (bool): Return the cache key of the pdf instead, see
+                `_cached`
+            **options: Remaining template variables
+        """
+        if self.cache is None or len(letterdata) < 2:
+            return self.compile_template(name, letterdata, progress=progress,
+                                         stored=stored, **options)
+
+        sources = [self.render(name, letterdata=[data], **options)
+                   for data in letterdata]
+        keys = [self.key(name, source) for source in sources]
+        result_key = make_key(*keys)
+
+        if stored:
+            result = self.cache.get_path(result_key)
+        else:
+            result = self.cache.get(result_key)
+        if result is not None:
+            if progress is not None:
+                progress(len(letterdata))
+            return result_key if stored else result
+
+        # Manifest of the last combined pdf for this template and options
+        manifest_key = make_key('manifest', self.version, name,
+                                _freeze(options))
+        (previous, ranges) = self._load_manifest(manifest_key)
+
+        parts = [None] * len(keys)
+        missing = []
+        for (index, key) in enumerate(keys):
+            if key in ranges:
+                (start, count) = ranges[key]
+                parts[index] = (previous, start, count)
+            else:
+                missing.append(index)
+        if progress is not None and len(missing) < len(keys):
+            progress(len(keys) - len(missing))
+
+        def _compile(indexes):
+            pdfs = self.compile_split(
+                name, [letterdata[index] for index in indexes], **options)
+            if progress is not None:
+                progress(len(indexes))
+            return pdfs
+
+        # map keeps the order of the chunks
+        missing = chunks(missing, self.chunk_size)
+        for (indexes, pdfs) in zip(missing, self.pool.map(_compile, missing)):
+            for (index, pdf) in zip(indexes, pdfs):
+                parts[index] = (pdf, 0, count_pages(pdf))
+        result = splice_pdfs(parts)
+
+        pages = []
+        start = 0
+        for (key, (_, _, count)) in zip(keys, parts):
+            pages.append([key, start, count])
+            start += count
+
+        self.cache.put(result_key, result)
+        self.cache.put(manifest_key, json.dumps(
+            {'pdf': result_key, 'pages': pages}).encode())
+        return result_key if stored else result
+
+    def _load_manifest(self, manifest_key):
+        """Return the previous pdf and {key: (start, count)} of companies.
+
+        If there is no manifest or the pdf is gone, (None, {}) is returned.
+        """
+        manifest = self.cache.get(manifest_key)
+        if manifest is None:
+            return (None, {})
+        manifest = json.loads(manifest.decode())
+
+        previous = self.cache.get(manifest['pdf'])
+        if previous is None:
+            return (None, {})
+        return (previous, {key: (start, count)
+                           for (key, start, count) in manifest['pages']})
+
+    def compile_split(self, name, letterdata, **options):
+        """Compile the documents of several companies with one tex run.
+
+        Companies are compiled into a single document, which is split at
+        the markers of the template. The documents are cached like separate
+        compilations, and only companies which are not cached are compiled.
+        Without markers, every company is compiled on its own.
+
+        Returns:
+            list: A pdf (bytes) for every company in letterdata
+        """
+        sources = [self.render(name, letterdata=[data], **options)
+                   for data in letterdata]
+        keys = [self.key(name, source) for source in sources]
+        pdfs = [None if self.cache is None else self.cache.get(key)
+                for key in keys]
+        missing = [index for (index, pdf) in enumerate(pdfs) if pdf is None]
+
+        if len(missing) > 1:
+            source = self.render(name, letterdata=[letterdata[index]
+                                                   for index in missing],
+                                 **options)
+            parts = None
+            if MARKER in source:
+                parts = split_pdf(self._compile(source), len(missing))
+            if parts is not None:
+                for (index, pdf) in zip(missing, parts):
+                    pdfs[index] = pdf
+                    if self.cache is not None:
+                        self.cache.put(keys[index], pdf)
+                METRICS.count('contractor_split_documents_total',
+                              len(parts))
+
+        return [pdf if pdf is not None else self.compile(name, source)
+                for (pdf, source) in zip(pdfs, sources)]
+
+    def _ordered(self, function, items):
+        """Call function for all items in the pool, yield results in order.
+
+        Only a few items (one per worker) are processed ahead, so memory
+        stays bounded if the consumer is slow. Items are read as needed.
+
+        Yields:
+            tuple: (item, result)
+        """
+        pending = deque()
+        for item in items:
+            pending.append((item, self.pool.submit(function, item)))
+            if len(pending) >= self.workers:
+                (done, future) = pending.popleft()
+                yield (done, future.result())
+
+        while pending:
+            (done, future) = pending.popleft()
+            yield (done, future.result())
+
+    def compile_each(self, name, letterdata, schedule=None, **options):
+        """Compile a separate document for every company.
+
+        Chunks of companies are compiled concurrently with `compile_split`,
+        but yielded in order, see `_ordered`.
+
+        Args:
+            schedule (callable): Called as `schedule(part, compile)` for
+                every chunk, e.g. to limit concurrent compilations. Must
+                return the result of `compile()`. By default, chunks are
+                compiled right away.
+
+        Yields:
+            tuple: (data, pdf) for every company in letterdata
+        """
+        def _compile(part):
+            def _compile_part():
+                return self.compile_split(name, part, **options)
+            if schedule is None:
+                return _compile_part()
+            return schedule(part, _compile_part)
+
+        for (part, pdfs) in self._ordered(
+                _compile, iter_chunks(letterdata, self.chunk_size)):
+            yield from zip(part, pdfs)
+
+    def compile_stream(self, name, records, **options):
+        """Compile the template for chunks of records, read as needed.
+
+        Meant for mail merges with many recipients: records can be an
+        iterator, e.g. streamed from the CRM, and only a few chunks are
+        kept in memory. The pdfs are not cached.
+
+        Yields:
+            tuple: (chunk, pdf), chunk is a list of records
+        """
+        def _compile(chunk):
+            return self._compile(self.render(name, letterdata=chunk,
+                                             **options))
+
+        return self._ordered(_compile, iter_chunks(records, self.chunk_size))
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+"""A pool of long-lived workers running the tex engine.
+
+Every worker is a thread with its own scratch directory, which is reused for
+all of its compilations instead of creating a new temporary directory every
+time. Jobs are dispatched through a shared queue, so the number of workers
+caps the number of tex processes running at the same time, no matter how
+many requests arrive.
+
+Workers are warmed up when they are (re)started by compiling a small
+document, which loads the engine, class files and fonts into the file
+system cache before the first real request arrives.
+
+Every job has a timeout, the tex process is killed if it takes too long.
+Before every job, a worker checks that its scratch directory is still
+usable. After a timeout, a failed health check or a fixed number of jobs,
+the worker is recycled: the scratch directory is replaced and the worker is
+warmed up again.
+"""
+
+from concurrent.futures import Future
+from os import R_OK, W_OK, X_OK, access, cpu_count, makedirs, path
+from queue import Queue
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock, Thread
+
+from .tex import Timeout, compile_tex
+
+# Small document to warm up workers, only uses the class
+WARMUP_SOURCE = ("\\documentclass{amivletter}\n"
+                 "\\begin{document}\n"
+                 "\\end{document}\n")
+
+
+class TexWorker(object):
+    """A single worker, compiling jobs from the queue of its pool.
+
+    Args:
+        pool (TexWorkerPool): The pool providing jobs and settings
+        index (int): Number of the worker, used for its directory
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.directory = None
+        self.jobs = 0  # Jobs since the last recycling
+        self.busy = False
+
+        self.thread = Thread(target=self._run, daemon=True,
+                             name='tex-worker-%s' % index)
+        self.thread.start()
+
+    def healthy(self):
+        """Check that the scratch directory can still be used."""
+        return (self.directory is not None and
+                path.isdir(self.directory) and
+                access(self.directory, R_OK | W_OK | X_OK))
+
+    def recycle(self):
+        """Replace the scratch directory and warm up again."""
+        if self.directory is not None:
+            rmtree(self.directory, ignore_errors=True)
+            self.pool._count('recycled')
+
+        makedirs(self.pool.directory, exist_ok=True)
+        self.directory = mkdtemp(prefix='worker-%s-' % self.index,
+                                 dir=self.pool.directory)
+        self.jobs = 0
+
+        if self.pool.warmup is not None:
+            try:
+                compile_tex(self.pool.warmup, self.pool.tex_engine,
+                            directory=self.directory,
+                            timeout=self.pool.timeout)
+            except Exception:
+                # The worker can be used anyway, warming up is optional
+                pass
+
+    def _run(self):
+        """Compile jobs until None is received."""
+        try:
+            self.recycle()
+        except OSError:
+            pass  # The health check tries again before the first job
+
+        while True:
+            job = self.pool.queue.get()
+            if job is None:
+                break
+
+            (source, fmt, draft, future) = job
+            if not future.set_running_or_notify_cancel():
+                continue  # Cancelled while waiting
+
+            self.busy = True
+            recycle = False
+            try:
+                if not self.healthy():
+                    self.pool._count('unhealthy')
+                    self.recycle()
+
+                pdf = compile_tex(source, self.pool.tex_engine, fmt=fmt,
+                                  draft=draft, directory=self.directory,
+                                  timeout=self.pool.timeout)
+            except Timeout as error:
+                self.pool._count('timeouts')
+                recycle = True
+                future.set_exception(error)
+            except Exception as error:
+                self.pool._count('failed')
+                future.set_exception(error)
+            else:
+                self.pool._count('compiled')
+                future.set_result(pdf)
+
+            self.jobs += 1
+            if (recycle or (self.pool.max_jobs is not None and
+                            self.jobs >= self.pool.max_jobs)):
+                try:
+                    self.recycle()
+                except OSError:
+                    pass  # The health check tries again before the next job
+            self.busy = False
+
+        if self.directory is not None:
+            rmtree(self.directory, ignore_errors=True)
+
+
+class TexWorkerPool(object):
+    """Long-lived workers compiling tex sources from a queue.
+
+    Args:
+        tex_engine (str): The tex command
+        directory (str): Directory for the scratch directories of workers
+        workers (int): Number of workers, defaults to the number of cores
+        timeout (float): Seconds until a compilation is aborted, None to
+            wait forever
+        max_jobs (int): Recycle workers after this many jobs, None to only
+            recycle after timeouts and failed health checks
+        warmup (str): Tex source compiled by every (recycled) worker before
+            accepting jobs, None to disable
+    """
+
+    def __init__(self, tex_engine, directory, workers=None, timeout=None,
+                 max_jobs=None, warmup=WARMUP_SOURCE):
+        self.tex_engine = tex_engine
+        self.directory = directory
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.warmup = warmup
+
+        self.queue = Queue()
+        self._lock = Lock()
+        self._stats = dict.fromkeys(
+            ['compiled', 'failed', 'timeouts', 'unhealthy', 'recycled'], 0)
+
+        self.workers = [TexWorker(self, index)
+                        for index in range(workers or cpu_count() or 1)]
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def submit(self, source, fmt=None, draft=False):
+        """Queue source for compilation.
+
+        See `contractor.tex.compile_tex` for the arguments.
+
+        Returns:
+            Future: Resolves to the pdf (bytes). Cancelling it before a
+                worker picks it up removes the job.
+        """
+        future = Future()
+        self.queue.put((source, fmt, draft, future))
+        return future
+
+    def compile(self, source, fmt=None, draft=False):
+        """Compile source on the next free worker and return the pdf.
+
+        Works like `contractor.tex.compile_tex`, which is called by the
+        worker.
+        """
+        return self.submit(source, fmt, draft).result()
+
+    def stats(self):
+        """Return counters and the current state of the workers."""
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(
+            workers=len(self.workers),
+            alive=sum(worker.thread.is_alive() for worker in self.workers),
+            busy=sum(worker.busy for worker in self.workers),
+            queued=self.queue.qsize(),
+        )
+        return stats
+
+    def close(self):
+        """Stop all workers after the queued jobs are done."""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.thread.join()